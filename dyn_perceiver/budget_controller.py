@@ -0,0 +1,144 @@
+import time
+import torch
+from dyn_perceiver.get_threshold import generate_distribution
+
+class BudgetController:
+    """
+    serving 중에 초당 FLOPs (또는 latency) budget을 맞추도록 threshold를 online으로 고르는 controller.
+    get_threshold로 calibration한 threshold들 중에서, 관측된 exit stage 비율로 구한 image당 예상 cost가
+    (초당 budget / 초당 처리해야 할 image 수) 이하인 것 중 가장 늦게 exit하는 threshold를 고른다.
+    요청이 몰리면 image당 budget이 줄어들어 자동으로 더 일찍 exit한다.
+
+    초당 처리해야 할 image 수는 요청의 도착 시각 (observe_arrivals)과 대기 중인 요청 수 (get_threshold의 queue_length)로
+    구하므로 caller (e.g. ExitAwareBatchingServer)가 넘겨줘야 한다.
+    get_threshold 호출 간격은 처리 속도 (throughput)이지 도착 rate가 아니므로 사용하지 않는다.
+
+    Args:
+        thresholds : get_threshold가 반환한 threshold list (34 * 4)
+        flops : exit stage별 image 한 장의 FLOPs (get_dynamic_flops)
+        flops_budget : 초당 사용할 수 있는 FLOPs
+        latency_budget : 초당 사용할 수 있는 inference 시간 (초). 관측된 FLOP당 시간으로 FLOPs budget으로 바꾼다.
+        threshold_distribution : get_threshold에 준 distribution. 처음 exit 비율의 추정치로 사용.
+        momentum : exit 비율, 도착 간격, FLOP당 시간의 running average momentum
+        drain_time : 대기 중인 요청을 처리할 시간 (초). queue_length개의 요청은 초당 queue_length / drain_time개로 더해진다.
+    """
+    def __init__(self, thresholds, flops, flops_budget=None, latency_budget=None,
+                 threshold_distribution=[0.85, 1, 0.5, 1], momentum=0.9, drain_time=1.0):
+        assert (flops_budget is None) != (latency_budget is None), \
+            'Exactly one of flops_budget and latency_budget must be given.'
+        self.thresholds = thresholds
+        self.flops = torch.as_tensor(flops, dtype=torch.float64)
+        self.flops_budget = flops_budget
+        self.latency_budget = latency_budget
+        self.momentum = momentum
+        self.drain_time = drain_time
+
+        # threshold마다 exit stage 비율의 running average. 처음에는 calibration의 목표 비율로 시작
+        self.exit_ratios = torch.zeros(len(thresholds), 4, dtype=torch.float64)
+        probs_list = generate_distribution(threshold_distribution)
+        for index in range(len(thresholds)):
+            if index < len(probs_list):
+                self.exit_ratios[index] = probs_list[index].double()
+            else:
+                # 마지막 threshold [1, 1, 1, -1]은 모두 stage 4에서 exit
+                self.exit_ratios[index, 3] = 1
+
+        self.index = len(thresholds) - 1
+        self.request_rate = None # 초당 도착하는 image 수
+        self.queue_length = 0 # 대기 중인 image 수
+        self.seconds_per_flop = None
+        self.mean_gap = None # 도착 간격의 running average (초)
+        self.last_arrival = None
+
+    def get_expected_flops(self):
+        # threshold별 image 한 장의 예상 FLOPs
+        return self.exit_ratios @ self.flops
+
+    def get_flops_budget(self):
+        if self.flops_budget is not None:
+            return self.flops_budget
+        if self.seconds_per_flop is None:
+            return None
+        return self.latency_budget / self.seconds_per_flop
+
+    def get_load(self):
+        # 초당 처리해야 할 image 수. 도착 rate에 대기 중인 요청을 drain_time 안에 처리하는 몫을 더한다
+        if self.request_rate is None and self.queue_length == 0:
+            return None
+        return (self.request_rate or 0) + self.queue_length / self.drain_time
+
+    def get_image_budget(self):
+        # image 한 장에 쓸 수 있는 FLOPs. load를 아직 모르면 None
+        flops_budget = self.get_flops_budget()
+        load = self.get_load()
+        if flops_budget is None or load is None:
+            return None
+        return flops_budget / load
+
+    def select(self):
+        """
+        image당 budget 안에서 예상 FLOPs가 가장 큰 threshold를 고른다.
+        budget 안에 드는 threshold가 없으면 가장 적은 FLOPs의 threshold를 고른다.
+        """
+        image_budget = self.get_image_budget()
+        if image_budget is None:
+            return self.index
+        expected_flops = self.get_expected_flops()
+        within_budget = expected_flops <= image_budget
+        if within_budget.any():
+            self.index = int(torch.where(within_budget, expected_flops, torch.full_like(expected_flops, -1)).argmax())
+        else:
+            self.index = int(expected_flops.argmin())
+        return self.index
+
+    def observe_arrivals(self, arrival_times=None):
+        """
+        요청이 도착했을 때 caller가 호출. 도착 간격의 running average로 도착 rate를 갱신.
+
+        Args:
+            arrival_times : 도착한 요청들의 시각 (time.perf_counter() 기준, 초) list. None이면 지금 한 개가 도착한 것으로 본다.
+        """
+        if arrival_times is None:
+            arrival_times = [time.perf_counter()]
+        for arrival in sorted(arrival_times):
+            if self.last_arrival is not None:
+                gap = max(arrival - self.last_arrival, 0)
+                self.mean_gap = gap if self.mean_gap is None else \
+                    self.momentum * self.mean_gap + (1 - self.momentum) * gap
+                if self.mean_gap > 0:
+                    self.request_rate = 1 / self.mean_gap
+            self.last_arrival = arrival if self.last_arrival is None else max(self.last_arrival, arrival)
+
+    def get_threshold(self, queue_length=None):
+        """
+        inference하기 전에 호출. 사용할 threshold를 반환.
+
+        Args:
+            queue_length : 이번에 inference할 image들 외에 아직 대기 중인 요청 수. None이면 이전 값을 유지.
+        """
+        if queue_length is not None:
+            self.queue_length = queue_length
+        return self.thresholds[self.select()]
+
+    def update(self, exiting_stages, elapsed=None, index=None):
+        """
+        get_threshold로 받은 threshold로 inference한 결과를 반영.
+
+        Args:
+            exiting_stages : 각 image가 exit한 stage (1~4) 또는 그 list (DynamicEvaluationLogger.append와 같음)
+            elapsed : inference에 걸린 시간 (초). latency_budget을 쓸 때 필요.
+            index : inference에 쓴 threshold의 index. None이면 마지막으로 고른 threshold.
+        """
+        if index is None:
+            index = self.index
+        if isinstance(exiting_stages, int):
+            exiting_stages = [exiting_stages]
+        counts = torch.bincount(torch.tensor(exiting_stages) - 1, minlength=4).double()
+        ratios = counts / counts.sum()
+        self.exit_ratios[index] = self.momentum * self.exit_ratios[index] + (1 - self.momentum) * ratios
+
+        if elapsed is not None:
+            used_flops = (counts @ self.flops).item()
+            seconds_per_flop = elapsed / used_flops
+            self.seconds_per_flop = seconds_per_flop if self.seconds_per_flop is None else \
+                self.momentum * self.seconds_per_flop + (1 - self.momentum) * seconds_per_flop
@@ -13,6 +13,7 @@ from timm.models.registry import register_model
 from dyn_perceiver.perceiver_core import (
     CrossAttentionLayer,
     SelfAttentionBlock,
+    set_attention_backend,
 )
 from dyn_perceiver.cnn_core import *
 import numpy as np
@@ -36,7 +37,10 @@ class DynPerceiver(nn.Module):
                 with_dwc=True,
                 with_last_CA=True,
                 with_isc=True,
-                zero_padding=False):
+                zero_padding=False,
+                batched_exit=False,
+                attn_backend='math',
+                attn_query_chunk_size=None):
         super().__init__()
         if num_SA_heads is None:
             num_SA_heads = [1,2,4,8]
@@ -52,6 +56,7 @@ class DynPerceiver(nn.Module):
         if spatial_reduction:
             self.ca_pooling = nn.AdaptiveAvgPool2d((7,7))
         self.zero_padding = zero_padding
+        self.batched_exit = batched_exit
 
         """
         functions for initializing cross-attention and self-attention layers respectively.
@@ -336,6 +341,8 @@ class DynPerceiver(nn.Module):
         self.token_mixer = nn.ModuleList(token_mixer)
         self.output_dir = output_dir
         self._init_parameters()
+        # attention 계산 방식 ('math', 'sdpa', 'chunked'). forward_calc_flops는 backend와 무관하게 같은 FLOPs를 센다.
+        set_attention_backend(self, attn_backend, attn_query_chunk_size)
         """
         FLOPs를 미리 계산하기 위해서 garbage value를 넣고 model을 한번 수행함.
         """
@@ -344,11 +351,173 @@ class DynPerceiver(nn.Module):
 
         self.softmax = nn.Softmax(dim=1).cuda()
         self.last_exited_stage = 4
-        self.output_fmap_sizes = [[1, 64, 200, 304], [1, 144, 100, 152], [1, 320, 50, 76], [1, 784, 25, 38]]
+        self.last_exited_stages = [4]
+        self._threshold_cache = None
+        # outs[k]의 channel 수. 각 stage의 CNN block은 stride 2라서 spatial size는 stage마다 절반(올림)이 된다.
+        self.output_fmap_channels = [self.cnn_body.block1.c_out, self.cnn_body.block2.c_out,
+                                     self.cnn_body.block3.c_out, self.cnn_body.block4.c_out]
+        self._zero_fmap_cache = {}
+        # input (H, W)마다 forward_calc_flops로 구한 exit stage별 FLOPs
+        self._stage_flops_table = {}
 
     def get_last_exited_stage(self):
         return self.last_exited_stage
 
+    def get_last_exited_stages(self):
+        """
+        batch 안의 각 sample이 exit한 stage (1~4)를 list로 반환.
+        """
+        return self.last_exited_stages
+
+    def get_active_levels(self, stage):
+        """
+        stage에서 exit했을 때 outs의 각 level이 실제로 계산되었는지 여부.
+        zero padding이면 exit 이후의 level은 zero map이라 inactive.
+        """
+        return [not self.zero_padding or k <= stage for k in range(4)]
+
+    def _exit_decision(self, y, threshold, k):
+        """
+        stage k classifier의 max softmax가 threshold[k] 이상인 sample들의 boolean mask.
+        threshold는 device 위에 한 번만 올려두고, .item()이나 CPU로의 copy 없이 device에서 계산한다.
+        """
+        threshold = self._preload_threshold(threshold, y.device)
+        max_preds, _ = self.softmax(y).max(dim=1)
+        return max_preds >= threshold[k]
+
+    def _preload_threshold(self, threshold, device):
+        """
+        같은 threshold로 반복 호출될 때 host-to-device copy를 하지 않도록 device tensor를 cache.
+        threshold가 다른 object로 바뀌거나, 같은 tensor가 in-place로 수정되면 (_version이 바뀜) 다시 copy한다.
+        """
+        cached = self._threshold_cache
+        version = getattr(threshold, '_version', None)
+        if cached is None or cached[0] is not threshold or cached[1] != version or cached[2].device != device:
+            cached = (threshold, version, torch.as_tensor(threshold, dtype=torch.float, device=device))
+            self._threshold_cache = cached
+        return cached[2]
+
+    def _zero_fmap(self, k, ref, ref_level):
+        """
+        zero padding에 쓰는 level k의 zero feature map.
+        ref (ref_level의 실제 feature map)에서 stage stride로 shape을 구하고,
+        (batch, channels, H, W, dtype, device)마다 하나의 buffer를 만들어 재사용한다.
+        여러 forward가 같은 buffer를 공유하므로 in-place로 수정하면 안 된다.
+        """
+        b, _, h, w = ref.shape
+        for _ in range(ref_level, k):
+            h, w = (h + 1) // 2, (w + 1) // 2
+        key = (b, self.output_fmap_channels[k], h, w, ref.dtype, ref.device)
+        zero_fmap = self._zero_fmap_cache.get(key)
+        if zero_fmap is None:
+            zero_fmap = ref.new_zeros(key[:4])
+            self._zero_fmap_cache[key] = zero_fmap
+        return zero_fmap
+
+    def get_stage_flops(self, input_size):
+        """
+        (H, W) 크기의 image 한 장을 각 exit stage (1~4)에서 exit할 때의 backbone FLOPs.
+        forward_calc_flops를 input 크기마다 한 번만 수행하고 table에 저장해둔다.
+        """
+        input_size = tuple(input_size)
+        stage_flops = self._stage_flops_table.get(input_size)
+        if stage_flops is None:
+            # BN의 running stat이 바뀌지 않도록 eval mode에서 계산하고, module별 mode를 그대로 복원
+            modes = [(m, m.training) for m in self.modules()]
+            self.eval()
+            try:
+                with torch.no_grad():
+                    x = self.latent.new_zeros(1, 3, *input_size)
+                    self.forward_calc_flops(x, save=False)
+            finally:
+                for m, mode in modes:
+                    m.training = mode
+            stage_flops = self.last_calc_flops
+            self._stage_flops_table[input_size] = stage_flops
+        return stage_flops
+
+    def _init_exit_state(self, b, device):
+        """
+        batched early exit에서 아직 exit하지 않은 sample들과 exit한 group들을 추적하는 state.
+        """
+        return dict(batch_size=b,
+                    active=torch.arange(b, device=device),
+                    logits=[None] * 4,
+                    groups=[])
+
+    def _batched_exit(self, stage, y, threshold, outs, exit_state):
+        """
+        현재 sub-batch 중 stage의 classifier confidence가 threshold를 넘는 sample들을 떼어낸다.
+
+        Args:
+            stage : exit point (1~4). 4는 남은 sample을 모두 exit시킨다.
+            y : 현재 sub-batch에 대한 stage classifier의 prediction
+            threshold : stage별 threshold
+            outs : 현재 sub-batch의 feature map list
+            exit_state : _init_exit_state로 만든 state
+
+        Returns:
+            계속 진행할 sample들의 (현재 sub-batch 기준) index
+        """
+        active = exit_state['active']
+        logits = exit_state['logits']
+        if logits[stage - 1] is None:
+            logits[stage - 1] = y.new_zeros(exit_state['batch_size'], y.size(1))
+        logits[stage - 1][active] = y
+
+        if stage == 4:
+            exit_mask = torch.ones_like(active, dtype=torch.bool)
+        else:
+            exit_mask = self._exit_decision(y, threshold, stage - 1)
+        # exit하는 sample을 앞으로 모으는 stable sort. host와의 sync는 n_exit 한 번뿐.
+        _, order = torch.sort(exit_mask.to(torch.uint8), descending=True, stable=True)
+        n_exit = int(exit_mask.sum())
+        exit_idx, keep_idx = order[:n_exit], order[n_exit:]
+
+        if n_exit > 0:
+            exit_outs = self._pad_outs([o[exit_idx] for o in outs])
+            exit_state['groups'].append((stage, active[exit_idx], exit_outs))
+        exit_state['active'] = active[keep_idx]
+        return keep_idx
+
+    def _gather_exit_state(self, exit_state):
+        """
+        exit한 group들을 원래 batch 순서의 per-sample feature list로 흩어놓는다.
+
+        Returns:
+            y_early3, y_att, y_cnn, y_merge (도달하지 못한 classifier는 0), per-sample outs
+        """
+        b = exit_state['batch_size']
+        sample_outs = [None] * b
+        stages = [4] * b
+        for stage, idx, group_outs in exit_state['groups']:
+            for j, i in enumerate(idx.tolist()):
+                sample_outs[i] = [o[j:j + 1] for o in group_outs]
+                stages[i] = stage
+        self.last_exited_stages = stages
+        self.last_exited_stage = max(stages)
+
+        logits = exit_state['logits']
+        y_early3 = logits[0]
+        y_att, y_cnn, y_merge = [torch.zeros_like(y_early3) if y is None else y for y in logits[1:]]
+        return y_early3, y_att, y_cnn, y_merge, sample_outs
+
+    def forward_all_exits(self, x, pad_mask=None):
+        """
+        threshold 없이 network 전체를 한 번만 실행하고, 각 exit stage (1~4)에서 exit했을 때
+        backbone이 반환했을 feature map list를 모두 만든다.
+        stage k까지의 feature map은 exit 여부와 무관하게 같으므로 segment마다 그때의 outs를 모으면 된다.
+
+        Returns:
+            y_early3, y_att, y_cnn, y_merge, exit_outs (exit_outs[k]: stage k + 1에서 exit했을 때의 outs)
+        """
+        state = self.init_state(x)
+        exit_outs = []
+        for stage in range(1, 5):
+            state = self.forward_segment(stage, state, pad_mask)
+            exit_outs.append(self.get_exit_outs(state, stage))
+        return (*self.get_state_preds(state), exit_outs)
+
     def _init_parameters(self):
         """
         latent code를 initialize하는 함수
@@ -356,24 +525,90 @@ class DynPerceiver(nn.Module):
         with torch.no_grad():
             self.latent.normal_(0.0, 0.02).clamp_(-2.0, 2.0)
 
-    def forward(self, x, pad_mask=None, threshold=None):
-        """_summary_
-        forward 연산을 수행.
+    def init_state(self, x):
+        """
+        forward_segment로 넘겨줄 state. 각 segment는 state의 tensor들을 이어서 계산하고,
+        state는 sample 단위로 select_state / cat_states 할 수 있다.
+            x : 현재 CNN feature map
+            x_latent : 현재 latent
+            outs : 지금까지의 stage output feature map list
+            preds : y_early3, y_att, y_cnn, y_merge (아직 계산하지 않은 classifier는 None)
+        """
+        return dict(x=x,
+                    x_latent=repeat(self.latent, "... -> b ...", b=x.shape[0]),
+                    outs=[],
+                    preds=[None] * 4)
 
-        Args:
-            x : input image
-            pad_mask : Defaults to None.
+    @staticmethod
+    def select_state(state, idx):
+        """
+        state에서 idx의 sample들만 골라낸다.
+        """
+        selected = {}
+        for key, value in state.items():
+            if isinstance(value, list):
+                selected[key] = [None if v is None else v[idx] for v in value]
+            else:
+                selected[key] = value[idx]
+        return selected
 
-        Returns:
-            각 classifier의 prediction. y_early3, y_att, y_cnn, y_merge 
+    @staticmethod
+    def cat_states(states):
+        """
+        같은 segment까지 계산된 (feature map 크기가 같은) state들을 하나의 batch로 합친다.
+        """
+        merged = {}
+        for key, value in states[0].items():
+            if isinstance(value, list):
+                merged[key] = [None if v is None else torch.cat([state[key][i] for state in states])
+                               for i, v in enumerate(value)]
+            else:
+                merged[key] = torch.cat([state[key] for state in states])
+        return merged
+
+    def get_state_preds(self, state):
         """
+        y_early3, y_att, y_cnn, y_merge. 아직 계산하지 않은 classifier는 0.
+        """
+        y_early3 = state['preds'][0]
+        return [y_early3] + [torch.zeros_like(y_early3) if y is None else y for y in state['preds'][1:]]
 
-        outs = []
+    def get_stage_outs(self, state, stage):
+        """
+        stage에서 exit할 때 실제로 계산된 feature map들 (zero padding 전).
+        """
+        if stage < 3:
+            return list(state['outs'])
+        return state['outs'] + [state['x']]
 
-        #TODO
-        b, c_in, _, _ = x.shape
-        x_latent = repeat(self.latent, "... -> b ...", b=b)
+    def get_exit_outs(self, state, stage):
+        """
+        stage에서 exit할 때 backbone이 반환하는 feature map list. zero padding이면 나머지 level은 zero map.
+        """
+        return self._pad_outs(self.get_stage_outs(state, stage))
+
+    def _pad_outs(self, outs):
+        if self.zero_padding:
+            ref_level = len(outs) - 1
+            for k in range(len(outs), 4):
+                outs.append(self._zero_fmap(k, outs[ref_level], ref_level))
+        return outs
+
+    def forward_segment(self, stage, state, pad_mask=None):
+        """
+        exit point (stage - 1)부터 exit point stage까지를 계산하고, stage의 classifier prediction을 state['preds']에 넣는다.
+            stage 1: stem ~ stage3의 self attention, y_early3
+            stage 2: block3 ~ stage4의 self attention, y_att
+            stage 3: block4, y_cnn
+            stage 4: last cross attention, y_merge
+        """
+        state = dict(state, outs=list(state['outs']), preds=list(state['preds']))
+        [self._forward_segment1, self._forward_segment2,
+         self._forward_segment3, self._forward_segment4][stage - 1](state, pad_mask)
+        return state
 
+    def _forward_segment1(self, state, pad_mask):
+        x, x_latent, outs = state['x'], state['x_latent'], state['outs']
         x = self.cnn_stem(x)
         # before stage1
         # conv to transformer
@@ -456,28 +691,12 @@ class DynPerceiver(nn.Module):
         y_early3 = self.early_classifier3(y_early3)
         outs.append(x)
 
-        logits = [[] for _ in range(1)]
-        if threshold is not None:
-            _t = self.softmax(y_early3)
-            logits[0].append(_t)
-            logits[0] = torch.cat(logits[0], dim=0)
-
-            size = (1, logits[0].size(0), logits[0].size(1))
-            ts_logits = torch.Tensor().resize_(size).zero_()
-            ts_logits[0].copy_(logits[0])
-
-            _, n_sample, _ =  ts_logits.size()
-            max_preds, _ = ts_logits.max(dim=2, keepdim=False)
-
-            for i in range(n_sample):
-                if max_preds[0][i].item() >= threshold[0]:
-                    self.last_exited_stage = 1
-                    if self.zero_padding:
-                        for k in range(2, 4):
-                            outs.append(torch.zeros(*self.output_fmap_sizes[k]).cuda())
-            
-                    return y_early3, torch.zeros_like(y_early3), torch.zeros_like(y_early3), torch.zeros_like(y_early3), outs 
+        state['x'], state['x_latent'] = x, x_latent
+        state['preds'][0] = y_early3
 
+    def _forward_segment2(self, state, pad_mask):
+        x, x_latent, outs = state['x'], state['x_latent'], state['outs']
+        y_early3 = state['preds'][0]
         x = self.cnn_body.block3(x)
 
         # between stage3 and stage4
@@ -518,54 +737,22 @@ class DynPerceiver(nn.Module):
             y_att = self.classifier_att(x_latent_mean)
         outs.append(x)
 
-        logits = [[] for _ in range(1)]
-        if threshold is not None:
-            _t = self.softmax(y_att)
-            logits[0].append(_t)
-            logits[0] = torch.cat(logits[0], dim=0)
-
-            size = (1, logits[0].size(0), logits[0].size(1))
-            ts_logits = torch.Tensor().resize_(size).zero_()
-            ts_logits[0].copy_(logits[0])
-
-            _, n_sample, _ =  ts_logits.size()
-            max_preds, _ = ts_logits.max(dim=2, keepdim=False)
-
-            for i in range(n_sample):
-                if max_preds[0][i].item() >= threshold[1]:
-                    self.last_exited_stage = 2 
-                    if self.zero_padding:
-                        for k in range(3, 4):
-                            outs.append(torch.zeros(*self.output_fmap_sizes[k]).cuda())
-            
-                    return y_early3, y_att, torch.zeros_like(y_att), torch.zeros_like(y_att), outs 
+        state['x'], state['x_latent'], state['x_latent_mean'] = x, x_latent, x_latent_mean
+        state['preds'][1] = y_att
 
-        x = self.cnn_body.block4(x)
+    def _forward_segment3(self, state, pad_mask):
+        x = self.cnn_body.block4(state['x'])
 
         x_mean = self.avgpool(x)
         x_mean = x_mean.flatten(start_dim=1)
         y_cnn = self.classifier_cnn(x_mean)
-        
-        logits = [[] for _ in range(1)]
-        if threshold is not None:
-            _t = self.softmax(y_cnn)
-            logits[0].append(_t)
-            logits[0] = torch.cat(logits[0], dim=0)
-
-            size = (1, logits[0].size(0), logits[0].size(1))
-            ts_logits = torch.Tensor().resize_(size).zero_()
-            ts_logits[0].copy_(logits[0])
-
-            _, n_sample, _ =  ts_logits.size()
-            max_preds, _ = ts_logits.max(dim=2, keepdim=False)
-
-            for i in range(n_sample):
-                if max_preds[0][i].item() >= threshold[2]:
-                    self.last_exited_stage = 3
-                    outs.append(x)
-            
-                    return y_early3, y_att, y_cnn, torch.zeros_like(y_cnn), outs
 
+        state['x'], state['x_mean'] = x, x_mean
+        state['preds'][2] = y_cnn
+
+    def _forward_segment4(self, state, pad_mask):
+        x, x_latent, x_mean = state['x'], state['x_latent'], state['x_mean']
+        x_latent_mean, y_att = state['x_latent_mean'], state['preds'][1]
         # cross attention from z to x
         if self.last_cross_att_z2x is not None:
             _,_,h,w = x.shape
@@ -574,7 +761,6 @@ class DynPerceiver(nn.Module):
             x = rearrange(x, "b (h w) c -> b c h w", h=h, w=w)
             x_mean = self.avgpool(x)
             x_mean = x_mean.flatten(start_dim=1)
-        outs.append(x)
 
         if self.with_isc:
             y4_ = self.isc4(y_att)
@@ -584,39 +770,46 @@ class DynPerceiver(nn.Module):
             x_merge = torch.cat((x_mean, x_latent_mean), dim=1)
             y_merge = self.classifier_merge(x_merge)
 
-        """
-        logits = [[] for _ in range(4)]
-        if threshold is not None:
-            output = [y_early3, y_att, y_cnn, y_merge]
-            for b in range(4):
-                _t = self.softmax(output[b])
-                logits[b].append(_t)
-
-            for b in range(4):
-                logits[b] = torch.cat(logits[b], dim=0)
-
-            size = (4, logits[0].size(0), logits[0].size(1))
-            ts_logits = torch.Tensor().resize_(size).zero_()
-            for b in range(4):
-                ts_logits[b].copy_(logits[b])
-            
-            n_stage, n_sample, _ =  ts_logits.size()
-            max_preds, _ = ts_logits.max(dim=2, keepdim=False)
-
-            for i in range(n_sample):
-                for k in range(n_stage):
-                    if max_preds[k][i].item() >= threshold[k]:
-                        self.last_exited_stage = k + 1 # 어느 스테이지에서 exit했는지 정보 필요. 1~4 range
-                        for j in range(k+1, n_stage):
-                            outs[j][i].zero_()
-        """
-        if threshold is not None:
-            self.last_exited_stage = 4
+        state['x'], state['x_mean'] = x, x_mean
+        state['preds'][3] = y_merge
 
-        return y_early3, y_att, y_cnn, y_merge, outs
+    def forward(self, x, pad_mask=None, threshold=None):
+        """_summary_
+        forward 연산을 수행.
+        exit point마다 forward_segment를 하나씩 수행하고, threshold가 있으면 그 exit point의 classifier로 exit 여부를 판단한다.
 
+        Args:
+            x : input image
+            pad_mask : Defaults to None.
 
-    def forward_calc_flops(self, x, pad_mask=None):
+        Returns:
+            각 classifier의 prediction. y_early3, y_att, y_cnn, y_merge 
+        """
+        b = x.shape[0]
+        if threshold is not None and self.batched_exit:
+            exit_state = self._init_exit_state(b, x.device)
+
+        state = self.init_state(x)
+        for stage in range(1, 5):
+            state = self.forward_segment(stage, state, pad_mask)
+            if threshold is None:
+                continue
+            y = state['preds'][stage - 1]
+            if self.batched_exit:
+                keep = self._batched_exit(stage, y, threshold, self.get_stage_outs(state, stage), exit_state)
+                if keep.numel() == 0:
+                    return self._gather_exit_state(exit_state)
+                state = self.select_state(state, keep)
+            elif stage == 4 or self._exit_decision(y, threshold, stage - 1).any():
+                # batch 전체가 같은 stage에서 exit
+                self.last_exited_stage = stage
+                self.last_exited_stages = [stage] * b
+                return (*self.get_state_preds(state), self.get_exit_outs(state, stage))
+
+        return (*self.get_state_preds(state), self.get_exit_outs(state, 4))
+
+
+    def forward_calc_flops(self, x, pad_mask=None, save=True):
         """_summary_
         Model을 처음 Instansiate할 때, 각 단계의 FLOPs를 구하기 위해 실행하는 함수.
         계산된 FLOPs는 {self.output_dir}/flops.txt 에 저장된다.
@@ -872,9 +1065,11 @@ class DynPerceiver(nn.Module):
         #     stage4_flops: {stage4_flops/1e8}\n\
         #     lastCA_flops: {lastCA_flops/1e8}')
         
+        self.last_calc_flops = [flops_early3, flops_early4, flops_early5, flops]
         all_flops = [flops_early3/1e9, flops_early4/1e9, flops_early5/1e9, flops/1e9]
         # print(all_flops)
-        np.savetxt(f'{self.output_dir}/flops.txt', all_flops)
+        if save:
+            np.savetxt(f'{self.output_dir}/flops.txt', all_flops)
         return y_early3, y_att, y_cnn, y_merge
 
 
@@ -3,6 +3,11 @@ from torch import Tensor
 import torch
 import torch.nn as nn
 import math
+import time
+import hashlib
+import os
+from os import path
+import numpy as np
 from cs470_logger.cs470_print import cs470_print
 
 def generate_distribution(threshold_distribution, each_exit = False) -> Tensor:
@@ -28,21 +33,27 @@ def generate_distribution(threshold_distribution, each_exit = False) -> Tensor:
             probs_list.append(probs)
     return probs_list # size : 34 * 4
 
-def get_threshold(model, val_loader, threshold_distribution, fp16: bool):
+def get_threshold(model, val_loader, threshold_distribution, fp16: bool, cache_dir=None):
     with autocast(enabled=fp16):
         #val_loader.batch_size = 128
         tester = Tester(model)
         
-        val_pred, val_target = tester.calc_logit(val_loader, early_break = True)
+        if cache_dir is not None:
+            val_pred, val_target = tester.calc_logit_cached(val_loader, cache_dir, fp16, early_break = True)
+        else:
+            val_pred, val_target = tester.calc_logit(val_loader, early_break = True)
         
         probs_list = generate_distribution(threshold_distribution)
         
+        start = time.perf_counter()
+        acc_vals, Ts = tester.dynamic_eval_find_thresholds(val_pred, val_target, torch.stack(probs_list))
+        cs470_print('Threshold search for {} distributions took {:.3f}s'.format(len(probs_list), time.perf_counter() - start))
+
         return_list = []
-        for probs in probs_list:
+        for probs, acc_val, T in zip(probs_list, acc_vals.tolist(), Ts):
             print("\n")
             cs470_print('*****************')
             cs470_print(f"Probs: {str(probs.tolist())}")
-            acc_val, T = tester.dynamic_eval_find_threshold(val_pred, val_target, probs)
             return_list.append(T)
             cs470_print(f"Threshold: {str(T.tolist())}")
             cs470_print('valid acc: {:.3f}'.format(acc_val))
@@ -52,6 +63,34 @@ def get_threshold(model, val_loader, threshold_distribution, fp16: bool):
     #print("Threshold list(get_threshold.py) :", return_list)
     return return_list
 
+def get_head_threshold(model, val_loader, exit_ratio, thresholds, fp16: bool, max_images = 5000):
+    """
+    DynRetinaHead의 coarse exit threshold를 get_threshold와 같은 방식으로 calibration.
+    test 때와 같은 backbone threshold에서 구해야 하므로 thresholds의 backbone threshold마다 하나씩 구한다.
+    backbone은 한 번만 끝까지 수행하고 (exit stage 1~4 각각의 coarse score를 모두 구함),
+    backbone threshold마다 image의 exit stage에서의 coarse score 중 floor(n_sample * exit_ratio)번째로 큰 값을 threshold로 정한다.
+    coarse level이 모두 inactive인 stage (zero map)에서 exit한 image는 coarse exit할 수 없으므로 제외.
+    """
+    with autocast(enabled=fp16):
+        tester = Tester(model)
+        scores, labels, targets, classifier_preds = tester.calc_coarse_scores(val_loader, early_break = True, max_images = max_images)
+
+    thresholds = torch.stack([torch.as_tensor(threshold, dtype=torch.float) for threshold in thresholds])
+    # (n_threshold, n_sample) 각 backbone threshold에서의 exit stage
+    stages = model.get_exit_stages(classifier_preds, thresholds).long() - 1
+    head_thresholds = tester.find_head_thresholds(scores.gather(0, stages), exit_ratio)
+    exit_labels = labels.gather(0, stages)
+
+    n_sample = scores.size(1)
+    for threshold, T, exit_score, exit_label in zip(thresholds, head_thresholds, scores.gather(0, stages), exit_labels):
+        exit_mask = exit_score >= T
+        n_exit = int(exit_mask.sum())
+        cs470_print('Head threshold for {}: {:.4f} (exit ratio {:.3f})'.format(threshold.tolist(), T, n_exit / max(n_sample, 1)))
+        if n_exit > 0:
+            acc = (exit_label[exit_mask] == targets[exit_mask]).float().mean().item() * 100.0
+            cs470_print('coarse exit label acc: {:.3f}'.format(acc))
+    return head_thresholds
+
 class Tester(object):
     def __init__(self, model):
         # self.args = args
@@ -103,43 +142,131 @@ class Tester(object):
 
         return ts_logits, ts_targets
 
+    def calc_coarse_scores(self, dataloader, early_break=False, max_images = 5000):
+        """
+        image마다 exit stage 1~4 각각에서의 head coarse level의 top box score, label (4 x n_sample)과
+        target label, classifier prediction을 구한다.
+        """
+        self.model.eval()
+        self.model.cuda()
+        n_stage = 4
+        scores, labels, targets = [], [], []
+        classifier_preds = [[] for _ in range(n_stage)]
+        for idx, sample in enumerate(dataloader):
+            if early_break and idx > max_images:
+                break
+            targets.append(torch.tensor([t.gt_instances.labels.tolist()[0] for t in sample['data_samples']]))
+            data = self.model.data_preprocessor(sample)
+            with torch.no_grad():
+                score, label, *preds = self.model.get_coarse_scores_all_exits(data['inputs'].cuda())
+            scores.append(score.float().cpu())
+            labels.append(label.cpu())
+            for b in range(n_stage):
+                classifier_preds[b].append(preds[b].float().cpu())
+            if idx % 50 == 0:
+                cs470_print('Generate Coarse Score: [{0}/{1}]'.format(idx, min(max_images, len(dataloader))))
+        classifier_preds = [torch.cat(preds, dim=0) for preds in classifier_preds]
+        return torch.cat(scores, dim=1), torch.cat(labels, dim=1), torch.cat(targets), classifier_preds
+
+    def find_head_thresholds(self, scores, exit_ratio):
+        """
+        scores (n_threshold x n_sample): 각 backbone threshold에서 image가 exit한 stage의 coarse score.
+        score가 floor(n_sample * exit_ratio)번째로 큰 값을 threshold로 정한다.
+        coarse exit할 수 없는 image (score < 0)는 세지 않으므로, 그런 image가 많으면 exit 비율이 exit_ratio보다 작아진다.
+        """
+        n_sample = scores.size(1)
+        out_n = int(math.floor(n_sample * exit_ratio))
+        sorted_scores, _ = scores.sort(dim=1, descending=True)
+        head_thresholds = []
+        for row in sorted_scores:
+            n_valid = int((row >= 0).sum())
+            n = min(out_n, n_valid)
+            head_thresholds.append(row[n - 1].item() if n > 0 else 1e8)
+        return head_thresholds
+
+    def logit_cache_key(self, dataloader, fp16, early_break, max_images):
+        """
+        calc_logit 결과의 cache key.
+        backbone weight의 hash, dataset의 ann_file, pipeline 설정과 calc_logit의 인자로 만든다.
+        """
+        hasher = hashlib.sha1()
+        for name, param in self.model.backbone.state_dict().items():
+            hasher.update(name.encode())
+            hasher.update(param.detach().cpu().float().numpy().tobytes())
+        dataset = dataloader.dataset
+        hasher.update(str(getattr(dataset, 'ann_file', '')).encode())
+        hasher.update(repr(getattr(dataset, 'pipeline', '')).encode())
+        hasher.update(f'{dataloader.batch_size}-{fp16}-{early_break}-{max_images}'.encode())
+        return hasher.hexdigest()
+
+    def calc_logit_cached(self, dataloader, cache_dir, fp16, early_break=False, max_images = 5000):
+        """
+        calc_logit의 결과 (stage별 softmax, target)를 cache_dir에 .npy로 저장해두고,
+        같은 weight, dataset, pipeline이면 forward 없이 memory-map으로 불러온다.
+        """
+        key = self.logit_cache_key(dataloader, fp16, early_break, max_images)
+        logits_file = path.join(cache_dir, f'{key}_logits.npy')
+        targets_file = path.join(cache_dir, f'{key}_targets.npy')
+        if path.exists(logits_file) and path.exists(targets_file):
+            cs470_print(f'Load cached logits: {logits_file}')
+            # copy-on-write memory map: 필요한 page만 읽고, 원본 파일은 수정하지 않음
+            ts_logits = torch.from_numpy(np.load(logits_file, mmap_mode='c'))
+            ts_targets = torch.from_numpy(np.load(targets_file, mmap_mode='c'))
+            return ts_logits, ts_targets
+
+        ts_logits, ts_targets = self.calc_logit(dataloader, early_break, max_images)
+        os.makedirs(cache_dir, exist_ok=True)
+        for file, tensor in ((logits_file, ts_logits), (targets_file, ts_targets)):
+            # 다른 process가 쓰다 만 파일을 읽지 않도록 임시 파일에 쓰고 rename
+            tmp_file = f'{file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'wb') as f:
+                np.save(f, tensor.numpy())
+            os.replace(tmp_file, file)
+        cs470_print(f'Saved logits cache: {logits_file}')
+        return ts_logits, ts_targets
+
     def dynamic_eval_find_threshold(self, logits, targets, p):
+        acc, T = self.dynamic_eval_find_thresholds(logits, targets, p.unsqueeze(0))
+        return acc[0].item(), T[0]
+
+    def dynamic_eval_find_thresholds(self, logits, targets, probs):
+        """
+        여러 exit 비율 분포 (probs: n_probs x n_stage)에 대한 threshold와 accuracy를 한 번에 계산.
+
+        stage k마다, 이전 stage에서 exit하지 않은 sample들 중 confidence가
+        floor(n_sample * p[k])번째로 큰 값을 threshold로 정한다.
+        sort, cumsum, masking으로 모든 분포를 동시에 처리한다.
+
+        Returns:
+            각 분포의 accuracy (n_probs), threshold (n_probs x n_stage)
+        """
         n_stage, n_sample, c = logits.size()
+        n_probs = probs.size(0)
         max_preds, argmax_preds = logits.max(dim=2, keepdim=False)
 
-        _, sorted_idx = max_preds.sort(dim=1, descending=True)
+        sorted_preds, sorted_idx = max_preds.sort(dim=1, descending=True)
 
-        filtered = torch.zeros(n_sample)
+        filtered = torch.zeros(n_probs, n_sample, dtype=torch.bool)
 
-        T = torch.Tensor(n_stage).fill_(1e8)
+        T = torch.Tensor(n_probs, n_stage).fill_(1e8)
 
         for k in range(n_stage - 1):
-            acc, count = 0.0, 0
-            out_n = math.floor(n_sample * p[k])
-            for i in range(n_sample):
-                ori_idx = sorted_idx[k][i]
-                if filtered[ori_idx] == 0:
-                    count += 1
-                    if count == out_n:
-                        T[k] = max_preds[k][ori_idx]
-                        break
-            filtered.add_(max_preds[k].ge(T[k]).type_as(filtered))
-
-        T[n_stage -1] = -1e8 # accept all of the samples at the last stage
-
-        acc_rec, exp = torch.zeros(n_stage), torch.zeros(n_stage) # 각 stage에서 correctly classified된 sample수와 총 검사한 sample 수
-        acc = 0 # 전체 system의 accuracy와 FLOPs
-        for i in range(n_sample):
-            gold_label = targets[i]
-            for k in range(n_stage):
-                if max_preds[k][i].item() >= T[k]: # force the sample to exit at k
-                    if int(gold_label.item()) == int(argmax_preds[k][i].item()):
-                        acc += 1
-                        acc_rec[k] += 1
-                    exp[k] += 1
-                    break
-        acc_all = 0
-        for k in range(n_stage):
-            acc_all += acc_rec[k]
-
-        return acc * 100.0 / n_sample, T
\ No newline at end of file
+            out_n = torch.floor(n_sample * probs[:, k]).long()
+            # 각 분포에서 sorted 순서로 본 아직 exit하지 않은 sample 수의 누적합
+            unfiltered = ~filtered[:, sorted_idx[k]]
+            count = unfiltered.long().cumsum(dim=1)
+            pos = torch.searchsorted(count, out_n.unsqueeze(1)).squeeze(1)
+            found = (out_n > 0) & (pos < n_sample)
+            T[:, k] = torch.where(found, sorted_preds[k][pos.clamp(max=n_sample - 1)], T[:, k])
+            filtered |= max_preds[k].unsqueeze(0) >= T[:, k:k + 1]
+
+        T[:, n_stage - 1] = -1e8 # accept all of the samples at the last stage
+
+        # 각 sample이 처음으로 threshold를 넘는 stage에서 exit
+        exit_mask = max_preds.unsqueeze(0) >= T.unsqueeze(2) # n_probs x n_stage x n_sample
+        exit_stage = (exit_mask.long().cumsum(dim=1) == 0).sum(dim=1) # n_probs x n_sample
+        # 분포마다 따로 gather (n_probs x n_stage x n_sample 에서 stage 축으로)
+        preds = argmax_preds.unsqueeze(0).expand(n_probs, -1, -1).gather(1, exit_stage.unsqueeze(1)).squeeze(1)
+        acc = (preds == targets.long().unsqueeze(0)).sum(dim=1).float()
+
+        return acc * 100.0 / n_sample, T
@@ -2,6 +2,7 @@ from typing import Optional
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from einops import rearrange, repeat
 # from fairscale.nn import checkpoint_wrapper
 from torch import Tensor
@@ -77,6 +78,10 @@ class MultiHeadAttention(nn.Module):
         self.o_proj = nn.Linear(num_v_channels, num_output_channels)
         self.dropout = nn.Dropout(dropout)
 
+        # attention 계산 방식. set_attention_backend 참고
+        self.attn_backend = 'math'
+        self.query_chunk_size = None
+
     def forward(self, x_q, x_kv, pad_mask=None, attn_mask=None):
         """
         :param x_q: Query input of shape (B, N, D) where B is the batch size, N the query sequence length
@@ -104,15 +109,37 @@ class MultiHeadAttention(nn.Module):
         # print(k.shape)
         if self.rpb:
             k += self.relative_position_bias
-        
-        q, k, v = (rearrange(x, "b n (h c) -> (b h) n c", h=self.num_heads) for x in [q, k, v])
+
+        if self.attn_backend == 'sdpa' and hasattr(F, 'scaled_dot_product_attention'):
+            o = self._sdpa_attention(q, k, v, pad_mask)
+        else:
+            q, k, v = (rearrange(x, "b n (h c) -> (b h) n c", h=self.num_heads) for x in [q, k, v])
+            if pad_mask is not None:
+                pad_mask = repeat(pad_mask, "b j -> (b h) () j", h=self.num_heads)
+            chunk_size = self.query_chunk_size
+            if self.attn_backend != 'math' and chunk_size is not None and q.shape[1] > chunk_size:
+                # query를 chunk_size개씩 나눠서 계산: attention matrix는 (b*h, chunk_size, l)까지만 만들어진다
+                o = torch.cat([self._attention(q[:, i:i + chunk_size], k, v, pad_mask)
+                               for i in range(0, q.shape[1], chunk_size)], dim=1)
+            else:
+                o = self._attention(q, k, v, pad_mask)
+            o = rearrange(o, "(b h) n c -> b n (h c)", h=self.num_heads)
+        in_channels = o.shape[-1]
+        o = self.o_proj(o)
+        # print(o.shape)
+        # flops += in_channels * o.shape[-1] * o.shape[-2]
+        return o
+
+    def _attention(self, q, k, v, pad_mask=None):
+        """
+        q: (B*H, N, C), k, v: (B*H, L, C)에 대한 attention. (B*H, N, L) attention matrix를 만든다.
+        """
         attn = torch.einsum("b i c, b j c -> b i j", q, k) * self.dp_scale
         # attn = q @ k.transpose(-2, -1) * self.dp_scale
         # print(attn.shape)
         # flops += q.shape[-1] * q.shape[-2] * k.shape[-2] * self.num_heads
 
         if pad_mask is not None:
-            pad_mask = repeat(pad_mask, "b j -> (b h) () j", h=self.num_heads)
             attn_max_neg = -torch.finfo(attn.dtype).max
             attn.masked_fill_(pad_mask, attn_max_neg)
 
@@ -123,13 +150,23 @@ class MultiHeadAttention(nn.Module):
         # o = attn @ v
         # print(attn.shape, v.shape, o.shape)
         # flops += attn.shape[-2] * v.shape[-2] * v.shape[-1] * self.num_heads
-        o = rearrange(o, "(b h) n c -> b n (h c)", h=self.num_heads)
-        in_channels = o.shape[-1]
-        o = self.o_proj(o)
-        # print(o.shape)
-        # flops += in_channels * o.shape[-1] * o.shape[-2]
         return o
 
+    def _sdpa_attention(self, q, k, v, pad_mask=None):
+        """
+        torch.nn.functional.scaled_dot_product_attention을 사용하는 attention.
+        가능하면 fused kernel (flash / memory efficient)을 사용해서 attention matrix를 만들지 않는다.
+        q: (B, N, H*C), k, v: (B, L, H*C)
+        """
+        q, k, v = (x.unflatten(-1, (self.num_heads, -1)).transpose(1, 2) for x in [q, k, v])
+        sdpa_mask = None
+        if pad_mask is not None:
+            # sdpa의 boolean mask는 True가 attention에 참여하는 위치
+            sdpa_mask = ~pad_mask[:, None, None, :]
+        dropout_p = self.dropout.p if self.training else 0.0
+        o = F.scaled_dot_product_attention(q, k, v, attn_mask=sdpa_mask, dropout_p=dropout_p)
+        return o.transpose(1, 2).flatten(2)
+
     def forward_calc_flops(self, x_q, x_kv, pad_mask=None, attn_mask=None):
         """
         :param x_q: Query input of shape (B, N, D) where B is the batch size, N the query sequence length
@@ -183,6 +220,25 @@ class MultiHeadAttention(nn.Module):
         flops += in_channels * o.shape[-1] * o.shape[-2]
         return o, flops
 
+def set_attention_backend(module: nn.Module, backend: str = 'math', query_chunk_size: Optional[int] = None):
+    """
+    module 안의 모든 MultiHeadAttention의 attention 계산 방식을 정한다.
+
+    :param backend: 'math' (기존 einsum 구현), 'sdpa' (scaled_dot_product_attention, torch < 2.0이면 'chunked'로 동작)
+        또는 'chunked' (query를 query_chunk_size개씩 나눠서 peak memory를 제한).
+    :param query_chunk_size: 'chunked'에서 한 번에 계산할 query 수. None이면 나누지 않는다.
+        다른 backend는 query를 나누지 않으므로 None이어야 한다.
+    """
+    if backend not in ('math', 'sdpa', 'chunked'):
+        raise ValueError(f"unknown attention backend {backend}")
+    if query_chunk_size is not None and backend != 'chunked':
+        raise ValueError(f"query_chunk_size is only supported by the 'chunked' backend, not '{backend}'")
+    for m in module.modules():
+        if isinstance(m, MultiHeadAttention):
+            m.attn_backend = backend
+            m.query_chunk_size = query_chunk_size
+
+
 class CrossAttention(nn.Module):
     def __init__(
         self,
@@ -1,5 +1,6 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 from .coco_api import COCO, COCOeval, COCOPanoptic
+from .cocoeval_fast import COCOevalFast
 from .cocoeval_mp import COCOevalMP
 
-__all__ = ['COCO', 'COCOeval', 'COCOPanoptic', 'COCOevalMP']
+__all__ = ['COCO', 'COCOeval', 'COCOPanoptic', 'COCOevalMP', 'COCOevalFast']
@@ -0,0 +1,502 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import copy
+import datetime
+import time
+
+import numpy as np
+
+from .coco_api import COCOeval
+
+
+def _lookup(keys, values):
+    """Position of each value in ``keys`` (first occurrence), -1 if absent."""
+    keys = np.asarray(keys, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    if len(keys) == 0:
+        return np.full(len(values), -1, dtype=np.int64)
+    uniq, first = np.unique(keys, return_index=True)
+    pos = np.minimum(np.searchsorted(uniq, values), len(uniq) - 1)
+    return np.where(uniq[pos] == values, first[pos], -1)
+
+
+def bbox_ious(dt_bboxes, gt_bboxes, gt_crowd):
+    """IoUs of ``xywh`` boxes, computed exactly as ``pycocotools.mask.iou``.
+
+    For a crowd ground truth the union is the detection area.
+
+    Args:
+        dt_bboxes (np.ndarray): Detections of shape (P, D, 4).
+        gt_bboxes (np.ndarray): Ground truths of shape (P, G, 4).
+        gt_crowd (np.ndarray): Crowd flags of shape (P, G).
+
+    Returns:
+        np.ndarray: IoUs of shape (P, D, G).
+    """
+    dt = dt_bboxes[:, :, None]
+    gt = gt_bboxes[:, None]
+    w = np.minimum(dt[..., 0] + dt[..., 2], gt[..., 0] + gt[..., 2]) - \
+        np.maximum(dt[..., 0], gt[..., 0])
+    h = np.minimum(dt[..., 1] + dt[..., 3], gt[..., 1] + gt[..., 3]) - \
+        np.maximum(dt[..., 1], gt[..., 1])
+    inter = w * h
+    dt_area = dt[..., 2] * dt[..., 3]
+    gt_area = gt[..., 2] * gt[..., 3]
+    union = np.where(gt_crowd[:, None], dt_area, dt_area + gt_area - inter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ious = inter / union
+    return np.where((w > 0) & (h > 0), ious, 0)
+
+
+def match_pairs(ious, gt_ignore, gt_crowd, num_dets, iou_thrs):
+    """Greedy COCO matching of a batch of (image, category) pairs.
+
+    Detections are matched one rank at a time for all pairs, IoU thresholds
+    and area ranges at once. Each detection takes the available ground truth
+    with the highest IoU (the last one on ties), and only falls back to an
+    ignored ground truth when no regular one is above the threshold, which
+    is the result of the sorted loop in ``COCOeval.evaluateImg``.
+
+    Args:
+        ious (np.ndarray): IoUs of shape (P, D, G) between the score sorted
+            detections and the ground truths of each pair. Padding is -1.
+        gt_ignore (np.ndarray): Ignore flags of shape (P, A, G) of the
+            ground truths for each area range.
+        gt_crowd (np.ndarray): Crowd flags of shape (P, G).
+        num_dets (np.ndarray): Number of detections of each pair, in
+            descending order.
+        iou_thrs (np.ndarray): IoU thresholds of shape (T, ).
+
+    Returns:
+        tuple[np.ndarray]: Whether each detection is matched, and whether the
+        matched ground truth is ignored, both of shape (P, D, T, A).
+    """
+    P, D, G = ious.shape
+    A = gt_ignore.shape[1]
+    T = len(iou_thrs)
+    thrs = np.minimum(np.asarray(iou_thrs, dtype=np.float64),
+                      1 - 1e-10)[None, :, None, None]
+    gt_ignore = gt_ignore[:, None]
+    gt_crowd = gt_crowd[:, None, None]
+    gt_index = np.arange(G)
+    taken = np.zeros((P, T, A, G), dtype=bool)
+    matched = np.zeros((P, D, T, A), dtype=bool)
+    matched_ignore = np.zeros((P, D, T, A), dtype=bool)
+    for d in range(D):
+        # pairs are sorted by the number of detections, so the pairs that
+        # still have a detection at this rank are a prefix
+        n = int(np.count_nonzero(num_dets > d))
+        if n == 0:
+            break
+        iou = ious[:n, d, None, None, :]
+        # a ground truth is matched only once, unless it is a crowd region
+        cand = (iou >= thrs) & ~(taken[:n] & ~gt_crowd[:n])
+        regular = cand & ~gt_ignore[:n]
+        cand = np.where(regular.any(-1, keepdims=True), regular, cand)
+        hit = cand.any(-1)
+        best = G - 1 - np.where(cand, iou, -np.inf)[..., ::-1].argmax(-1)
+        one_hot = (gt_index == best[..., None]) & hit[..., None]
+        taken[:n] |= one_hot
+        matched[:n, d] = hit
+        matched_ignore[:n, d] = (one_hot & gt_ignore[:n]).any(-1)
+    return matched, matched_ignore
+
+
+class COCOevalFast(COCOeval):
+    """Vectorized COCO bbox evaluation.
+
+    A drop-in replacement of ``COCOeval`` for ``iouType='bbox'``. Ground
+    truths and detections are kept in flat numpy arrays instead of one dict
+    per box: :meth:`evaluate` matches all (image, category) pairs of a
+    similar size at once, and :meth:`accumulate` builds the precision and
+    recall curves of each category with cumulative sums. ``eval`` and
+    ``stats`` are the same as those of ``COCOeval``.
+
+    Detections are read from ``cocoDt`` (e.g. the output of
+    ``COCO.loadRes``), or passed as arrays with :meth:`load_dets`, which
+    skips building the result COCO object. They can also be matched image by
+    image as they come with :meth:`evaluate_images`, and the compact matching
+    results are merged by :meth:`load_matches` in place of :meth:`evaluate`.
+
+    Note:
+        ``evalImgs`` is not filled. The matching results are kept per
+        detection in compact arrays instead.
+
+    Args:
+        cocoGt (COCO, optional): Ground truth COCO api. Defaults to None.
+        cocoDt (COCO, optional): Detection results COCO api.
+            Defaults to None.
+        iouType (str): Only 'bbox' is supported. Defaults to 'bbox'.
+        max_elements (int): Upper bound of the number of IoUs matched in
+            one batch, which bounds the memory. Defaults to 2**22.
+    """
+
+    def __init__(self,
+                 cocoGt=None,
+                 cocoDt=None,
+                 iouType='bbox',
+                 max_elements=2**22):
+        if iouType != 'bbox':
+            raise ValueError(
+                f'COCOevalFast only supports iouType "bbox", got {iouType}')
+        super().__init__(cocoGt, cocoDt, iouType)
+        self.max_elements = max_elements
+        self._gt_arrays = None
+        self._dets = None
+        self._matches = None
+        if cocoDt is not None:
+            anns = cocoDt.dataset.get('annotations', [])
+            self.load_dets([ann['image_id'] for ann in anns],
+                           [ann['bbox'] for ann in anns],
+                           [ann['score'] for ann in anns],
+                           [ann['category_id'] for ann in anns])
+
+    def load_dets(self, img_ids, bboxes, scores, cat_ids):
+        """Set the detections to evaluate.
+
+        Args:
+            img_ids (array-like): Image id of each detection, shape (N, ).
+            bboxes (array-like): Boxes in ``xywh`` order, shape (N, 4).
+            scores (array-like): Scores, shape (N, ).
+            cat_ids (array-like): Category ids, shape (N, ).
+        """
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        self._dets = dict(
+            img_ids=np.asarray(img_ids, dtype=np.int64).reshape(-1),
+            bboxes=bboxes,
+            # area of a loaded result is always the box area
+            areas=bboxes[:, 2] * bboxes[:, 3],
+            scores=np.asarray(scores, dtype=np.float64).reshape(-1),
+            cat_ids=np.asarray(cat_ids, dtype=np.int64).reshape(-1))
+
+    def _load_gts(self, img_ids):
+        """Ground truths of the given images, in annotation order within
+        each image."""
+        if self._gt_arrays is None:
+            anns = self.cocoGt.dataset.get('annotations', [])
+            gts = dict(
+                img_ids=np.array([ann['image_id'] for ann in anns],
+                                 dtype=np.int64),
+                bboxes=np.array([ann['bbox'] for ann in anns],
+                                dtype=np.float64).reshape(-1, 4),
+                areas=np.array([ann['area'] for ann in anns],
+                               dtype=np.float64),
+                crowd=np.array([bool(ann.get('iscrowd', 0)) for ann in anns],
+                               dtype=bool),
+                cat_ids=np.array([ann['category_id'] for ann in anns],
+                                 dtype=np.int64))
+            # grouped by image, so that the ground truths of a few images
+            # are sliced out without scanning all of them
+            order = np.argsort(gts['img_ids'], kind='stable')
+            self._gt_arrays = {key: value[order] for key, value in gts.items()}
+        gts = self._gt_arrays
+        img_ids = np.unique(np.asarray(img_ids, dtype=np.int64))
+        starts = np.searchsorted(gts['img_ids'], img_ids, side='left')
+        counts = np.searchsorted(gts['img_ids'], img_ids,
+                                 side='right') - starts
+        rows = np.repeat(starts - (np.cumsum(counts) - counts),
+                         counts) + np.arange(counts.sum())
+        return {key: value[rows] for key, value in gts.items()}
+
+    def _index(self, boxes):
+        """Pair index and category position of the evaluated boxes.
+
+        Returns:
+            tuple[np.ndarray]: Indices of the kept boxes, their pair index
+            (image position * K + category index) and category position.
+        """
+        p = self.params
+        img_pos = _lookup(p.imgIds, boxes['img_ids'])
+        cat_pos = _lookup(p.catIds, boxes['cat_ids'])
+        keep = np.nonzero((img_pos >= 0) & (cat_pos >= 0))[0]
+        img_pos, cat_pos = img_pos[keep], cat_pos[keep]
+        if p.useCats:
+            pairs = img_pos * len(p.catIds) + cat_pos
+        else:
+            pairs = img_pos
+        return keep, pairs, cat_pos
+
+    def _prepare(self):
+        """Gather the ground truths and the detections of each (image,
+        category) pair in the order used by ``COCOeval``."""
+        p = self.params
+        area_rng = np.asarray(p.areaRng, dtype=np.float64)
+        max_det = p.maxDets[-1]
+
+        gts = self._load_gts(p.imgIds)
+        keep, pairs, cat_pos = self._index(gts)
+        # annotation order, by category first when categories are merged
+        sort = np.lexsort((cat_pos, pairs))
+        gts = {key: value[keep[sort]] for key, value in gts.items()}
+        gts['pairs'] = pairs[sort]
+        gts['k'] = cat_pos[sort] if p.useCats else np.zeros_like(sort)
+        gts['ignore'] = gts['crowd'][:, None] | \
+            (gts['areas'][:, None] < area_rng[:, 0]) | \
+            (gts['areas'][:, None] > area_rng[:, 1])
+
+        dets = self._dets
+        if dets is None:
+            self.load_dets([], [], [], [])
+            dets = self._dets
+        keep, pairs, cat_pos = self._index(dets)
+        # highest score first within each pair, as the stable sort in
+        # COCOeval.computeIoU does
+        sort = np.lexsort((cat_pos, -dets['scores'][keep], pairs))
+        dt_pairs = pairs[sort]
+        dt_cats = cat_pos[sort]
+        dets = {key: value[keep[sort]] for key, value in dets.items()}
+        starts = np.searchsorted(dt_pairs, dt_pairs, side='left')
+        rank = np.arange(len(dt_pairs)) - starts
+        top = rank < max_det
+        dets = {key: value[top] for key, value in dets.items()}
+        dets['pairs'] = dt_pairs[top]
+        dets['k'] = dt_cats[top] if p.useCats else np.zeros_like(
+            dt_cats[top])
+        dets['rank'] = rank[top]
+        dets['out'] = (dets['areas'][:, None] < area_rng[:, 0]) | \
+            (dets['areas'][:, None] > area_rng[:, 1])
+
+        self._gts = gts
+        self._dts = dets
+        self.evalImgs = []
+        self.eval = {}
+
+    def evaluate(self):
+        """Match the detections of every (image, category) pair to the
+        ground truths.
+
+        The results are stored per detection, and used by
+        :meth:`accumulate`.
+        """
+        tic = time.time()
+        print('Running per image evaluation...')
+        print('Evaluate annotation type *{}*'.format(self.params.iouType))
+        self._normalize_params()
+        self._prepare()
+        self._matches = self._match(self._gts, self._dts)
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc - tic))
+
+    def _normalize_params(self):
+        p = self.params
+        p.imgIds = list(np.unique(p.imgIds))
+        if p.useCats:
+            p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+
+    def _match(self, gts, dets):
+        """Match the prepared detections to the ground truths.
+
+        Returns:
+            dict: Whether each detection is matched and whether it is
+            ignored, both of shape (N, T, A).
+        """
+        p = self.params
+        T = len(p.iouThrs)
+        A = len(p.areaRng)
+        matched = np.zeros((len(dets['scores']), T, A), dtype=bool)
+        matched_ignore = np.zeros_like(matched)
+
+        # pairs are sorted, so each pair is a contiguous segment
+        gt_keys, gt_starts, gt_counts = np.unique(
+            gts['pairs'], return_index=True, return_counts=True)
+        dt_keys, dt_starts, dt_counts = np.unique(
+            dets['pairs'], return_index=True, return_counts=True)
+        _, gi, di = np.intersect1d(
+            gt_keys, dt_keys, assume_unique=True, return_indices=True)
+        gt_starts, gt_counts = gt_starts[gi], gt_counts[gi]
+        dt_starts, dt_counts = dt_starts[di], dt_counts[di]
+
+        # bucket the pairs by their padded size, so that few IoUs are padding
+        buckets = np.ceil(np.log2(gt_counts)).astype(np.int64) * 64 + \
+            np.ceil(np.log2(dt_counts)).astype(np.int64)
+        for bucket in np.unique(buckets):
+            sel = np.nonzero(buckets == bucket)[0]
+            sel = sel[np.argsort(-dt_counts[sel], kind='stable')]
+            G = int(gt_counts[sel].max())
+            D = int(dt_counts[sel].max())
+            chunk = max(1, self.max_elements // (D * G + T * A * (D + G)))
+            for begin in range(0, len(sel), chunk):
+                s = sel[begin:begin + chunk]
+                g_valid = np.arange(G) < gt_counts[s, None]
+                d_valid = np.arange(D) < dt_counts[s, None]
+                g_idx = gt_starts[s, None] + np.where(g_valid, np.arange(G), 0)
+                d_idx = dt_starts[s, None] + np.where(d_valid, np.arange(D), 0)
+                ious = bbox_ious(dets['bboxes'][d_idx], gts['bboxes'][g_idx],
+                                 gts['crowd'][g_idx])
+                ious[~(d_valid[:, :, None] & g_valid[:, None, :])] = -1
+                m, mi = match_pairs(ious,
+                                    gts['ignore'][g_idx].transpose(0, 2, 1),
+                                    gts['crowd'][g_idx], dt_counts[s],
+                                    p.iouThrs)
+                matched[d_idx[d_valid]] = m[d_valid]
+                matched_ignore[d_idx[d_valid]] = mi[d_valid]
+
+        # unmatched detections outside of the area range are ignored
+        ignore = matched_ignore | (~matched & dets['out'][:, None, :])
+        return dict(matched=matched, ignore=ignore)
+
+    def evaluate_images(self, images, img_ids, bboxes, scores, cat_ids):
+        """Match the detections of some images, for streaming evaluation.
+
+        Each image is matched on its own, so the images can be evaluated in
+        batches as they come, e.g. while a model is being tested. Only the
+        compact matching results are returned, which are merged by
+        :meth:`load_matches`. All the detections of an image must be given
+        in the same call, and the parameters must not change in between.
+
+        Args:
+            images (array-like): Ids of the evaluated images, including
+                those without detections.
+            img_ids (array-like): Image id of each detection, shape (N, ).
+            bboxes (array-like): Boxes in ``xywh`` order, shape (N, 4).
+            scores (array-like): Scores, shape (N, ).
+            cat_ids (array-like): Category ids, shape (N, ).
+
+        Returns:
+            dict: The image id, category index, score, rank in its (image,
+            category) pair and matching flags of shape (T, A) of the kept
+            detections, and the image id, category index and ignore flags of
+            shape (A, ) of the ground truths.
+        """
+        p = self.params
+        eval_img_ids = p.imgIds
+        p.imgIds = list(images)
+        try:
+            self._normalize_params()
+            self.load_dets(img_ids, bboxes, scores, cat_ids)
+            self._prepare()
+            matches = self._match(self._gts, self._dts)
+        finally:
+            p.imgIds = eval_img_ids
+        gts, dets = self._gts, self._dts
+        return dict(
+            img_ids=dets['img_ids'],
+            k=dets['k'],
+            scores=dets['scores'],
+            rank=dets['rank'],
+            matched=matches['matched'],
+            ignore=matches['ignore'],
+            gt_img_ids=gts['img_ids'],
+            gt_k=gts['k'],
+            gt_ignore=gts['ignore'])
+
+    def load_matches(self, matches):
+        """Merge the results of :meth:`evaluate_images` in place of
+        :meth:`evaluate`.
+
+        The images in ``params.imgIds`` without matching results are
+        evaluated without detections, and the results of other images are
+        dropped, so that the result is the same as that of :meth:`evaluate`.
+
+        Args:
+            matches (list[dict]): Results of :meth:`evaluate_images` of
+                disjoint sets of images.
+        """
+        self._normalize_params()
+        p = self.params
+        # images with neither detections nor ground truths are not in the
+        # results, and evaluating them again adds nothing
+        seen = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                              [match['gt_img_ids'] for match in matches] +
+                              [match['img_ids'] for match in matches])
+        missing = np.setdiff1d(np.asarray(p.imgIds, dtype=np.int64), seen)
+        matches = list(matches) + [
+            self.evaluate_images(missing, [], [], [], [])
+        ]
+        merged = {
+            key: np.concatenate([match[key] for match in matches])
+            for key in matches[-1]
+        }
+        img_pos = _lookup(p.imgIds, merged['img_ids'])
+        gt_keep = _lookup(p.imgIds, merged['gt_img_ids']) >= 0
+        # the order of evaluate, by image, category and rank
+        keep = np.nonzero(img_pos >= 0)[0]
+        keep = keep[np.lexsort((merged['rank'][keep], merged['k'][keep],
+                                img_pos[keep]))]
+        self._gts = dict(
+            k=merged['gt_k'][gt_keep], ignore=merged['gt_ignore'][gt_keep])
+        self._dts = {
+            key: merged[key][keep]
+            for key in ('img_ids', 'k', 'scores', 'rank')
+        }
+        self._matches = dict(
+            matched=merged['matched'][keep], ignore=merged['ignore'][keep])
+        self._paramsEval = copy.deepcopy(p)
+        self.evalImgs = []
+        self.eval = {}
+
+    def accumulate(self, p=None):
+        """Accumulate the matches into precision / recall curves.
+
+        Args:
+            p (Params, optional): Evaluation parameters. Must be the
+                parameters used by :meth:`evaluate`. Defaults to None.
+        """
+        print('Accumulating evaluation results...')
+        tic = time.time()
+        if self._matches is None:
+            print('Please run evaluate() first')
+            return
+        if p is None:
+            p = self.params
+        p.catIds = p.catIds if p.useCats == 1 else [-1]
+        T = len(p.iouThrs)
+        R = len(p.recThrs)
+        K = len(p.catIds) if p.useCats else 1
+        A = len(p.areaRng)
+        M = len(p.maxDets)
+        precision = -np.ones((T, R, K, A, M))
+        recall = -np.ones((T, K, A, M))
+        scores = -np.ones((T, R, K, A, M))
+
+        gts, dets = self._gts, self._dts
+        npig = np.stack([
+            np.bincount(gts['k'][~gts['ignore'][:, a]], minlength=K)
+            for a in range(A)
+        ], axis=1)
+        # detections of each category, highest score first. The stable sort
+        # keeps the image order on ties, as the concatenation in COCOeval
+        order = np.lexsort((-dets['scores'], dets['k']))
+        bounds = np.searchsorted(dets['k'][order], np.arange(K + 1))
+        for k in range(K):
+            cat_dets = order[bounds[k]:bounds[k + 1]]
+            for a in range(A):
+                if npig[k, a] == 0:
+                    continue
+                for m, max_det in enumerate(p.maxDets):
+                    keep = cat_dets[dets['rank'][cat_dets] < max_det]
+                    nd = len(keep)
+                    dt_matched = self._matches['matched'][keep, :, a].T
+                    dt_ignore = self._matches['ignore'][keep, :, a].T
+                    tps = np.logical_and(dt_matched, np.logical_not(dt_ignore))
+                    fps = np.logical_and(
+                        np.logical_not(dt_matched), np.logical_not(dt_ignore))
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
+                    rc = tp_sum / npig[k, a]
+                    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+                    recall[:, k, a, m] = rc[:, -1] if nd else 0
+                    # precision envelope, the best precision at any recall
+                    # greater than or equal to each point
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    dt_scores = dets['scores'][keep]
+                    for t in range(T):
+                        inds = np.searchsorted(rc[t], p.recThrs, side='left')
+                        valid = inds < nd
+                        q = np.zeros(R)
+                        ss = np.zeros(R)
+                        q[valid] = pr[t, inds[valid]]
+                        ss[valid] = dt_scores[inds[valid]]
+                        precision[t, :, k, a, m] = q
+                        scores[t, :, k, a, m] = ss
+        self.eval = {
+            'params': p,
+            'counts': [T, R, K, A, M],
+            'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'precision': precision,
+            'recall': recall,
+            'scores': scores,
+        }
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc - tic))
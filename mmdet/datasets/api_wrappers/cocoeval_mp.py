@@ -1,8 +1,8 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import copy
-import itertools
 import time
 from collections import defaultdict
+from multiprocessing.shared_memory import SharedMemory
 
 import numpy as np
 import torch.multiprocessing as mp
@@ -10,62 +10,327 @@ from mmengine.logging import MMLogger
 from pycocotools.cocoeval import COCOeval
 from tqdm import tqdm
 
+# arrays of the process, set by ``_init_worker``
+_worker = {}
+
+
+def _share_arrays(arrays):
+    """Copy numpy arrays into one shared memory block.
+
+    Returns:
+        tuple: The ``SharedMemory`` and the (name, dtype, shape, offset)
+        of each array in it.
+    """
+    spec = []
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        spec.append((name, array.dtype.str, array.shape, offset))
+        # keep every array 8 bytes aligned
+        offset += (array.nbytes + 7) // 8 * 8
+    shm = SharedMemory(create=True, size=max(offset, 1))
+    for name, dtype, shape, offset in spec:
+        np.ndarray(
+            shape, dtype=dtype, buffer=shm.buf,
+            offset=offset)[...] = arrays[name]
+    return shm, spec
+
+
+def _attach_arrays(shm, spec):
+    return {
+        name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        for name, dtype, shape, offset in spec
+    }
+
+
+def _init_worker(shm_name, spec, params):
+    shm = SharedMemory(name=shm_name)
+    _worker.update(shm=shm, arrays=_attach_arrays(shm, spec), params=params)
+
+
+def _pack_anns(anns, coco, params, img_pos, is_gt):
+    """Flatten annotations into arrays, sorted by the category index.
+
+    The annotation order is kept within a category, which is the order used
+    by ``COCOeval``.
+    """
+    p = params
+    if p.useCats:
+        cat_pos = {cat_id: k for k, cat_id in enumerate(p.catIds)}
+        ks = np.array([cat_pos[ann['category_id']] for ann in anns],
+                      dtype=np.int64)
+    else:
+        ks = np.zeros(len(anns), dtype=np.int64)
+    order = np.argsort(ks, kind='stable')
+    anns = [anns[i] for i in order]
+    arrays = dict(
+        k=ks[order],
+        img_pos=np.array([img_pos[ann['image_id']] for ann in anns],
+                         dtype=np.int64),
+        id=np.array([ann['id'] for ann in anns], dtype=np.int64),
+        image_id=np.array([ann['image_id'] for ann in anns], dtype=np.int64),
+        category_id=np.array([ann['category_id'] for ann in anns],
+                             dtype=np.int64),
+        bbox=np.array([ann['bbox'] for ann in anns],
+                      dtype=np.float64).reshape(-1, 4),
+        area=np.array([ann['area'] for ann in anns], dtype=np.float64),
+        iscrowd=np.array([int(ann.get('iscrowd', 0)) for ann in anns],
+                         dtype=np.int64))
+    if is_gt:
+        ignore = arrays['iscrowd'] > 0
+        if p.iouType == 'keypoints':
+            ignore |= np.array([ann['num_keypoints'] == 0 for ann in anns],
+                               dtype=bool)
+        arrays['ignore'] = ignore
+    else:
+        arrays['score'] = np.array([ann['score'] for ann in anns],
+                                   dtype=np.float64)
+    if p.iouType == 'segm':
+        # convert to RLE once, and store the compressed counts as bytes
+        rles = [coco.annToRLE(ann) for ann in anns]
+        counts = [
+            rle['counts'] if isinstance(rle['counts'], bytes) else
+            rle['counts'].encode() for rle in rles
+        ]
+        arrays['rle_size'] = np.array([rle['size'] for rle in rles],
+                                      dtype=np.int64).reshape(-1, 2)
+        arrays['rle_offset'] = np.cumsum([0] + [len(c) for c in counts],
+                                         dtype=np.int64)
+        arrays['rle_counts'] = np.frombuffer(b''.join(counts), dtype=np.uint8)
+    if p.iouType == 'keypoints':
+        length = max([len(ann['keypoints']) for ann in anns], default=0)
+        keypoints = np.zeros((len(anns), length), dtype=np.float64)
+        for i, ann in enumerate(anns):
+            keypoints[i, :len(ann['keypoints'])] = ann['keypoints']
+        arrays['keypoints'] = keypoints
+        if is_gt:
+            arrays['num_keypoints'] = np.array(
+                [ann['num_keypoints'] for ann in anns], dtype=np.int64)
+    arrays['bounds'] = np.searchsorted(arrays['k'],
+                                       np.arange(len(p.catIds) + 1))
+    return arrays
+
+
+def _unpack_anns(arrays, prefix, k, lo, hi, is_gt):
+    """Rebuild the annotation dicts of category ``k`` and the images in
+    ``[lo, hi)``, keyed by (image id, category id)."""
+
+    def get(key):
+        return arrays[prefix + key]
+
+    begin, end = get('bounds')[k], get('bounds')[k + 1]
+    img_pos = get('img_pos')[begin:end]
+    rows = begin + np.nonzero((img_pos >= lo) & (img_pos < hi))[0]
+    anns = defaultdict(list)
+    for i in rows.tolist():
+        ann = dict(
+            id=int(get('id')[i]),
+            image_id=int(get('image_id')[i]),
+            category_id=int(get('category_id')[i]),
+            bbox=get('bbox')[i].tolist(),
+            area=float(get('area')[i]),
+            iscrowd=int(get('iscrowd')[i]))
+        if is_gt:
+            ann['ignore'] = bool(get('ignore')[i])
+        else:
+            ann['score'] = float(get('score')[i])
+        if prefix + 'rle_size' in arrays:
+            offset = get('rle_offset')
+            ann['segmentation'] = dict(
+                size=get('rle_size')[i].tolist(),
+                counts=get('rle_counts')[offset[i]:offset[i + 1]].tobytes())
+        if prefix + 'keypoints' in arrays:
+            ann['keypoints'] = get('keypoints')[i].tolist()
+            if is_gt:
+                ann['num_keypoints'] = int(get('num_keypoints')[i])
+        anns[ann['image_id'], ann['category_id']].append(ann)
+    return anns
+
+
+def _pack_evals(evals, num_iou_thrs):
+    """Pack the per-image results of ``evaluateImg`` into a few arrays."""
+    T = num_iou_thrs
+    present = np.array([e is not None for e in evals], dtype=bool)
+    evals = [e for e in evals if e is not None]
+    return dict(
+        present=present,
+        num_dts=np.array([len(e['dtIds']) for e in evals], dtype=np.int64),
+        num_gts=np.array([len(e['gtIds']) for e in evals], dtype=np.int64),
+        dt_ids=np.array([i for e in evals for i in e['dtIds']],
+                        dtype=np.int64),
+        gt_ids=np.array([i for e in evals for i in e['gtIds']],
+                        dtype=np.int64),
+        dt_scores=np.array([s for e in evals for s in e['dtScores']],
+                           dtype=np.float64),
+        dt_matches=np.concatenate(
+            [np.zeros((T, 0))] + [e['dtMatches'] for e in evals], axis=1),
+        gt_matches=np.concatenate(
+            [np.zeros((T, 0))] + [e['gtMatches'] for e in evals], axis=1),
+        dt_ignore=np.concatenate(
+            [np.zeros((T, 0), dtype=bool)] +
+            [np.asarray(e['dtIgnore'], dtype=bool) for e in evals],
+            axis=1),
+        gt_ignore=np.concatenate(
+            [np.zeros(0, dtype=bool)] +
+            [np.asarray(e['gtIgnore'], dtype=bool) for e in evals]))
+
+
+def _unpack_evals(packed, keys):
+    """Rebuild the per-image result dicts of ``evaluateImg`` as views of the
+    packed arrays.
+
+    Args:
+        packed (dict): Output of ``_pack_evals``.
+        keys (list[tuple]): (image id, category id, area range, max det)
+            of each result.
+    """
+    dt_ends = np.cumsum(packed['num_dts']).tolist()
+    gt_ends = np.cumsum(packed['num_gts']).tolist()
+    evals = []
+    j = 0
+    for present, (img_id, cat_id, a_rng, max_det) in zip(
+            packed['present'].tolist(), keys):
+        if not present:
+            evals.append(None)
+            continue
+        dt_end, gt_end = dt_ends[j], gt_ends[j]
+        dt_begin = dt_end - int(packed['num_dts'][j])
+        gt_begin = gt_end - int(packed['num_gts'][j])
+        evals.append({
+            'image_id': img_id,
+            'category_id': cat_id,
+            'aRng': a_rng,
+            'maxDet': max_det,
+            'dtIds': packed['dt_ids'][dt_begin:dt_end],
+            'gtIds': packed['gt_ids'][gt_begin:gt_end],
+            'dtMatches': packed['dt_matches'][:, dt_begin:dt_end],
+            'gtMatches': packed['gt_matches'][:, gt_begin:gt_end],
+            'dtScores': packed['dt_scores'][dt_begin:dt_end],
+            'gtIgnore': packed['gt_ignore'][gt_begin:gt_end],
+            'dtIgnore': packed['dt_ignore'][:, dt_begin:dt_end],
+        })
+        j += 1
+    return evals
+
+
+def _evaluate_task(task):
+    """Evaluate category ``k`` on the images in ``[lo, hi)`` with the arrays
+    of the process."""
+    k, lo, hi = task
+    arrays = _worker['arrays']
+    p = _worker['params']
+    evaluator = COCOevalMP(iouType=p.iouType)
+    evaluator.params = p
+    evaluator._gts = _unpack_anns(arrays, 'gt_', k, lo, hi, is_gt=True)
+    evaluator._dts = _unpack_anns(arrays, 'dt_', k, lo, hi, is_gt=False)
+    cat_id = p.catIds[k] if p.useCats else -1
+    max_det = p.maxDets[-1]
+    evals = [
+        evaluator.evaluateImg(img_id, cat_id, a_rng, max_det)
+        for a_rng in p.areaRng for img_id in p.imgIds[lo:hi]
+    ]
+    return k, lo, hi, _pack_evals(evals, len(p.iouThrs))
+
 
 class COCOevalMP(COCOeval):
+    """Multi-processing COCO evaluation.
 
-    def _prepare(self):
-        '''
-        Prepare ._gts and ._dts for evaluation based on params
-        :return: None
-        '''
+    The ground truths and the detections are flattened into arrays once and
+    shared with the workers through shared memory, instead of pickling the
+    COCO apis to every worker. The work is split into tasks of one category
+    and a range of images, balanced by the number of annotations, so that
+    large categories such as ``person`` are spread over several workers.
+    The workers return the per-image results as packed arrays.
 
-        def _toMask(anns, coco):
-            # modify ann['segmentation'] by reference
-            for ann in anns:
-                rle = coco.annToRLE(ann)
-                ann['segmentation'] = rle
+    Args:
+        cocoGt (COCO, optional): Ground truth COCO api. Defaults to None.
+        cocoDt (COCO, optional): Detection results COCO api.
+            Defaults to None.
+        iouType (str): 'segm', 'bbox' or 'keypoints'. Defaults to 'segm'.
+        nproc (int): Number of worker processes. 0 or 1 evaluates in the
+            current process. Defaults to 8.
+        tasks_per_proc (int): Number of tasks per worker, more tasks give a
+            better balance at the cost of scheduling overhead.
+            Defaults to 4.
+    """
+
+    def __init__(self,
+                 cocoGt=None,
+                 cocoDt=None,
+                 iouType='segm',
+                 nproc=8,
+                 tasks_per_proc=4):
+        super().__init__(cocoGt, cocoDt, iouType)
+        self.nproc = nproc
+        self.tasks_per_proc = tasks_per_proc
+
+    def _prepare(self):
+        """Flatten the ground truths and detections to evaluate into
+        arrays.
 
+        :return: dict of arrays, with 'gt_' and 'dt_' prefixes
+        """
         p = self.params
-        if p.useCats:
-            gts = []
-            dts = []
-            img_ids = set(p.imgIds)
-            cat_ids = set(p.catIds)
-            for gt in self.cocoGt.dataset['annotations']:
-                if (gt['category_id'] in cat_ids) and (gt['image_id']
-                                                       in img_ids):
-                    gts.append(gt)
-            for dt in self.cocoDt.dataset['annotations']:
-                if (dt['category_id'] in cat_ids) and (dt['image_id']
-                                                       in img_ids):
-                    dts.append(dt)
-            # gts=self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds)) # noqa
-            # dts=self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds)) # noqa
-            # gts=self.cocoGt.dataset['annotations']
-            # dts=self.cocoDt.dataset['annotations']
-        else:
-            gts = self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds))
-            dts = self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
-
-        # convert ground truth to mask if iouType == 'segm'
-        if p.iouType == 'segm':
-            _toMask(gts, self.cocoGt)
-            _toMask(dts, self.cocoDt)
-        # set ignore flag
-        for gt in gts:
-            gt['ignore'] = gt['ignore'] if 'ignore' in gt else 0
-            gt['ignore'] = 'iscrowd' in gt and gt['iscrowd']
-            if p.iouType == 'keypoints':
-                gt['ignore'] = (gt['num_keypoints'] == 0) or gt['ignore']
-        self._gts = defaultdict(list)  # gt for evaluation
-        self._dts = defaultdict(list)  # dt for evaluation
-        for gt in gts:
-            self._gts[gt['image_id'], gt['category_id']].append(gt)
-        for dt in dts:
-            self._dts[dt['image_id'], dt['category_id']].append(dt)
+        img_ids = set(p.imgIds)
+        cat_ids = set(p.catIds)
+        gts = [
+            gt for gt in self.cocoGt.dataset['annotations']
+            if gt['image_id'] in img_ids and gt['category_id'] in cat_ids
+        ]
+        dts = [
+            dt for dt in self.cocoDt.dataset['annotations']
+            if dt['image_id'] in img_ids and dt['category_id'] in cat_ids
+        ]
+        img_pos = {img_id: i for i, img_id in enumerate(p.imgIds)}
+        arrays = {}
+        for prefix, anns, coco, is_gt in (('gt_', gts, self.cocoGt, True),
+                                          ('dt_', dts, self.cocoDt, False)):
+            packed = _pack_anns(anns, coco, p, img_pos, is_gt)
+            arrays.update(
+                {prefix + key: value
+                 for key, value in packed.items()})
         self.evalImgs = defaultdict(
             list)  # per-image per-category evaluation results
         self.eval = {}  # accumulated evaluation results
+        return arrays
+
+    def _split_tasks(self, arrays):
+        """Split the evaluation into (category, first image, last image)
+        tasks of about the same number of annotations.
+
+        :return: tasks sorted by their number of annotations, largest first
+        """
+        p = self.params
+        num_imgs = len(p.imgIds)
+        K = len(p.catIds) if p.useCats else 1
+        # number of annotations of each category on each image
+        weights = []
+        for k in range(K):
+            img_pos = [
+                arrays[prefix + 'img_pos']
+                [arrays[prefix + 'bounds'][k]:arrays[prefix + 'bounds'][k + 1]]
+                for prefix in ('gt_', 'dt_')
+            ]
+            weights.append(
+                np.bincount(np.concatenate(img_pos), minlength=num_imgs))
+        total = sum(int(weight.sum()) for weight in weights)
+        target = max(
+            1, -(-total // (max(self.nproc, 1) * self.tasks_per_proc)))
+        tasks = []
+        for k, weight in enumerate(weights):
+            cum = np.cumsum(weight)
+            if num_imgs == 0 or cum[-1] == 0:
+                continue
+            # cut after the image where each multiple of target is reached
+            cuts = np.searchsorted(cum, np.arange(target, cum[-1],
+                                                  target)) + 1
+            bounds = np.unique(np.concatenate([[0], cuts, [num_imgs]]))
+            for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                task_weight = cum[hi - 1] - (cum[lo - 1] if lo > 0 else 0)
+                if task_weight > 0:
+                    tasks.append((task_weight, (k, lo, hi)))
+        tasks.sort(key=lambda task: -task[0])
+        return [task for _, task in tasks]
 
     def evaluate(self):
         """Run per image evaluation on given images and store results (a list
@@ -88,45 +353,52 @@ class COCOevalMP(COCOeval):
         p.maxDets = sorted(p.maxDets)
         self.params = p
 
-        # loop through images, area range, max detection number
-        catIds = p.catIds if p.useCats else [-1]
-
-        nproc = 8
-        split_size = len(catIds) // nproc
-        mp_params = []
-        for i in range(nproc):
-            begin = i * split_size
-            end = (i + 1) * split_size
-            if i == nproc - 1:
-                end = len(catIds)
-            mp_params.append((catIds[begin:end], ))
+        arrays = self._prepare()
+        tasks = self._split_tasks(arrays)
 
         MMLogger.get_current_instance().info(
-            'start multi processing evaluation ...')
-        with mp.Pool(nproc) as pool:
-            self.evalImgs = pool.starmap(self._evaluateImg, mp_params)
+            f'start multi processing evaluation with {self.nproc} processes '
+            f'and {len(tasks)} tasks ...')
+        if self.nproc <= 1:
+            _worker.update(arrays=arrays, params=p)
+            results = [_evaluate_task(task) for task in tqdm(tasks)]
+            _worker.clear()
+        else:
+            shm, spec = _share_arrays(arrays)
+            try:
+                with mp.Pool(
+                        self.nproc,
+                        initializer=_init_worker,
+                        initargs=(shm.name, spec, p)) as pool:
+                    results = list(
+                        tqdm(
+                            pool.imap_unordered(_evaluate_task, tasks),
+                            total=len(tasks)))
+            finally:
+                shm.close()
+                shm.unlink()
 
-        self.evalImgs = list(itertools.chain(*self.evalImgs))
+        # evalImgs is ordered by category, area range and image
+        num_imgs = len(p.imgIds)
+        K = len(p.catIds) if p.useCats else 1
+        A = len(p.areaRng)
+        max_det = p.maxDets[-1]
+        evalImgs = [None] * (K * A * num_imgs)
+        for k, lo, hi, packed in results:
+            cat_id = p.catIds[k] if p.useCats else -1
+            keys = [(img_id, cat_id, a_rng, max_det) for a_rng in p.areaRng
+                    for img_id in p.imgIds[lo:hi]]
+            evals = _unpack_evals(packed, keys)
+            n = hi - lo
+            for a in range(A):
+                begin = (k * A + a) * num_imgs + lo
+                evalImgs[begin:begin + n] = evals[a * n:(a + 1) * n]
+        self.evalImgs = evalImgs
 
         self._paramsEval = copy.deepcopy(self.params)
         toc = time.time()
         print('DONE (t={:0.2f}s).'.format(toc - tic))
 
-    def _evaluateImg(self, catids_chunk):
-        self._prepare()
-        p = self.params
-        maxDet = max(p.maxDets)
-        all_params = []
-        for catId in catids_chunk:
-            for areaRng in p.areaRng:
-                for imgId in p.imgIds:
-                    all_params.append((catId, areaRng, imgId))
-        evalImgs = [
-            self.evaluateImg(imgId, catId, areaRng, maxDet)
-            for catId, areaRng, imgId in tqdm(all_params)
-        ]
-        return evalImgs
-
     def evaluateImg(self, imgId, catId, aRng, maxDet):
         p = self.params
         if p.useCats:
@@ -152,7 +424,10 @@ class COCOevalMP(COCOeval):
         iscrowd = [int(o['iscrowd']) for o in gt]
         # load computed ious
         # ious = self.ious[imgId, catId][:, gtind] if len(self.ious[imgId, catId]) > 0 else self.ious[imgId, catId] # noqa
-        ious = self.computeIoU(imgId, catId)
+        if p.iouType == 'keypoints':
+            ious = self.computeOks(imgId, catId)
+        else:
+            ious = self.computeIoU(imgId, catId)
         ious = ious[:, gtind] if len(ious) > 0 else ious
 
         T = len(p.iouThrs)
@@ -35,15 +35,25 @@ class ILSVRCDataset(XMLDataset):
 
         data_list = []
         img_ids = list_from_file(self.ann_file, backend_args=self.backend_args)
+        raw_img_infos = []
+        for img_id in img_ids:
+            raw_img_info = {}
+            raw_img_info['img_id'] = img_id
+            raw_img_info['file_name'] = f'{img_id}.JPEG'
+            raw_img_info['xml_path'] = osp.join(self.data_prefix['img'], 'annotations',
+                                                f'{img_id}.xml')
+            raw_img_infos.append(raw_img_info)
+
+        # ann_index를 설정하면 처음 한 번만 XML을 parsing해서 index로 저장하고, 이후에는 index를 memory-map으로 불러옴
+        if self.ann_index is not None:
+            # Coordinates are in range [0, width - 1 or height - 1]
+            return self.load_data_list_from_index(raw_img_infos, minus_one=False)
 
         # loading process takes around 10 mins
         if is_main_process():
             prog_bar = ProgressBar(len(img_ids))
 
-        for img_id in img_ids:
-            raw_img_info = {}
-            raw_img_info['img_id'] = img_id
-            raw_img_info['file_name'] = f'{img_id}.JPEG'
+        for raw_img_info in raw_img_infos:
             parsed_data_info = self.parse_data_info(raw_img_info)
             data_list.append(parsed_data_info)
 
@@ -51,6 +61,10 @@ class ILSVRCDataset(XMLDataset):
                 prog_bar.update()
         return data_list
 
+    def get_img_path(self, img_info: dict) -> str:
+        """Get the image path of a raw image information."""
+        return osp.join(self.data_prefix['img'], img_info['file_name'])
+
     def parse_data_info(self, img_info: dict) -> Union[dict, List[dict]]:
         """Parse raw annotation to target format.
 
@@ -63,8 +77,7 @@ class ILSVRCDataset(XMLDataset):
         """
         data_info = {}
         img_id = img_info['img_id']
-        xml_path = osp.join(self.data_prefix['img'], 'annotations',
-                            f'{img_id}.xml')
+        xml_path = img_info['xml_path']
         data_info['img_id'] = img_id
         data_info['xml_path'] = xml_path
 
@@ -77,8 +90,7 @@ class ILSVRCDataset(XMLDataset):
         width = int(size.find('width').text)
         height = int(size.find('height').text)
         folder = root.find('folder').text
-        img_path = osp.join(self.data_prefix['img'],
-                            img_info['file_name'])
+        img_path = self.get_img_path(img_info)
         data_info['img_path'] = img_path
 
         data_info['height'] = height
@@ -1,14 +1,23 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import hashlib
+import json
+import os
 import os.path as osp
+import shutil
 import xml.etree.ElementTree as ET
 from typing import List, Optional, Union
 
 import mmcv
+import numpy as np
+from mmengine.dist import barrier, is_main_process
 from mmengine.fileio import get, get_local_path, list_from_file
 
 from mmdet.registry import DATASETS
 from .base_det_dataset import BaseDetDataset
 
+# version of the layout written by ``XMLDataset.compile_ann_index``
+ANN_INDEX_VERSION = 1
+
 
 @DATASETS.register_module()
 class XMLDataset(BaseDetDataset):
@@ -17,6 +26,12 @@ class XMLDataset(BaseDetDataset):
     Args:
         img_subdir (str): Subdir where images are stored. Default: JPEGImages.
         ann_subdir (str): Subdir where annotations are. Default: Annotations.
+        ann_index (str, optional): Directory of the compiled annotation
+            index. If set, the XML files are parsed only once into a
+            columnar index (see :meth:`compile_ann_index`), which is memory
+            mapped by later launches as long as ``ann_file`` is unchanged.
+            Relative paths are joined with ``data_root``. Defaults to None,
+            which parses the XML files on every launch.
         backend_args (dict, optional): Arguments to instantiate the
             corresponding backend. Defaults to None.
     """
@@ -24,9 +39,11 @@ class XMLDataset(BaseDetDataset):
     def __init__(self,
                  img_subdir: str = 'JPEGImages',
                  ann_subdir: str = 'Annotations',
+                 ann_index: Optional[str] = None,
                  **kwargs) -> None:
         self.img_subdir = img_subdir
         self.ann_subdir = ann_subdir
+        self.ann_index = ann_index
         super().__init__(**kwargs)
 
     @property
@@ -49,6 +66,7 @@ class XMLDataset(BaseDetDataset):
 
         data_list = []
         img_ids = list_from_file(self.ann_file, backend_args=self.backend_args)
+        raw_img_infos = []
         for img_id in img_ids:
             file_name = osp.join(self.img_subdir, f'{img_id}.jpg')
             xml_path = osp.join(self.sub_data_root, self.ann_subdir,
@@ -58,11 +76,202 @@ class XMLDataset(BaseDetDataset):
             raw_img_info['img_id'] = img_id
             raw_img_info['file_name'] = file_name
             raw_img_info['xml_path'] = xml_path
+            raw_img_infos.append(raw_img_info)
+
+        if self.ann_index is not None:
+            return self.load_data_list_from_index(raw_img_infos)
 
+        for raw_img_info in raw_img_infos:
             parsed_data_info = self.parse_data_info(raw_img_info)
             data_list.append(parsed_data_info)
         return data_list
 
+    def get_img_path(self, img_info: dict) -> str:
+        """Get the image path of a raw image information."""
+        return osp.join(self.sub_data_root, img_info['file_name'])
+
+    @property
+    def ann_index_dir(self) -> Optional[str]:
+        """Return the directory of the compiled annotation index."""
+        if self.ann_index is None:
+            return None
+        if self.data_root and not osp.isabs(self.ann_index):
+            return osp.join(self.data_root, self.ann_index)
+        return self.ann_index
+
+    def get_ann_index_key(self, raw_img_infos: List[dict]) -> dict:
+        """Get the key which a valid annotation index must match.
+
+        The index is tied to the modification time, size and content hash of
+        ``ann_file``, to the XML paths it was compiled from and to the
+        classes.
+        """
+        with get_local_path(
+                self.ann_file, backend_args=self.backend_args) as local_path:
+            stat = os.stat(local_path)
+            with open(local_path, 'rb') as f:
+                ann_file_hash = hashlib.sha1(f.read()).hexdigest()
+        xml_paths_hash = hashlib.sha1('\n'.join(
+            img_info['xml_path']
+            for img_info in raw_img_infos).encode()).hexdigest()
+        return dict(
+            version=ANN_INDEX_VERSION,
+            ann_file=osp.abspath(self.ann_file),
+            ann_file_mtime=stat.st_mtime,
+            ann_file_size=stat.st_size,
+            ann_file_hash=ann_file_hash,
+            xml_paths_hash=xml_paths_hash,
+            classes=list(self._metainfo['classes']))
+
+    def compile_ann_index(self, raw_img_infos: List[dict],
+                          index_dir: str, key: dict) -> None:
+        """Parse the XML files once into a columnar annotation index.
+
+        The index is a directory of ``.npy`` files:
+
+        - ``sizes``: (N, 2) int32 height and width of each image.
+        - ``offsets``: (N + 1, ) int64, the instances of the i-th image are
+          ``offsets[i]:offsets[i + 1]``.
+        - ``bboxes``: (M, 4) int32 boxes as written in the XML files.
+        - ``labels``: (M, ) int32 labels.
+        - ``difficult``: (M, ) uint8 difficult flags.
+
+        and a ``key.json`` holding ``key``. It is written to a temporary
+        directory first, so that readers never see a partial index.
+
+        Args:
+            raw_img_infos (list[dict]): Raw image information, including
+                `img_id`, `file_name` and `xml_path`.
+            index_dir (str): Directory to write the index to.
+            key (dict): The key returned by :meth:`get_ann_index_key`.
+        """
+        sizes, offsets = [], [0]
+        bboxes, labels, difficults = [], [], []
+        for img_info in raw_img_infos:
+            with get_local_path(
+                    img_info['xml_path'],
+                    backend_args=self.backend_args) as local_path:
+                raw_ann_info = ET.parse(local_path)
+            size = raw_ann_info.getroot().find('size')
+            if size is not None:
+                width = int(size.find('width').text)
+                height = int(size.find('height').text)
+            else:
+                img_bytes = get(
+                    self.get_img_path(img_info),
+                    backend_args=self.backend_args)
+                img = mmcv.imfrombytes(img_bytes, backend='cv2')
+                height, width = img.shape[:2]
+                del img, img_bytes
+            sizes.append((height, width))
+
+            for obj in raw_ann_info.findall('object'):
+                name = obj.find('name').text
+                if name not in self.cat2label:
+                    continue
+                difficult = obj.find('difficult')
+                difficults.append(
+                    0 if difficult is None else int(difficult.text))
+                bnd_box = obj.find('bndbox')
+                bboxes.append([
+                    int(float(bnd_box.find(coord).text))
+                    for coord in ('xmin', 'ymin', 'xmax', 'ymax')
+                ])
+                labels.append(self.cat2label[name])
+            offsets.append(len(labels))
+
+        columns = dict(
+            sizes=np.array(sizes, dtype=np.int32).reshape(-1, 2),
+            offsets=np.array(offsets, dtype=np.int64),
+            bboxes=np.array(bboxes, dtype=np.int32).reshape(-1, 4),
+            labels=np.array(labels, dtype=np.int32),
+            difficult=np.array(difficults, dtype=np.uint8))
+        tmp_dir = f'{index_dir}.tmp{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, column in columns.items():
+            np.save(osp.join(tmp_dir, f'{name}.npy'), column)
+        with open(osp.join(tmp_dir, 'key.json'), 'w') as f:
+            json.dump(key, f)
+        if osp.exists(index_dir):
+            shutil.rmtree(index_dir)
+        os.replace(tmp_dir, index_dir)
+
+    @staticmethod
+    def load_ann_index(index_dir: str, key: dict) -> Optional[dict]:
+        """Memory map the annotation index in ``index_dir``.
+
+        Returns:
+            dict, optional: The columns of the index, or None if there is no
+            index matching ``key``.
+        """
+        key_file = osp.join(index_dir, 'key.json')
+        if not osp.exists(key_file):
+            return None
+        with open(key_file) as f:
+            if json.load(f) != key:
+                return None
+        return {
+            name: np.load(osp.join(index_dir, f'{name}.npy'), mmap_mode='r')
+            for name in ('sizes', 'offsets', 'bboxes', 'labels', 'difficult')
+        }
+
+    def load_data_list_from_index(self,
+                                  raw_img_infos: List[dict],
+                                  minus_one: bool = True) -> List[dict]:
+        """Load the data list from the compiled annotation index.
+
+        The index is compiled by the main process if it is missing or
+        stale, and memory mapped by every process.
+
+        Args:
+            raw_img_infos (list[dict]): Raw image information, including
+                `img_id`, `file_name` and `xml_path`.
+            minus_one (bool): Whether to subtract 1 from the coordinates.
+                Defaults to True.
+
+        Returns:
+            list[dict]: Annotation info, same as :meth:`parse_data_info`.
+        """
+        index_dir = self.ann_index_dir
+        key = self.get_ann_index_key(raw_img_infos)
+        if is_main_process() and self.load_ann_index(index_dir, key) is None:
+            self.compile_ann_index(raw_img_infos, index_dir, key)
+        barrier()
+        index = self.load_ann_index(index_dir, key)
+        assert index is not None, \
+            f'annotation index in {index_dir} does not match {self.ann_file}'
+
+        bboxes = index['bboxes'] - int(minus_one)
+        ignore_flags = index['difficult'].astype(bool)
+        if self.bbox_min_size is not None and len(bboxes) > 0:
+            assert not self.test_mode
+            ignore_flags |= (bboxes[:, 2] - bboxes[:, 0] < self.bbox_min_size)
+            ignore_flags |= (bboxes[:, 3] - bboxes[:, 1] < self.bbox_min_size)
+        sizes = index['sizes'].tolist()
+        offsets = index['offsets'].tolist()
+        bboxes = bboxes.tolist()
+        labels = index['labels'].tolist()
+        ignore_flags = ignore_flags.astype(int).tolist()
+
+        data_list = []
+        for i, img_info in enumerate(raw_img_infos):
+            start, end = offsets[i], offsets[i + 1]
+            data_list.append(
+                dict(
+                    img_path=self.get_img_path(img_info),
+                    img_id=img_info['img_id'],
+                    xml_path=img_info['xml_path'],
+                    height=sizes[i][0],
+                    width=sizes[i][1],
+                    instances=[
+                        dict(ignore_flag=ignore_flag, bbox=bbox,
+                             bbox_label=label)
+                        for bbox, label, ignore_flag in zip(
+                            bboxes[start:end], labels[start:end],
+                            ignore_flags[start:end])
+                    ]))
+        return data_list
+
     @property
     def bbox_min_size(self) -> Optional[int]:
         """Return the minimum size of bounding boxes in the images."""
@@ -82,7 +291,7 @@ class XMLDataset(BaseDetDataset):
             Union[dict, List[dict]]: Parsed annotation.
         """
         data_info = {}
-        img_path = osp.join(self.sub_data_root, img_info['file_name'])
+        img_path = self.get_img_path(img_info)
         data_info['img_path'] = img_path
         data_info['img_id'] = img_info['img_id']
         data_info['xml_path'] = img_info['xml_path']
@@ -1,5 +1,8 @@
 from mmengine.runner import ValLoop, TestLoop
-from typing import Dict, List, Union, Sequence
+from typing import Dict, List, Optional, Union, Sequence
+import os.path as osp
+import time
+from copy import deepcopy
 from mmengine.runner.amp import autocast
 
 from torch.utils.data import DataLoader
@@ -8,6 +11,7 @@ from mmengine.evaluator import Evaluator
 from mmdet.registry import LOOPS
 
 from dyn_perceiver.get_threshold import get_threshold as _get_threshold
+from dyn_perceiver.get_threshold import get_head_threshold as _get_head_threshold
 import torch
 from cs470_logger.cs470_print import cs470_print
 from tools.cs470.dynamic_evaluation_logger import DynamicEvaluationLogger, DynamicValidationLogger
@@ -21,11 +25,13 @@ class DynamicValLoop(ValLoop):
                  evaluator: Union[Evaluator, Dict, List],
                  fp16: bool = False,
                  dynamic_evaluate_epoch: List[int] = [],
-                 threshold_distribution: List[float] = [0.85, 1, 0.5, 1]
+                 threshold_distribution: List[float] = [0.85, 1, 0.5, 1],
+                 logit_cache_dir: Optional[str] = 'threshold_cache'
                  ):
         super().__init__(runner, dataloader, evaluator, fp16)
         self.dynamic_evaluate_epoch = dynamic_evaluate_epoch
         self.threshold_distribution = threshold_distribution
+        self.logit_cache_dir = logit_cache_dir
         if len(self.dynamic_evaluate_epoch) > 0:
             self.get_flops()
 
@@ -36,15 +42,15 @@ class DynamicValLoop(ValLoop):
         self.get_dynamic_evalute()
         if self.dynamic_evaluate:
             cs470_print("Dynamic Evaluation")
-            self.evaluate_logger = DynamicValidationLogger(self.runner._log_dir, self.flops, self.runner.train_loop.epoch)
+            self.evaluate_logger = DynamicValidationLogger(self.runner._log_dir, self.flops, self.runner.train_loop.epoch, len(self.dataloader.dataset))
             self.get_threshold_and_flops()
             for _index, threshold in enumerate(self.thresholds):
                 cs470_print("Thresholds for output: " + str(threshold.tolist()))
                 self.set_threshold(threshold)
                 for idx, data_batch in enumerate(self.dataloader):
+                    start = time.perf_counter()
                     self.run_iter(idx, data_batch)
-                    self.evaluate_logger.append(self.get_last_exited_stage())
-                    self.evaluate_logger.append_classifier(self.get_last_classifiy_correct())
+                    self.append_evaluation(time.perf_counter() - start)
                 self.unset_threshold()
                 metrics = self.evaluator.evaluate(len(self.dataloader.dataset))
                 self.runner.model.metrics.append(metrics)
@@ -63,20 +69,38 @@ class DynamicValLoop(ValLoop):
     
     @torch.no_grad()
     def get_threshold_and_flops(self):
-        self.thresholds = _get_threshold(self.runner.model, self.runner.train_loop.dataloader, self.threshold_distribution, self.fp16)
+        self.thresholds = _get_threshold(self.runner.model, self.runner.train_loop.dataloader, self.threshold_distribution, self.fp16, self.get_logit_cache_dir())
         cs470_print("Thresholds: " + str([threshold.tolist() for threshold in self.thresholds]))
         cs470_print("Flops per early exiting stages: " + str(self.flops.tolist()))
         return
     
     def get_flops(self):
         self.flops = self.runner.model.get_dynamic_flops(data_loader=self.dataloader)
+
+    def get_logit_cache_dir(self):
+        # 상대 경로는 work_dir 기준. None이면 cache를 사용하지 않음.
+        if self.logit_cache_dir is None:
+            return None
+        return osp.join(self.runner.work_dir, self.logit_cache_dir)
     
     def get_last_exited_stage(self):
         return self.runner.model.backbone.get_last_exited_stage()
+
+    def get_last_exited_stages(self):
+        return self.runner.model.backbone.get_last_exited_stages()
     
     def get_last_classifiy_correct(self):
         return self.runner.model.classifiy_correct
 
+    def append_evaluation(self, elapsed=None):
+        # 마지막 batch의 exit stage, classifier 결과와 image별 trace를 evaluate_logger에 기록
+        model = self.runner.model
+        stages = self.get_last_exited_stages()
+        confidences, corrects, input_shapes = model.last_exit_trace
+        self.evaluate_logger.append(stages, confidences, corrects,
+                                    model.get_sample_flops(input_shapes, stages), elapsed)
+        self.evaluate_logger.append_classifier(self.get_last_classifiy_correct())
+
     def set_threshold(self, threshold):
         self.runner.model.set_threshold(threshold)
 
@@ -95,12 +119,28 @@ class DynamicTestLoop(TestLoop):
                  fp16: bool = False,
                  dynamic_evaluate: bool = False,
                  threshold_distribution: List[float] = [0.85, 1, 0.5, 1],
-                 use_qualitive_logger: bool = False):
+                 use_qualitive_logger: bool = False,
+                 logit_cache_dir: Optional[str] = 'threshold_cache',
+                 single_pass: bool = False,
+                 head_exit_ratio: Optional[float] = None,
+                 qualitive_log_format: Optional[str] = None):
         super().__init__(runner, dataloader, evaluator, fp16)
         self.dynamic_evaluate = dynamic_evaluate
         self.threshold_distribution = threshold_distribution
+        self.logit_cache_dir = logit_cache_dir
+        # single_pass: dataset을 한 번만 돌면서 모든 exit의 detection을 구하고, threshold들은 offline으로 적용
+        self.single_pass = single_pass
+        self.evaluator_cfg = deepcopy(evaluator)
+        # head의 coarse exit (P5~P7만 보고 P3/P4 head를 건너뜀)으로 exit시킬 image 비율. None이면 사용하지 않음
+        # head threshold는 backbone threshold마다 따로 calibration하므로 single_pass (모든 threshold를 한 번에 적용)와는 같이 쓸 수 없다
+        assert head_exit_ratio is None or not single_pass, \
+            'head_exit_ratio is not supported with single_pass'
+        self.head_exit_ratio = head_exit_ratio
+        self.head_thresholds = None
         self.use_qualitive_logger = use_qualitive_logger and dynamic_evaluate
         self.qualitive_logger = None
+        # QualitiveLogger의 파일 형식 ('parquet', 'csv'). None이면 pyarrow가 있을 때 parquet
+        self.qualitive_log_format = qualitive_log_format
         if self.dynamic_evaluate:
             self.get_flops()
 
@@ -108,26 +148,37 @@ class DynamicTestLoop(TestLoop):
         self.runner.call_hook('before_test')
         self.runner.call_hook('before_test_epoch')
         self.runner.model.eval()
-        if self.dynamic_evaluate:
+        if self.dynamic_evaluate and self.single_pass:
+            metrics = self.run_single_pass()
+            self.runner.call_hook('after_test_epoch', metrics=metrics)
+            self.runner.call_hook('after_test')
+            self.evaluate_logger.process()
+        elif self.dynamic_evaluate:
             cs470_print("Dynamic Evaluation")
-            self.evaluate_logger = DynamicEvaluationLogger(self.runner._log_dir, self.flops)
+            self.evaluate_logger = DynamicEvaluationLogger(self.runner._log_dir, self.flops, num_images=len(self.dataloader.dataset))
             self.get_threshold_and_flops()
+            qualitive_loggers = []
             for index, threshold in enumerate(self.thresholds):
                 cs470_print("Thresholds for output: " + str(threshold.tolist()))
                 if self.use_qualitive_logger:
-                    self.qualitive_logger = QualitiveLogger(self.runner._log_dir, index + 1)
+                    self.qualitive_logger = QualitiveLogger(self.runner._log_dir, index + 1, self.qualitive_log_format)
+                    qualitive_loggers.append(self.qualitive_logger)
                 self.set_threshold(threshold)
+                if self.head_thresholds is not None:
+                    self.runner.model.set_head_threshold(self.head_thresholds[index])
                 for idx, data_batch in enumerate(self.dataloader):
+                    start = time.perf_counter()
                     self.run_iter(idx, data_batch)
-                    self.evaluate_logger.append(self.get_last_exited_stage())
-                    self.evaluate_logger.append_classifier(self.get_last_classifiy_correct())
+                    self.append_evaluation(time.perf_counter() - start)
                 self.unset_threshold()
+                self.runner.model.unset_head_threshold()
                 metrics = self.evaluator.evaluate(len(self.dataloader.dataset))
                 self.runner.model.metrics.append(metrics)
                 if self.use_qualitive_logger:
                     self.qualitive_logger.save_info()
                     self.qualitive_logger = None
                 self.evaluate_logger.save_info(metrics, threshold.tolist())
+            self.wait_qualitive_loggers(qualitive_loggers)
             self.runner.call_hook('after_test_epoch', metrics=metrics)
             self.runner.call_hook('after_test')
             self.evaluate_logger.process()
@@ -140,6 +191,93 @@ class DynamicTestLoop(TestLoop):
             self.runner.call_hook('after_test')
         return metrics
     
+    def run_single_pass(self) -> dict:
+        """
+        한 번의 data pass로 모든 threshold에 대한 dynamic evaluation을 수행.
+        image마다 network 전체를 한 번 실행해 exit stage 1~4의 detection과 classifier confidence를 모두 구하고,
+        각 threshold로 exit stage를 정해서 threshold마다 따로 둔 evaluator에 넣는다.
+        """
+        cs470_print("Dynamic Evaluation (single pass)")
+        self.evaluate_logger = DynamicEvaluationLogger(self.runner._log_dir, self.flops, num_images=len(self.dataloader.dataset))
+        self.get_threshold_and_flops()
+        thresholds = torch.stack([torch.as_tensor(threshold, dtype=torch.float) for threshold in self.thresholds])
+        evaluators = [self.build_evaluator() for _ in self.thresholds]
+        exited_stages = [[] for _ in self.thresholds]
+        classifier_corrects = [[] for _ in self.thresholds]
+        # image별 trace. 모든 classifier가 계산되므로 confidence, correct는 threshold와 무관
+        exit_traces = dict(confidences=[], corrects=[], flops=[[] for _ in self.thresholds])
+        qualitive_loggers = [QualitiveLogger(self.runner._log_dir, index + 1, self.qualitive_log_format) for index in range(len(self.thresholds))] \
+            if self.use_qualitive_logger else None
+
+        for idx, data_batch in enumerate(self.dataloader):
+            self.runner.call_hook(
+                'before_test_iter', batch_idx=idx, data_batch=data_batch)
+            outputs = self.run_iter_all_exits(idx, data_batch, thresholds, evaluators,
+                                              exited_stages, classifier_corrects, qualitive_loggers, exit_traces)
+            self.runner.call_hook(
+                'after_test_iter',
+                batch_idx=idx,
+                data_batch=data_batch,
+                outputs=outputs)
+
+        for index, (threshold, evaluator) in enumerate(zip(self.thresholds, evaluators)):
+            cs470_print("Thresholds for output: " + str(threshold.tolist()))
+            self.evaluate_logger.append(exited_stages[index], torch.cat(exit_traces['confidences']),
+                                        torch.cat(exit_traces['corrects']), exit_traces['flops'][index])
+            self.evaluate_logger.append_classifier(classifier_corrects[index])
+            metrics = evaluator.evaluate(len(self.dataloader.dataset))
+            self.runner.model.metrics.append(metrics)
+            if qualitive_loggers is not None:
+                qualitive_loggers[index].save_info()
+            self.evaluate_logger.save_info(metrics, threshold.tolist())
+        if qualitive_loggers is not None:
+            self.wait_qualitive_loggers(qualitive_loggers)
+        self.evaluator = evaluators[-1]
+        return metrics
+
+    def wait_qualitive_loggers(self, qualitive_loggers):
+        # background에서 저장 중인 qualitive log가 모두 끝날 때까지 기다린다. 실패한 write가 있으면 raise
+        try:
+            for qualitive_logger in qualitive_loggers:
+                qualitive_logger.wait()
+        finally:
+            QualitiveLogger.shutdown()
+
+    @torch.no_grad()
+    def run_iter_all_exits(self, idx, data_batch: Sequence[dict], thresholds, evaluators,
+                           exited_stages, classifier_corrects, qualitive_loggers, exit_traces):
+        model = self.runner.model
+        with autocast(enabled=self.fp16):
+            data_samples, stage_results, *classifier_preds = model.test_step_all_exits(data_batch)
+        # (num_thresholds, batch) exit stage. host로는 batch마다 한 번만 가져온다.
+        stages = model.get_exit_stages(classifier_preds, thresholds).tolist()
+        confidences, corrects = model.get_exit_trace(classifier_preds, data_samples)
+        exit_traces['confidences'].append(confidences.cpu())
+        exit_traces['corrects'].append(corrects.cpu())
+        input_shapes = [tuple(data_sample.batch_input_shape) for data_sample in data_samples]
+        for index in range(len(evaluators)):
+            exit_traces['flops'][index].extend(model.get_sample_flops(input_shapes, stages[index]))
+        target_labels = model.get_target_labels(data_samples)
+        # (4, batch) 각 classifier의 predicted label
+        preds = torch.stack([pred.argmax(dim=1) for pred in classifier_preds]).tolist()
+
+        for index, evaluator in enumerate(evaluators):
+            for data_sample, results, stage in zip(data_samples, zip(*stage_results), stages[index]):
+                data_sample.pred_instances = results[stage - 1]
+            exited_stages[index].extend(stages[index])
+            classifier_corrects[index].extend(
+                preds[stage - 1][i] == target_labels[i] for i, stage in enumerate(stages[index]))
+            if qualitive_loggers is not None:
+                qualitive_loggers[index].process(idx, data_batch, data_samples, stages[index])
+            evaluator.process(data_samples=data_samples, data_batch=data_batch)
+        return data_samples
+
+    def build_evaluator(self):
+        evaluator = self.runner.build_evaluator(deepcopy(self.evaluator_cfg))
+        if hasattr(self.dataloader.dataset, 'metainfo'):
+            evaluator.dataset_meta = self.dataloader.dataset.metainfo
+        return evaluator
+
     @torch.no_grad()
     def run_iter(self, idx, data_batch: Sequence[dict]) -> None:
         self.runner.call_hook(
@@ -148,7 +286,7 @@ class DynamicTestLoop(TestLoop):
         with autocast(enabled=self.fp16):
             outputs = self.runner.model.test_step(data_batch)
         if self.use_qualitive_logger:
-            self.qualitive_logger.process(idx, data_batch, outputs, self.get_last_exited_stage())
+            self.qualitive_logger.process(idx, data_batch, outputs, self.get_last_exited_stages())
         self.evaluator.process(data_samples=outputs, data_batch=data_batch)
         self.runner.call_hook(
             'after_test_iter',
@@ -158,19 +296,45 @@ class DynamicTestLoop(TestLoop):
     
     @torch.no_grad()
     def get_threshold_and_flops(self):
-        self.thresholds = _get_threshold(self.runner.model, self.runner.train_loop.dataloader, self.threshold_distribution, self.fp16)
+        self.thresholds = _get_threshold(self.runner.model, self.runner.train_loop.dataloader, self.threshold_distribution, self.fp16, self.get_logit_cache_dir())
         cs470_print("Thresholds: " + str([threshold.tolist() for threshold in self.thresholds]))
         cs470_print("Flops per early exiting stages: " + str(self.flops.tolist()))
+        if self.head_exit_ratio is not None:
+            # self.thresholds의 backbone threshold마다 하나씩
+            self.head_thresholds = _get_head_threshold(self.runner.model, self.runner.train_loop.dataloader, self.head_exit_ratio, self.thresholds, self.fp16)
         return
     
     def get_flops(self):
         self.flops = self.runner.model.get_dynamic_flops(data_loader=self.dataloader)
+
+    def get_logit_cache_dir(self):
+        # 상대 경로는 work_dir 기준. None이면 cache를 사용하지 않음.
+        if self.logit_cache_dir is None:
+            return None
+        return osp.join(self.runner.work_dir, self.logit_cache_dir)
     
     def get_last_exited_stage(self):
         return self.runner.model.backbone.get_last_exited_stage()
+
+    def get_last_exited_stages(self):
+        return self.runner.model.backbone.get_last_exited_stages()
     
     def get_last_classifiy_correct(self):
         return self.runner.model.classifiy_correct
+
+    def append_evaluation(self, elapsed=None):
+        # 마지막 batch의 exit stage, classifier 결과와 image별 trace를 evaluate_logger에 기록
+        # head의 coarse exit을 한 image는 건너뛴 P3/P4 head의 FLOPs를 빼고 기록
+        model = self.runner.model
+        stages = self.get_last_exited_stages()
+        confidences, corrects, input_shapes = model.last_exit_trace
+        coarse_exits = model.get_last_coarse_exits()
+        flops = model.get_sample_flops(input_shapes, stages, coarse_exits)
+        self.evaluate_logger.append(stages, confidences, corrects, flops, elapsed)
+        self.evaluate_logger.append_classifier(self.get_last_classifiy_correct())
+        if coarse_exits is not None:
+            full_flops = model.get_sample_flops(input_shapes, stages)
+            self.evaluate_logger.append_coarse_exits(coarse_exits, [full - sample for full, sample in zip(full_flops, flops)])
     
     def set_threshold(self, threshold):
         self.runner.model.set_threshold(threshold)
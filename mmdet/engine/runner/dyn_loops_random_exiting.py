@@ -1,5 +1,6 @@
 from mmengine.runner import ValLoop, TestLoop
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Union
+import os.path as osp
 
 from torch.utils.data import DataLoader
 from mmengine.evaluator import Evaluator
@@ -21,10 +22,12 @@ class DynamicTestLoopRandomExiting(TestLoop):
                  num_images,
                  fp16: bool = False,
                  dynamic_evaluate: bool = False,
-                 threshold_distribution: List[float] = [0.85, 1, 0.5, 1]):
+                 threshold_distribution: List[float] = [0.85, 1, 0.5, 1],
+                 logit_cache_dir: Optional[str] = 'threshold_cache'):
         super().__init__(runner, dataloader, evaluator, fp16)
         self.dynamic_evaluate = dynamic_evaluate
         self.threshold_distribution = threshold_distribution
+        self.logit_cache_dir = logit_cache_dir
         self.num_images = num_images
         if self.dynamic_evaluate:
             self.get_flops()
@@ -49,7 +52,7 @@ class DynamicTestLoopRandomExiting(TestLoop):
                     for idx, data_batch in enumerate(self.dataloader):
                         self.set_threshold(applied_thresholds[idx])
                         self.run_iter(idx, data_batch)
-                        self.evaluate_logger.append(self.get_last_exited_stage())
+                        self.evaluate_logger.append(self.get_last_exited_stages())
                         self.evaluate_logger.append_classifier(self.get_last_classifiy_correct())
                         self.unset_threshold()
                     metrics = self.evaluator.evaluate(len(self.dataloader.dataset))
@@ -69,16 +72,25 @@ class DynamicTestLoopRandomExiting(TestLoop):
     
     @torch.no_grad()
     def get_threshold_and_flops(self):
-        self.thresholds = _get_threshold(self.runner.model, self.runner.train_loop.dataloader, self.threshold_distribution, self.fp16)
+        self.thresholds = _get_threshold(self.runner.model, self.runner.train_loop.dataloader, self.threshold_distribution, self.fp16, self.get_logit_cache_dir())
         cs470_print("Thresholds: " + str([threshold.tolist() for threshold in self.thresholds]))
         cs470_print("Flops per early exiting stages: " + str(self.flops.tolist()))
         return
     
     def get_flops(self):
         self.flops = self.runner.model.get_dynamic_flops(data_loader=self.dataloader)
+
+    def get_logit_cache_dir(self):
+        # 상대 경로는 work_dir 기준. None이면 cache를 사용하지 않음.
+        if self.logit_cache_dir is None:
+            return None
+        return osp.join(self.runner.work_dir, self.logit_cache_dir)
     
     def get_last_exited_stage(self):
         return self.runner.model.backbone.get_last_exited_stage()
+
+    def get_last_exited_stages(self):
+        return self.runner.model.backbone.get_last_exited_stages()
     
     def get_last_classifiy_correct(self):
         return self.runner.model.classifiy_correct
@@ -1,4 +1,5 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+from .background_worker import BackgroundWorker
 from .bbox_overlaps import bbox_overlaps
 from .cityscapes_utils import evaluateImgLists
 from .class_names import (cityscapes_classes, coco_classes,
@@ -6,7 +7,9 @@ from .class_names import (cityscapes_classes, coco_classes,
                           imagenet_det_classes, imagenet_vid_classes,
                           objects365v1_classes, objects365v2_classes,
                           oid_challenge_classes, oid_v6_classes, voc_classes)
-from .mean_ap import average_precision, eval_map, print_map_summary
+from .mean_ap import (average_precision, eval_map, get_cls_eval_result,
+                      get_cls_results, get_mean_ap, print_map_summary,
+                      tpfp_default_batched, tpfp_imagenet_batched)
 from .panoptic_utils import (INSTANCE_OFFSET, pq_compute_multi_core,
                              pq_compute_single_core)
 from .recall import (eval_recalls, plot_iou_recall, plot_num_recall,
@@ -22,5 +25,7 @@ __all__ = [
     'oid_v6_classes', 'oid_challenge_classes', 'INSTANCE_OFFSET',
     'pq_compute_single_core', 'pq_compute_multi_core', 'bbox_overlaps',
     'objects365v1_classes', 'objects365v2_classes', 'coco_panoptic_classes',
-    'evaluateImgLists', 'YTVIS', 'YTVISeval'
+    'evaluateImgLists', 'YTVIS', 'YTVISeval', 'BackgroundWorker',
+    'get_cls_results', 'get_cls_eval_result', 'get_mean_ap',
+    'tpfp_default_batched', 'tpfp_imagenet_batched'
 ]
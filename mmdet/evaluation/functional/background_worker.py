@@ -0,0 +1,61 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import queue
+import threading
+
+
+class BackgroundWorker:
+    """Run a function on the submitted arguments in a background thread.
+
+    The calls run one by one in the order of submission, so that a metric can
+    match the predictions of a batch while the next batches are inferred.
+    At most ``max_pending`` calls wait in the queue, which bounds the memory
+    held by the predictions not matched yet.
+
+    Args:
+        func (callable): The function to run.
+        max_pending (int): Maximum number of pending calls. Defaults to 16.
+    """
+
+    def __init__(self, func, max_pending=16):
+        self.func = func
+        self.max_pending = max_pending
+        self._queue = None
+        self._thread = None
+        self._error = None
+
+    def submit(self, *args):
+        """Queue a call of ``func(*args)``, starting the thread if needed."""
+        if self._error is not None:
+            # stop early instead of queueing calls that are skipped
+            self.join()
+        if self._thread is None:
+            self._queue = queue.Queue(self.max_pending)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put(args)
+
+    def join(self):
+        """Wait for the submitted calls and stop the thread.
+
+        The first exception raised by a call, if any, is raised again here.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._queue = None
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            if args is None:
+                break
+            # the remaining calls are skipped after an error
+            if self._error is None:
+                try:
+                    self.func(*args)
+                except Exception as e:
+                    self._error = e
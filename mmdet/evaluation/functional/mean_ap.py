@@ -1,4 +1,7 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import atexit
+import os
+from itertools import starmap
 from multiprocessing import Pool
 
 import numpy as np
@@ -10,6 +13,28 @@ from .bbox_overlaps import bbox_overlaps
 from .class_names import get_classes
 
 
+_eval_pool = dict(pool=None, nproc=0, pid=None)
+
+
+def _get_eval_pool(nproc):
+    """Get a pool of ``nproc`` processes, which is kept alive across the
+    calls of :func:`eval_map`, e.g. for every iou threshold of a metric."""
+    if _eval_pool['nproc'] != nproc or _eval_pool['pid'] != os.getpid():
+        _close_eval_pool()
+        _eval_pool.update(pool=Pool(nproc), nproc=nproc, pid=os.getpid())
+    return _eval_pool['pool']
+
+
+def _close_eval_pool():
+    # a pool inherited by a forked process belongs to its parent
+    if _eval_pool['pool'] is not None and _eval_pool['pid'] == os.getpid():
+        _eval_pool['pool'].terminate()
+    _eval_pool.update(pool=None, nproc=0, pid=None)
+
+
+atexit.register(_close_eval_pool)
+
+
 def average_precision(recalls, precisions, mode='area'):
     """Calculate average precision (for single or multiple scales).
 
@@ -474,6 +499,251 @@ def tpfp_openimages(det_bboxes,
         return tp, fp, det_bboxes
 
 
+def _concat_cls_results(cls_dets, cls_gts, cls_gts_ignore):
+    """Concatenate the per-image results of a class into segments.
+
+    The dets of each image are sorted by score in descending order (ties
+    keep their input order), and the ignored gts of each image follow its
+    gts, so that every image owns a contiguous segment of dets and of gts.
+
+    Returns:
+        dict: The concatenated ``dets``, ``gts`` and ``gt_ignore``, the
+        ``det_order`` mapping sorted dets back to the input order, and the
+        ``det_starts``, ``det_counts``, ``gt_starts``, ``gt_counts`` of the
+        segments.
+    """
+    num_imgs = len(cls_dets)
+    det_counts = np.array([det.shape[0] for det in cls_dets], dtype=np.int64)
+    dets = np.concatenate(cls_dets).reshape(-1, 5)
+    det_imgs = np.repeat(np.arange(num_imgs), det_counts)
+    det_order = np.lexsort((-dets[:, -1], det_imgs))
+
+    num_gts = np.array([gt.shape[0] for gt in cls_gts], dtype=np.int64)
+    num_ignores = np.array([gt.shape[0] for gt in cls_gts_ignore],
+                           dtype=np.int64)
+    gts = np.concatenate(cls_gts + cls_gts_ignore).reshape(-1, 4)
+    gt_ignore = np.concatenate(
+        (np.zeros(num_gts.sum(), dtype=bool),
+         np.ones(num_ignores.sum(), dtype=bool)))
+    gt_order = np.argsort(
+        np.concatenate((np.repeat(np.arange(num_imgs) * 2, num_gts),
+                        np.repeat(np.arange(num_imgs) * 2 + 1, num_ignores))),
+        kind='stable')
+    gt_counts = num_gts + num_ignores
+    return dict(
+        dets=dets[det_order],
+        det_order=det_order,
+        det_starts=np.cumsum(det_counts) - det_counts,
+        det_counts=det_counts,
+        gts=gts[gt_order],
+        gt_ignore=gt_ignore[gt_order],
+        gt_starts=np.cumsum(gt_counts) - gt_counts,
+        gt_counts=gt_counts)
+
+
+def _iter_padded_segments(segments, max_elements=2**22):
+    """Yield padded indices of the images that have both dets and gts.
+
+    Images are bucketed by their padded number of dets and gts, and each
+    bucket is chunked so that a chunk holds about ``max_elements`` IoUs.
+
+    Yields:
+        tuple[np.ndarray]: ``(d_idx, d_valid, g_idx, g_valid)`` of shape
+        (P, D) and (P, G), indexing the concatenated dets and gts.
+    """
+    det_counts, gt_counts = segments['det_counts'], segments['gt_counts']
+    imgs = np.nonzero((det_counts > 0) & (gt_counts > 0))[0]
+    buckets = np.ceil(np.log2(gt_counts[imgs])).astype(np.int64) * 64 + \
+        np.ceil(np.log2(det_counts[imgs])).astype(np.int64)
+    for bucket in np.unique(buckets):
+        sel = imgs[buckets == bucket]
+        D = int(det_counts[sel].max())
+        G = int(gt_counts[sel].max())
+        chunk = max(1, max_elements // (D * G))
+        for begin in range(0, len(sel), chunk):
+            s = sel[begin:begin + chunk]
+            d_valid = np.arange(D) < det_counts[s, None]
+            g_valid = np.arange(G) < gt_counts[s, None]
+            d_idx = segments['det_starts'][s, None] + np.where(
+                d_valid, np.arange(D), 0)
+            g_idx = segments['gt_starts'][s, None] + np.where(
+                g_valid, np.arange(G), 0)
+            yield d_idx, d_valid, g_idx, g_valid
+
+
+def _padded_overlaps(det_bboxes, gt_bboxes, extra_length=0.):
+    """IoUs of (P, D, 4) and (P, G, 4) bboxes, computed in float32 exactly as
+    :func:`bbox_overlaps`."""
+    dets = det_bboxes[..., :4].astype(np.float32)[:, :, None]
+    gts = gt_bboxes.astype(np.float32)[:, None]
+    det_areas = (dets[..., 2] - dets[..., 0] + extra_length) * (
+        dets[..., 3] - dets[..., 1] + extra_length)
+    gt_areas = (gts[..., 2] - gts[..., 0] + extra_length) * (
+        gts[..., 3] - gts[..., 1] + extra_length)
+    x_start = np.maximum(dets[..., 0], gts[..., 0])
+    y_start = np.maximum(dets[..., 1], gts[..., 1])
+    x_end = np.minimum(dets[..., 2], gts[..., 2])
+    y_end = np.minimum(dets[..., 3], gts[..., 3])
+    overlap = np.maximum(x_end - x_start + extra_length, 0) * np.maximum(
+        y_end - y_start + extra_length, 0)
+    union = np.maximum(det_areas + gt_areas - overlap, 1e-6)
+    return overlap / union
+
+
+def _scale_tpfp(segments, matched_gt, area_ranges, extra_length):
+    """Turn the gt matched by each sorted det (-1 for none) into tp and fp in
+    the input order of the dets.
+
+    A det matching an ignored gt, or no gt but beyond the area range, is
+    neither tp nor fp.
+    """
+    dets, gts = segments['dets'], segments['gts']
+    if area_ranges is None:
+        area_ranges = [(None, None)]
+    num_dets = dets.shape[0]
+    tp = np.zeros((len(area_ranges), num_dets), dtype=np.float32)
+    fp = np.zeros((len(area_ranges), num_dets), dtype=np.float32)
+    det_areas = (dets[:, 2] - dets[:, 0] + extra_length) * (
+        dets[:, 3] - dets[:, 1] + extra_length)
+    gt_areas = (gts[:, 2] - gts[:, 0] + extra_length) * (
+        gts[:, 3] - gts[:, 1] + extra_length)
+    matched = matched_gt >= 0
+    # the last entry is indexed by the dets matching no gt
+    gt_ignore = np.append(segments['gt_ignore'], True)
+    gt_areas = np.append(gt_areas, 0)
+    for k, (min_area, max_area) in enumerate(area_ranges):
+        gt_valid = ~gt_ignore
+        det_in_range = np.ones(num_dets, dtype=bool)
+        if min_area is not None:
+            gt_valid &= (gt_areas >= min_area) & (gt_areas < max_area)
+            det_in_range = (det_areas >= min_area) & (det_areas < max_area)
+        tp[k, segments['det_order']] = matched & gt_valid[matched_gt]
+        fp[k, segments['det_order']] = ~matched & det_in_range
+    return tp, fp
+
+
+def tpfp_default_batched(cls_dets,
+                         cls_gts,
+                         cls_gts_ignore,
+                         iou_thr=0.5,
+                         area_ranges=None,
+                         use_legacy_coordinate=False,
+                         max_elements=2**22):
+    """Check if detected bboxes of all images of a class are true positive or
+    false positive, the same as :func:`tpfp_default` image by image.
+
+    Args:
+        cls_dets (list[ndarray]): Detected bboxes of each image, of shape
+            (m, 5).
+        cls_gts (list[ndarray]): GT bboxes of each image, of shape (n, 4).
+        cls_gts_ignore (list[ndarray]): Ignored gt bboxes of each image,
+            of shape (k, 4).
+        iou_thr (float): IoU threshold to be considered as matched.
+            Defaults to 0.5.
+        area_ranges (list[tuple] | None): Range of bbox areas to be
+            evaluated, in the format [(min1, max1), (min2, max2), ...].
+            Defaults to None.
+        use_legacy_coordinate (bool): Whether to use coordinate system in
+            mmdet v1.x. Defaults to False.
+        max_elements (int): Upper bound of the number of IoUs computed at
+            once. Defaults to 2**22.
+
+    Returns:
+        tuple[np.ndarray]: (tp, fp) whose elements are 0 and 1. The shape of
+        each array is (num_scales, total m), the dets of the images being
+        concatenated in order.
+    """
+    extra_length = 1. if use_legacy_coordinate else 0.
+    segments = _concat_cls_results(cls_dets, cls_gts, cls_gts_ignore)
+    dets, gts = segments['dets'], segments['gts']
+    # for each det, the gt overlapping most with it, if the iou is enough
+    matched_gt = np.full(dets.shape[0], -1, dtype=np.int64)
+    for d_idx, d_valid, g_idx, g_valid in _iter_padded_segments(
+            segments, max_elements):
+        ious = _padded_overlaps(dets[d_idx], gts[g_idx], extra_length)
+        ious = np.where(g_valid[:, None], ious, -1)
+        ious_max = ious.max(axis=2)
+        ious_argmax = ious.argmax(axis=2)
+        matched_gt[d_idx[d_valid]] = np.where(
+            ious_max >= iou_thr,
+            np.take_along_axis(g_idx, ious_argmax, 1), -1)[d_valid]
+
+    tp, fp = _scale_tpfp(segments, matched_gt, area_ranges, extra_length)
+    # only the first det, by score, matching a valid gt is tp, and the
+    # others matching it are fp
+    inds = np.arange(dets.shape[0])
+    order = segments['det_order']
+    for k in range(tp.shape[0]):
+        tp_inds = inds[tp[k, order] > 0]
+        _, first = np.unique(matched_gt[tp_inds], return_index=True)
+        duplicates = np.delete(tp_inds, first)
+        tp[k, order[duplicates]] = 0
+        fp[k, order[duplicates]] = 1
+    return tp, fp
+
+
+def tpfp_imagenet_batched(cls_dets,
+                          cls_gts,
+                          cls_gts_ignore,
+                          default_iou_thr=0.5,
+                          area_ranges=None,
+                          use_legacy_coordinate=False,
+                          max_elements=2**22):
+    """Check if detected bboxes of all images of a class are true positive or
+    false positive, the same as :func:`tpfp_imagenet` image by image.
+
+    The greedy matching loops over the rank of the dets, and handles all the
+    images at once.
+
+    Args:
+        cls_dets (list[ndarray]): Detected bboxes of each image, of shape
+            (m, 5).
+        cls_gts (list[ndarray]): GT bboxes of each image, of shape (n, 4).
+        cls_gts_ignore (list[ndarray]): Ignored gt bboxes of each image,
+            of shape (k, 4).
+        default_iou_thr (float): IoU threshold to be considered as matched
+            for medium and large bboxes (small ones have special rules).
+            Defaults to 0.5.
+        area_ranges (list[tuple] | None): Range of bbox areas to be
+            evaluated, in the format [(min1, max1), (min2, max2), ...].
+            Defaults to None.
+        use_legacy_coordinate (bool): Whether to use coordinate system in
+            mmdet v1.x. Defaults to False.
+        max_elements (int): Upper bound of the number of IoUs computed at
+            once. Defaults to 2**22.
+
+    Returns:
+        tuple[np.ndarray]: (tp, fp) whose elements are 0 and 1. The shape of
+        each array is (num_scales, total m), the dets of the images being
+        concatenated in order.
+    """
+    extra_length = 1. if use_legacy_coordinate else 0.
+    segments = _concat_cls_results(cls_dets, cls_gts, cls_gts_ignore)
+    dets, gts = segments['dets'], segments['gts']
+    gt_w = gts[:, 2] - gts[:, 0] + extra_length
+    gt_h = gts[:, 3] - gts[:, 1] + extra_length
+    iou_thrs = np.minimum((gt_w * gt_h) / ((gt_w + 10.0) * (gt_h + 10.0)),
+                          default_iou_thr)
+    matched_gt = np.full(dets.shape[0], -1, dtype=np.int64)
+    for d_idx, d_valid, g_idx, g_valid in _iter_padded_segments(
+            segments, max_elements):
+        ious = _padded_overlaps(dets[d_idx], gts[g_idx] - 1, extra_length)
+        thrs = np.where(g_valid, iou_thrs[g_idx], np.inf)
+        gt_covered = np.zeros(g_valid.shape, dtype=bool)
+        matched = np.full(d_idx.shape, -1, dtype=np.int64)
+        rows = np.arange(d_idx.shape[0])
+        for i in range(d_idx.shape[1]):
+            # find best overlapped available gt, padded dets match nothing
+            candidates = (ious[:, i] >= thrs) & ~gt_covered
+            candidates &= d_valid[:, i, None]
+            best = np.where(candidates, ious[:, i], -1).argmax(axis=1)
+            hit = candidates[rows, best]
+            gt_covered[rows[hit], best[hit]] = True
+            matched[hit, i] = g_idx[rows[hit], best[hit]]
+        matched_gt[d_idx[d_valid]] = matched[d_valid]
+    return _scale_tpfp(segments, matched_gt, area_ranges, extra_length)
+
+
 def get_cls_results(det_results, annotations, class_id):
     """Get det results and gt information of a certain class.
 
@@ -522,6 +792,84 @@ def get_cls_group_ofs(annotations, class_id):
     return gt_group_ofs
 
 
+def get_cls_eval_result(tp,
+                        fp,
+                        det_scores,
+                        num_gts,
+                        scale_ranges=None,
+                        eval_mode='area'):
+    """Calculate the recall, precision and AP of a class from the tp and fp
+    of its dets.
+
+    Args:
+        tp (ndarray): tp of the dets of all images, of shape (num_scales, m).
+        fp (ndarray): fp of the dets of all images, of shape (num_scales, m).
+        det_scores (ndarray): Scores of the dets, of shape (m, ).
+        num_gts (ndarray): Number of gts of each scale, of shape
+            (num_scales, ).
+        scale_ranges (list[tuple] | None): Same as `eval_map()`.
+        eval_mode (str): Same as `eval_map()`.
+
+    Returns:
+        dict: `num_gts`, `num_dets`, `recall`, `precision` and `ap` of the
+        class.
+    """
+    # sort all det bboxes by score, also sort tp and fp
+    sort_inds = np.argsort(-det_scores)
+    tp = tp[:, sort_inds]
+    fp = fp[:, sort_inds]
+    # calculate recall and precision with tp and fp
+    tp = np.cumsum(tp, axis=1)
+    fp = np.cumsum(fp, axis=1)
+    eps = np.finfo(np.float32).eps
+    recalls = tp / np.maximum(num_gts[:, np.newaxis], eps)
+    precisions = tp / np.maximum((tp + fp), eps)
+    # calculate AP
+    if scale_ranges is None:
+        recalls = recalls[0, :]
+        precisions = precisions[0, :]
+        num_gts = num_gts.item()
+    ap = average_precision(recalls, precisions, eval_mode)
+    return {
+        'num_gts': num_gts,
+        'num_dets': len(det_scores),
+        'recall': recalls,
+        'precision': precisions,
+        'ap': ap
+    }
+
+
+def get_mean_ap(eval_results, scale_ranges=None):
+    """Average the AP of the classes that have gts.
+
+    Args:
+        eval_results (list[dict]): Results of `get_cls_eval_result()` of
+            each class.
+        scale_ranges (list[tuple] | None): Same as `eval_map()`.
+
+    Returns:
+        float | list[float]: mAP, or mAP of each scale.
+    """
+    if scale_ranges is not None:
+        # shape (num_classes, num_scales)
+        all_ap = np.vstack([cls_result['ap'] for cls_result in eval_results])
+        all_num_gts = np.vstack(
+            [cls_result['num_gts'] for cls_result in eval_results])
+        mean_ap = []
+        for i in range(len(scale_ranges)):
+            if np.any(all_num_gts[:, i] > 0):
+                mean_ap.append(all_ap[all_num_gts[:, i] > 0, i].mean())
+            else:
+                mean_ap.append(0.0)
+    else:
+        aps = []
+        for cls_result in eval_results:
+            if cls_result['num_gts'] > 0:
+                aps.append(cls_result['ap'])
+        mean_ap = np.array(aps).mean().item() if aps else 0.0
+    return mean_ap
+
+
 def eval_map(det_results,
              annotations,
              scale_ranges=None,
@@ -566,8 +914,8 @@ def eval_map(det_results,
             unless dataset is 'det' or 'vid' (:func:`tpfp_imagenet` in this
             case). If it is given as a function, then this function is used
             to evaluate tp & fp. Default None.
-        nproc (int): Processes used for computing TP and FP.
-            Defaults to 4.
+        nproc (int): Processes used for computing TP and FP. The pool of
+            processes is reused by the following calls. Defaults to 4.
         use_legacy_coordinate (bool): Whether to use coordinate system in
             mmdet v1.x. which means width, height should be
             calculated as 'x2 - x1 + 1` and 'y2 - y1 + 1' respectively.
@@ -603,27 +951,45 @@ def eval_map(det_results,
     if num_imgs > 1:
         assert nproc > 0, 'nproc must be at least one.'
         nproc = min(nproc, num_imgs)
-        pool = Pool(nproc)
+
+    # choose proper function according to datasets to compute tp and fp
+    if tpfp_fn is None:
+        if dataset in ['det', 'vid']:
+            tpfp_fn = tpfp_imagenet
+        elif dataset in ['oid_challenge', 'oid_v6'] or use_group_of is True:
+            tpfp_fn = tpfp_openimages
+        else:
+            tpfp_fn = tpfp_default
+    if not callable(tpfp_fn):
+        raise ValueError(
+            f'tpfp_fn has to be a function or None, but got {tpfp_fn}')
+    # the builtin functions handle all images of a class at once, and the
+    # classes are distributed to the processes
+    batched_tpfp_fn = None
+    if not use_group_of:
+        batched_tpfp_fn = {
+            tpfp_default: tpfp_default_batched,
+            tpfp_imagenet: tpfp_imagenet_batched
+        }.get(tpfp_fn)
+    if batched_tpfp_fn is not None:
+        batched_args = ((*get_cls_results(det_results, annotations, i),
+                         iou_thr, area_ranges, use_legacy_coordinate)
+                        for i in range(num_classes))
+        if num_imgs > 1 and nproc > 1 and num_classes > 1:
+            batched_tpfps = iter(
+                _get_eval_pool(nproc).starmap(batched_tpfp_fn, batched_args))
+        else:
+            batched_tpfps = starmap(batched_tpfp_fn, batched_args)
 
     eval_results = []
     for i in range(num_classes):
         # get gt and det bboxes of this class
         cls_dets, cls_gts, cls_gts_ignore = get_cls_results(
             det_results, annotations, i)
-        # choose proper function according to datasets to compute tp and fp
-        if tpfp_fn is None:
-            if dataset in ['det', 'vid']:
-                tpfp_fn = tpfp_imagenet
-            elif dataset in ['oid_challenge', 'oid_v6'] \
-                    or use_group_of is True:
-                tpfp_fn = tpfp_openimages
-            else:
-                tpfp_fn = tpfp_default
-        if not callable(tpfp_fn):
-            raise ValueError(
-                f'tpfp_fn has to be a function or None, but got {tpfp_fn}')
 
-        if num_imgs > 1:
+        if batched_tpfp_fn is not None:
+            tpfp = [next(batched_tpfps)]
+        elif num_imgs > 1:
             # compute tp and fp for each image with multiple processes
             args = []
             if use_group_of:
@@ -634,7 +1000,7 @@ def eval_map(det_results,
             if ioa_thr is not None:
                 args.append([ioa_thr for _ in range(num_imgs)])
 
-            tpfp = pool.starmap(
+            tpfp = _get_eval_pool(nproc).starmap(
                 tpfp_fn,
                 zip(cls_dets, cls_gts, cls_gts_ignore,
                     [iou_thr for _ in range(num_imgs)],
@@ -670,52 +1036,17 @@ def eval_map(det_results,
                 for k, (min_area, max_area) in enumerate(area_ranges):
                     num_gts[k] += np.sum((gt_areas >= min_area)
                                          & (gt_areas < max_area))
-        # sort all det bboxes by score, also sort tp and fp
         cls_dets = np.vstack(cls_dets)
-        num_dets = cls_dets.shape[0]
-        sort_inds = np.argsort(-cls_dets[:, -1])
-        tp = np.hstack(tp)[:, sort_inds]
-        fp = np.hstack(fp)[:, sort_inds]
-        # calculate recall and precision with tp and fp
-        tp = np.cumsum(tp, axis=1)
-        fp = np.cumsum(fp, axis=1)
-        eps = np.finfo(np.float32).eps
-        recalls = tp / np.maximum(num_gts[:, np.newaxis], eps)
-        precisions = tp / np.maximum((tp + fp), eps)
-        # calculate AP
-        if scale_ranges is None:
-            recalls = recalls[0, :]
-            precisions = precisions[0, :]
-            num_gts = num_gts.item()
-        ap = average_precision(recalls, precisions, eval_mode)
-        eval_results.append({
-            'num_gts': num_gts,
-            'num_dets': num_dets,
-            'recall': recalls,
-            'precision': precisions,
-            'ap': ap
-        })
-
-    if num_imgs > 1:
-        pool.close()
-
-    if scale_ranges is not None:
-        # shape (num_classes, num_scales)
-        all_ap = np.vstack([cls_result['ap'] for cls_result in eval_results])
-        all_num_gts = np.vstack(
-            [cls_result['num_gts'] for cls_result in eval_results])
-        mean_ap = []
-        for i in range(num_scales):
-            if np.any(all_num_gts[:, i] > 0):
-                mean_ap.append(all_ap[all_num_gts[:, i] > 0, i].mean())
-            else:
-                mean_ap.append(0.0)
-    else:
-        aps = []
-        for cls_result in eval_results:
-            if cls_result['num_gts'] > 0:
-                aps.append(cls_result['ap'])
-        mean_ap = np.array(aps).mean().item() if aps else 0.0
+        eval_results.append(
+            get_cls_eval_result(
+                np.hstack(tp),
+                np.hstack(fp),
+                cls_dets[:, -1],
+                num_gts,
+                scale_ranges=scale_ranges,
+                eval_mode=eval_mode))
+
+    mean_ap = get_mean_ap(eval_results, scale_ranges)
 
     print_map_summary(
         mean_ap, eval_results, dataset, area_ranges, logger=logger)
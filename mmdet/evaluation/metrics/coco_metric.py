@@ -1,22 +1,25 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import datetime
 import itertools
+import json
 import os.path as osp
 import tempfile
 from collections import OrderedDict
-from typing import Dict, List, Optional, Sequence, Union
+from typing import (Dict, Iterable, Iterator, List, Optional, Sequence,
+                    Union)
 
 import numpy as np
 import torch
 from mmengine.evaluator import BaseMetric
-from mmengine.fileio import dump, get_local_path, load
+from mmengine.fileio import dump, get_local_path
 from mmengine.logging import MMLogger
 from terminaltables import AsciiTable
 
-from mmdet.datasets.api_wrappers import COCO, COCOeval, COCOevalMP
+from mmdet.datasets.api_wrappers import (COCO, COCOeval, COCOevalFast,
+                                         COCOevalMP)
 from mmdet.registry import METRICS
 from mmdet.structures.mask import encode_mask_results
-from ..functional import eval_recalls
+from ..functional import BackgroundWorker, eval_recalls
 
 
 @METRICS.register_module()
@@ -49,7 +52,8 @@ class CocoMetric(BaseMetric):
             Defaults to False.
         outfile_prefix (str, optional): The prefix of json files. It includes
             the file path and the prefix of filename, e.g., "a/b/prefix".
-            If not specified, a temp file will be created. Defaults to None.
+            If not specified, the predictions are evaluated in memory without
+            writing json files. Defaults to None.
         file_client_args (dict, optional): Arguments to instantiate the
             corresponding backend in mmdet <= 3.0.0rc6. Defaults to None.
         backend_args (dict, optional): Arguments to instantiate the
@@ -64,8 +68,23 @@ class CocoMetric(BaseMetric):
         sort_categories (bool): Whether sort categories in annotations. Only
             used for `Objects365V1Dataset`. Defaults to False.
         use_mp_eval (bool): Whether to use mul-processing evaluation
+        mp_eval_nproc (int): Number of processes of the multi-processing
+            evaluation. Defaults to 8.
+        use_fast_eval (bool): Whether to evaluate 'bbox' and 'proposal' with
+            the vectorized ``COCOevalFast``, which takes the predictions as
+            arrays and gives the same results as ``COCOeval``.
+            Defaults to False.
+        streaming (bool): Whether to match the 'bbox' and 'proposal'
+            predictions of each batch with ``COCOevalFast`` in a background
+            thread during testing. Only the compact matching results are
+            kept instead of the predictions, and the metrics are the same.
+            Requires ``ann_file``, and does not support 'segm',
+            'proposal_fast', ``format_only`` or ``outfile_prefix``.
+            Defaults to False.
     """
     default_prefix: Optional[str] = 'coco'
+    # number of results written to the json files at a time
+    json_chunk_size: int = 65536
 
     def __init__(self,
                  ann_file: Optional[str] = None,
@@ -81,7 +100,10 @@ class CocoMetric(BaseMetric):
                  collect_device: str = 'cpu',
                  prefix: Optional[str] = None,
                  sort_categories: bool = False,
-                 use_mp_eval: bool = False) -> None:
+                 use_mp_eval: bool = False,
+                 mp_eval_nproc: int = 8,
+                 use_fast_eval: bool = False,
+                 streaming: bool = False) -> None:
         super().__init__(collect_device=collect_device, prefix=prefix)
         # coco evaluation metrics
         self.metrics = metric if isinstance(metric, list) else [metric]
@@ -96,6 +118,21 @@ class CocoMetric(BaseMetric):
         self.classwise = classwise
         # whether to use multi processing evaluation, default False
         self.use_mp_eval = use_mp_eval
+        self.mp_eval_nproc = mp_eval_nproc
+        # whether to use the vectorized bbox evaluation, default False
+        self.use_fast_eval = use_fast_eval
+        # whether to match the predictions while testing, default False
+        self.streaming = streaming
+        self._stream_worker = BackgroundWorker(
+            self._match_results) if streaming else None
+        self._stream_evals = dict()
+        if streaming:
+            assert ann_file is not None, \
+                '`ann_file` is required by the streaming evaluation'
+            assert set(self.metrics) <= {'bbox', 'proposal'}, \
+                "streaming evaluation only supports 'bbox' and 'proposal'"
+            assert not format_only and outfile_prefix is None, \
+                'streaming evaluation does not keep the predictions to dump'
 
         # proposal_nums used to compute recall or precision.
         self.proposal_nums = list(proposal_nums)
@@ -207,6 +244,98 @@ class CocoMetric(BaseMetric):
             _bbox[3] - _bbox[1],
         ]
 
+    def results2arrays(self, results: Sequence[dict]) -> tuple:
+        """Concatenate the bbox results of all images into COCO style
+        arrays.
+
+        Args:
+            results (Sequence[dict]): Testing results of the
+                dataset.
+
+        Returns:
+            tuple[np.ndarray]: Image ids (N, ), boxes (N, 4) in ``xywh``
+            order, scores (N, ) and category ids (N, ) of all the
+            detections.
+        """
+        img_ids = np.concatenate([
+            np.full(len(result['labels']), result.get('img_id', idx),
+                    dtype=np.int64) for idx, result in enumerate(results)
+        ])
+        bboxes = np.concatenate([
+            result['bboxes'].reshape(-1, 4) for result in results
+        ]).astype(np.float64)
+        bboxes[:, 2:] -= bboxes[:, :2]
+        scores = np.concatenate([result['scores'] for result in results
+                                 ]).astype(np.float64)
+        labels = np.concatenate([result['labels'] for result in results
+                                 ]).astype(np.int64)
+        cat_ids = np.asarray(self.cat_ids, dtype=np.int64)[labels]
+        return img_ids, bboxes, scores, cat_ids
+
+    def results2segm(self,
+                     results: Sequence[dict],
+                     with_bbox: bool = True) -> Iterator[List[dict]]:
+        """Convert the mask results to COCO style result dicts, in chunks of
+        at most ``json_chunk_size`` dicts.
+
+        Args:
+            results (Sequence[dict]): Testing results of the
+                dataset.
+            with_bbox (bool): Whether to add the ``bbox`` of each instance.
+                Defaults to True.
+
+        Yields:
+            List[dict]: COCO style mask results.
+        """
+        chunk = []
+        for idx, result in enumerate(results):
+            image_id = result.get('img_id', idx)
+            labels = result['labels']
+            masks = result['masks']
+            mask_scores = result.get('mask_scores', result['scores'])
+            if with_bbox:
+                bboxes = result['bboxes'].reshape(-1, 4).astype(np.float64)
+                bboxes[:, 2:] -= bboxes[:, :2]
+                bboxes = bboxes.tolist()
+            for i, (score, label) in enumerate(
+                    zip(mask_scores.tolist(), labels.tolist())):
+                data = dict()
+                data['image_id'] = image_id
+                if with_bbox:
+                    data['bbox'] = bboxes[i]
+                data['score'] = float(score)
+                data['category_id'] = self.cat_ids[label]
+                if isinstance(masks[i]['counts'], bytes):
+                    masks[i]['counts'] = masks[i]['counts'].decode()
+                data['segmentation'] = masks[i]
+                chunk.append(data)
+                if len(chunk) == self.json_chunk_size:
+                    yield chunk
+                    chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def dump_json_chunks(self, chunks: Iterable[List[dict]],
+                         json_file: str) -> None:
+        """Write a json list chunk by chunk, so that only one chunk of result
+        dicts is kept in memory.
+
+        Args:
+            chunks (Iterable[List[dict]]): Chunks of the list.
+            json_file (str): Path of the json file.
+        """
+        with open(json_file, 'w') as f:
+            f.write('[')
+            first = True
+            for chunk in chunks:
+                if len(chunk) == 0:
+                    continue
+                if not first:
+                    f.write(', ')
+                f.write(json.dumps(chunk)[1:-1])
+                first = False
+            f.write(']')
+
     def results2json(self, results: Sequence[dict],
                      outfile_prefix: str) -> dict:
         """Dump the detection results to a COCO style json file.
@@ -214,6 +343,8 @@ class CocoMetric(BaseMetric):
         There are 3 types of results: proposals, bbox predictions, mask
         predictions, and they have different data types. This method will
         automatically recognize the type, and dump them to json files.
+        The boxes of all images are converted at once, and the files are
+        written in chunks of ``json_chunk_size`` results.
 
         Args:
             results (Sequence[dict]): Testing results of the
@@ -227,47 +358,33 @@ class CocoMetric(BaseMetric):
             dict: Possible keys are "bbox", "segm", "proposal", and
             values are corresponding filenames.
         """
-        bbox_json_results = []
-        segm_json_results = [] if 'masks' in results[0] else None
-        for idx, result in enumerate(results):
-            image_id = result.get('img_id', idx)
-            labels = result['labels']
-            bboxes = result['bboxes']
-            scores = result['scores']
-            # bbox results
-            for i, label in enumerate(labels):
-                data = dict()
-                data['image_id'] = image_id
-                data['bbox'] = self.xyxy2xywh(bboxes[i])
-                data['score'] = float(scores[i])
-                data['category_id'] = self.cat_ids[label]
-                bbox_json_results.append(data)
-
-            if segm_json_results is None:
-                continue
-
-            # segm results
-            masks = result['masks']
-            mask_scores = result.get('mask_scores', scores)
-            for i, label in enumerate(labels):
-                data = dict()
-                data['image_id'] = image_id
-                data['bbox'] = self.xyxy2xywh(bboxes[i])
-                data['score'] = float(mask_scores[i])
-                data['category_id'] = self.cat_ids[label]
-                if isinstance(masks[i]['counts'], bytes):
-                    masks[i]['counts'] = masks[i]['counts'].decode()
-                data['segmentation'] = masks[i]
-                segm_json_results.append(data)
+        img_ids, bboxes, scores, cat_ids = self.results2arrays(results)
+
+        def bbox_chunks():
+            for begin in range(0, len(scores), self.json_chunk_size):
+                end = begin + self.json_chunk_size
+                yield [
+                    dict(
+                        image_id=image_id,
+                        bbox=bbox,
+                        score=score,
+                        category_id=category_id)
+                    for image_id, bbox, score, category_id in zip(
+                        img_ids[begin:end].tolist(),
+                        bboxes[begin:end].tolist(),
+                        scores[begin:end].tolist(),
+                        cat_ids[begin:end].tolist())
+                ]
 
         result_files = dict()
         result_files['bbox'] = f'{outfile_prefix}.bbox.json'
         result_files['proposal'] = f'{outfile_prefix}.bbox.json'
-        dump(bbox_json_results, result_files['bbox'])
+        self.dump_json_chunks(bbox_chunks(), result_files['bbox'])
 
-        if segm_json_results is not None:
+        if 'masks' in results[0]:
             result_files['segm'] = f'{outfile_prefix}.segm.json'
-            dump(segm_json_results, result_files['segm'])
+            self.dump_json_chunks(
+                self.results2segm(results), result_files['segm'])
 
         return result_files
 
@@ -353,6 +470,7 @@ class CocoMetric(BaseMetric):
             data_samples (Sequence[dict]): A batch of data samples that
                 contain annotations and predictions.
         """
+        stream_results = []
         for data_sample in data_samples:
             result = dict()
             pred = data_sample['pred_instances']
@@ -360,6 +478,10 @@ class CocoMetric(BaseMetric):
             result['bboxes'] = pred['bboxes'].cpu().numpy()
             result['scores'] = pred['scores'].cpu().numpy()
             result['labels'] = pred['labels'].cpu().numpy()
+            if self.streaming:
+                # the predictions are matched in the background
+                stream_results.append(result)
+                continue
             # encode mask to RLE
             if 'masks' in pred:
                 result['masks'] = encode_mask_results(
@@ -383,6 +505,50 @@ class CocoMetric(BaseMetric):
             # add converted result to the results list
             self.results.append((gt, result))
 
+        if stream_results:
+            # handle lazy init
+            if self.cat_ids is None:
+                self.cat_ids = self._coco_api.get_cat_ids(
+                    cat_names=self.dataset_meta['classes'])
+            self._stream_worker.submit(stream_results)
+
+    def _match_results(self, results: List[dict]) -> None:
+        """Match the predictions of a batch with ``COCOevalFast``, and keep
+        the compact matching results of each image in ``self.results``.
+
+        Args:
+            results (List[dict]): The predictions of each image.
+        """
+        for metric in self.metrics:
+            if metric not in self._stream_evals:
+                coco_eval = COCOevalFast(self._coco_api)
+                coco_eval.params.catIds = self.cat_ids
+                coco_eval.params.maxDets = list(self.proposal_nums)
+                coco_eval.params.iouThrs = self.iou_thrs
+                coco_eval.params.useCats = int(metric == 'bbox')
+                self._stream_evals[metric] = coco_eval
+        for result in results:
+            img_ids, bboxes, scores, cat_ids = self.results2arrays([result])
+            self.results.append({
+                metric: coco_eval.evaluate_images([result['img_id']], img_ids,
+                                                  bboxes, scores, cat_ids)
+                for metric, coco_eval in self._stream_evals.items()
+            })
+
+    def evaluate(self, size: int) -> dict:
+        """Evaluate the model performance of the whole dataset after
+        processing all batches, waiting for the streaming matching first.
+
+        Args:
+            size (int): Length of the entire validation dataset.
+
+        Returns:
+            dict: Evaluation metrics dict on the val dataset.
+        """
+        if self._stream_worker is not None:
+            self._stream_worker.join()
+        return super().evaluate(size)
+
     def compute_metrics(self, results: list) -> Dict[str, float]:
         """Compute the metrics from processed results.
 
@@ -395,8 +561,9 @@ class CocoMetric(BaseMetric):
         """
         logger: MMLogger = MMLogger.get_current_instance()
 
-        # split gt and prediction list
-        gts, preds = zip(*results)
+        # split gt and prediction list, the streaming results are only the
+        # matching results of each image
+        gts, preds = zip(*results) if not self.streaming else ((), ())
 
         tmp_dir = None
         if self.outfile_prefix is None:
@@ -419,8 +586,10 @@ class CocoMetric(BaseMetric):
         if self.img_ids is None:
             self.img_ids = self._coco_api.get_img_ids()
 
-        # convert predictions to coco format and dump to json file
-        result_files = self.results2json(preds, outfile_prefix)
+        # predictions are passed to the evaluators in memory, the json files
+        # are only written when they are kept
+        if self.format_only or self.outfile_prefix is not None:
+            self.results2json(preds, outfile_prefix)
 
         eval_results = OrderedDict()
         if self.format_only:
@@ -428,6 +597,7 @@ class CocoMetric(BaseMetric):
                         f'{osp.dirname(outfile_prefix)}')
             return eval_results
 
+        det_arrays = None
         for metric in self.metrics:
             logger.info(f'Evaluating {metric}...')
 
@@ -446,30 +616,52 @@ class CocoMetric(BaseMetric):
 
             # evaluate proposal, bbox and segm
             iou_type = 'bbox' if metric == 'proposal' else metric
-            if metric not in result_files:
+            if metric == 'segm' and 'masks' not in preds[0]:
                 raise KeyError(f'{metric} is not in results')
-            try:
-                predictions = load(result_files[metric])
-                if iou_type == 'segm':
+            if iou_type == 'bbox' and not self.streaming:
+                if det_arrays is None:
+                    det_arrays = self.results2arrays(preds)
+                img_ids, bboxes, scores, cat_ids = det_arrays
+                if len(scores) == 0:
+                    logger.error(
+                        'The testing results of the whole dataset is empty.')
+                    break
+            if self.streaming:
+                coco_eval = COCOevalFast(self._coco_api, iouType=iou_type)
+            elif self.use_fast_eval and iou_type == 'bbox':
+                coco_eval = COCOevalFast(self._coco_api, iouType=iou_type)
+                coco_eval.load_dets(img_ids, bboxes, scores, cat_ids)
+            else:
+                if iou_type == 'bbox':
+                    # (N, 7) array of image id, xywh, score and category id
+                    coco_dt = self._coco_api.loadRes(
+                        np.column_stack(
+                            [img_ids, bboxes, scores, cat_ids]).astype(
+                                np.float64))
+                else:
                     # Refer to https://github.com/cocodataset/cocoapi/blob/master/PythonAPI/pycocotools/coco.py#L331  # noqa
                     # When evaluating mask AP, if the results contain bbox,
                     # cocoapi will use the box area instead of the mask area
                     # for calculating the instance area. Though the overall AP
                     # is not affected, this leads to different
                     # small/medium/large mask AP results.
-                    for x in predictions:
-                        x.pop('bbox')
-                coco_dt = self._coco_api.loadRes(predictions)
-
-            except IndexError:
-                logger.error(
-                    'The testing results of the whole dataset is empty.')
-                break
-
-            if self.use_mp_eval:
-                coco_eval = COCOevalMP(self._coco_api, coco_dt, iou_type)
-            else:
-                coco_eval = COCOeval(self._coco_api, coco_dt, iou_type)
+                    predictions = list(
+                        itertools.chain.from_iterable(
+                            self.results2segm(preds, with_bbox=False)))
+                    if len(predictions) == 0:
+                        logger.error('The testing results of the whole '
+                                     'dataset is empty.')
+                        break
+                    coco_dt = self._coco_api.loadRes(predictions)
+
+                if self.use_mp_eval:
+                    coco_eval = COCOevalMP(
+                        self._coco_api,
+                        coco_dt,
+                        iou_type,
+                        nproc=self.mp_eval_nproc)
+                else:
+                    coco_eval = COCOeval(self._coco_api, coco_dt, iou_type)
 
             coco_eval.params.catIds = self.cat_ids
             coco_eval.params.imgIds = self.img_ids
@@ -500,7 +692,11 @@ class CocoMetric(BaseMetric):
 
             if metric == 'proposal':
                 coco_eval.params.useCats = 0
-                coco_eval.evaluate()
+                if self.streaming:
+                    coco_eval.load_matches(
+                        [result[metric] for result in results])
+                else:
+                    coco_eval.evaluate()
                 coco_eval.accumulate()
                 coco_eval.summarize()
                 if metric_items is None:
@@ -514,7 +710,11 @@ class CocoMetric(BaseMetric):
                         f'{coco_eval.stats[coco_metric_names[item]]:.3f}')
                     eval_results[item] = val
             else:
-                coco_eval.evaluate()
+                if self.streaming:
+                    coco_eval.load_matches(
+                        [result[metric] for result in results])
+                else:
+                    coco_eval.evaluate()
                 coco_eval.accumulate()
                 coco_eval.summarize()
                 if self.classwise:  # Compute per-category AP
@@ -9,7 +9,10 @@ from mmengine.evaluator import BaseMetric
 from mmengine.logging import MMLogger
 
 from mmdet.registry import METRICS
-from ..functional import eval_map, eval_recalls
+from ..functional import (BackgroundWorker, eval_map, eval_recalls,
+                          get_cls_eval_result, get_cls_results, get_mean_ap,
+                          print_map_summary, tpfp_default_batched,
+                          tpfp_imagenet_batched)
 
 
 @METRICS.register_module()
@@ -39,6 +42,10 @@ class VOCMetric(BaseMetric):
             names to disambiguate homonymous metrics of different evaluators.
             If prefix is not provided in the argument, self.default_prefix
             will be used instead. Defaults to None.
+        streaming (bool): Whether to match the predictions of each batch in
+            a background thread during testing. Only the compact matching
+            results are kept instead of the predictions, and the mAP is the
+            same. Only supports the 'mAP' metric. Defaults to False.
     """
 
     default_prefix: Optional[str] = 'pascal_voc'
@@ -50,7 +57,8 @@ class VOCMetric(BaseMetric):
                  proposal_nums: Sequence[int] = (100, 300, 1000),
                  eval_mode: str = '11points',
                  collect_device: str = 'cpu',
-                 prefix: Optional[str] = None) -> None:
+                 prefix: Optional[str] = None,
+                 streaming: bool = False) -> None:
         super().__init__(collect_device=collect_device, prefix=prefix)
         self.iou_thrs = [iou_thrs] if isinstance(iou_thrs, float) \
             else iou_thrs
@@ -68,6 +76,13 @@ class VOCMetric(BaseMetric):
         assert eval_mode in ['area', '11points'], \
             'Unrecognized mode, only "area" and "11points" are supported'
         self.eval_mode = eval_mode
+        # whether to match the predictions while testing, default False
+        self.streaming = streaming
+        self._stream_worker = BackgroundWorker(
+            self._match_results) if streaming else None
+        if streaming:
+            assert metric == 'mAP', \
+                "streaming evaluation only supports 'mAP'"
 
     # TODO: data_batch is no longer needed, consider adjusting the
     #  parameter position
@@ -81,6 +96,7 @@ class VOCMetric(BaseMetric):
             data_samples (Sequence[dict]): A batch of data samples that
                 contain annotations and predictions.
         """
+        stream_results = []
         for data_sample in data_samples:
             gt = copy.deepcopy(data_sample)
             # TODO: Need to refactor to support LoadAnnotations
@@ -104,7 +120,148 @@ class VOCMetric(BaseMetric):
                     [pred_bboxes[index], pred_scores[index].reshape((-1, 1))])
                 dets.append(pred_bbox_scores)
 
-            self.results.append((ann, dets))
+            if self.streaming:
+                # the predictions are matched in the background
+                stream_results.append((ann, dets))
+            else:
+                self.results.append((ann, dets))
+
+        if stream_results:
+            self._stream_worker.submit(*zip(*stream_results))
+
+    def _match_results(self, anns: Sequence[dict],
+                       dets: Sequence[list]) -> None:
+        """Match the predictions of a batch as ``eval_map`` does, and keep
+        the compact matching results of each image in ``self.results``.
+
+        Args:
+            anns (Sequence[dict]): The annotations of each image.
+            dets (Sequence[list]): The detected bboxes of each class of each
+                image.
+        """
+        if self.dataset_meta.get('dataset_type') in ['VOC2007', 'VOC2012']:
+            tpfp_fn = tpfp_default_batched
+        else:
+            # the same as eval_map with dataset 'det'
+            tpfp_fn = tpfp_imagenet_batched
+        area_ranges = ([(rg[0]**2, rg[1]**2) for rg in self.scale_ranges]
+                       if self.scale_ranges is not None else None)
+        num_scales = len(area_ranges) if area_ranges is not None else 1
+        empty = np.zeros((len(self.iou_thrs), num_scales, 0), dtype=bool)
+        records = [
+            dict(
+                labels=[np.zeros(0, dtype=np.int64)],
+                scores=[np.zeros(0, dtype=np.float32)],
+                tp=[empty],
+                fp=[empty]) for _ in anns
+        ]
+        for label in range(len(self.dataset_meta['classes'])):
+            num_dets = [img_dets[label].shape[0] for img_dets in dets]
+            if sum(num_dets) == 0:
+                continue
+            cls_dets, cls_gts, cls_gts_ignore = get_cls_results(
+                dets, anns, label)
+            tpfps = [
+                tpfp_fn(cls_dets, cls_gts, cls_gts_ignore, iou_thr,
+                        area_ranges, True) for iou_thr in self.iou_thrs
+            ]
+            # (num_iou_thrs, num_scales, num_dets) of each image
+            splits = np.cumsum(num_dets)[:-1]
+            tps = np.split(
+                np.stack([tp for tp, _ in tpfps]) > 0, splits, axis=2)
+            fps = np.split(
+                np.stack([fp for _, fp in tpfps]) > 0, splits, axis=2)
+            for record, cls_det, tp, fp in zip(records, cls_dets, tps, fps):
+                if cls_det.shape[0] > 0:
+                    record['labels'].append(
+                        np.full(cls_det.shape[0], label, dtype=np.int64))
+                    record['scores'].append(cls_det[:, -1])
+                    record['tp'].append(tp)
+                    record['fp'].append(fp)
+        for ann, record in zip(anns, records):
+            bboxes = ann['bboxes']
+            self.results.append(
+                dict(
+                    labels=np.concatenate(record['labels']),
+                    scores=np.concatenate(record['scores']),
+                    tp=np.concatenate(record['tp'], axis=2),
+                    fp=np.concatenate(record['fp'], axis=2),
+                    gt_labels=ann['labels'],
+                    # the legacy coordinate system, as in compute_metrics
+                    gt_areas=(bboxes[:, 2] - bboxes[:, 0] + 1) *
+                    (bboxes[:, 3] - bboxes[:, 1] + 1)))
+
+    def evaluate(self, size: int) -> dict:
+        """Evaluate the model performance of the whole dataset after
+        processing all batches, waiting for the streaming matching first.
+
+        Args:
+            size (int): Length of the entire validation dataset.
+
+        Returns:
+            dict: Evaluation metrics dict on the val dataset.
+        """
+        if self._stream_worker is not None:
+            self._stream_worker.join()
+        return super().evaluate(size)
+
+    def _eval_stream_map(self, results: list, thr_idx: int,
+                         dataset_name: str, logger: MMLogger) -> tuple:
+        """``eval_map`` on the matching results of the streaming
+        evaluation.
+
+        Args:
+            results (list): The matching results of each image.
+            thr_idx (int): Index of the IoU threshold.
+            dataset_name (str): Dataset name used in the summary.
+            logger (MMLogger): The logger of the summary.
+
+        Returns:
+            tuple: (mAP, [dict, dict, ...])
+        """
+        area_ranges = ([(rg[0]**2, rg[1]**2) for rg in self.scale_ranges]
+                       if self.scale_ranges is not None else None)
+        labels = np.concatenate([res['labels'] for res in results])
+        scores = np.concatenate([res['scores'] for res in results])
+        tp = np.concatenate([res['tp'][thr_idx] for res in results],
+                            axis=1).astype(np.float32)
+        fp = np.concatenate([res['fp'][thr_idx] for res in results],
+                            axis=1).astype(np.float32)
+        gt_labels = np.concatenate([res['gt_labels'] for res in results])
+        gt_areas = np.concatenate([res['gt_areas'] for res in results])
+
+        # group the dets and gts by class, keeping the image order
+        num_classes = len(self.dataset_meta['classes'])
+        det_order = np.argsort(labels, kind='stable')
+        det_bounds = np.searchsorted(labels[det_order],
+                                     np.arange(num_classes + 1))
+        gt_order = np.argsort(gt_labels, kind='stable')
+        gt_bounds = np.searchsorted(gt_labels[gt_order],
+                                    np.arange(num_classes + 1))
+        eval_results = []
+        for i in range(num_classes):
+            inds = det_order[det_bounds[i]:det_bounds[i + 1]]
+            cls_gt_areas = gt_areas[gt_order[gt_bounds[i]:gt_bounds[i + 1]]]
+            if area_ranges is None:
+                num_gts = np.array([len(cls_gt_areas)], dtype=int)
+            else:
+                num_gts = np.array(
+                    [((cls_gt_areas >= min_area) &
+                      (cls_gt_areas < max_area)).sum()
+                     for min_area, max_area in area_ranges],
+                    dtype=int)
+            eval_results.append(
+                get_cls_eval_result(
+                    tp[:, inds],
+                    fp[:, inds],
+                    scores[inds],
+                    num_gts,
+                    scale_ranges=self.scale_ranges,
+                    eval_mode=self.eval_mode))
+        mean_ap = get_mean_ap(eval_results, self.scale_ranges)
+        print_map_summary(
+            mean_ap, eval_results, dataset_name, area_ranges, logger=logger)
+        return mean_ap, eval_results
 
     def compute_metrics(self, results: list) -> dict:
         """Compute the metrics from processed results.
@@ -117,7 +274,8 @@ class VOCMetric(BaseMetric):
             and the values are corresponding results.
         """
         logger: MMLogger = MMLogger.get_current_instance()
-        gts, preds = zip(*results)
+        if not self.streaming:
+            gts, preds = zip(*results)
         eval_results = OrderedDict()
         if self.metric == 'mAP':
             assert isinstance(self.iou_thrs, list)
@@ -138,22 +296,26 @@ class VOCMetric(BaseMetric):
                 logger.info(f'Data : {dataset_name}')
 
             mean_aps = []
-            for iou_thr in self.iou_thrs:
+            for i, iou_thr in enumerate(self.iou_thrs):
                 logger.info(f'\n{"-" * 15}iou_thr: {iou_thr}{"-" * 15}')
                 # Follow the official implementation,
                 # http://host.robots.ox.ac.uk/pascal/VOC/voc2012/VOCdevkit_18-May-2011.tar
                 # we should use the legacy coordinate system in mmdet 1.x,
                 # which means w, h should be computed as 'x2 - x1 + 1` and
                 # `y2 - y1 + 1`
-                mean_ap, _ = eval_map(
-                    preds,
-                    gts,
-                    scale_ranges=self.scale_ranges,
-                    iou_thr=iou_thr,
-                    dataset=dataset_name,
-                    logger=logger,
-                    eval_mode=self.eval_mode,
-                    use_legacy_coordinate=True)
+                if self.streaming:
+                    mean_ap, _ = self._eval_stream_map(results, i,
+                                                       dataset_name, logger)
+                else:
+                    mean_ap, _ = eval_map(
+                        preds,
+                        gts,
+                        scale_ranges=self.scale_ranges,
+                        iou_thr=iou_thr,
+                        dataset=dataset_name,
+                        logger=logger,
+                        eval_mode=self.eval_mode,
+                        use_legacy_coordinate=True)
                 mean_aps.append(mean_ap)
                 eval_results[f'AP{int(iou_thr * 100):02d}'] = round(mean_ap, 3)
             eval_results['mAP'] = sum(mean_aps) / len(mean_aps)
@@ -42,6 +42,12 @@ class DynPerceiverBaseline(BaseModule):
 
     def get_last_exited_stage(self):
         return self.dyn_perceiver.get_last_exited_stage()
+
+    def get_last_exited_stages(self):
+        return self.dyn_perceiver.get_last_exited_stages()
+
+    def get_active_levels(self, stage):
+        return self.dyn_perceiver.get_active_levels(stage)
     
     def train(self, mode=True):
         self.dyn_perceiver.train(mode)
@@ -6,7 +6,8 @@ from cs470_logger.cs470_debug_print import cs470_debug_print
 
 @MODELS.register_module()
 class DynPerceiverDownSampling(BaseModule):
-    def __init__(self, init_cfg, test_num, num_classes=1000, **args):
+    def __init__(self, init_cfg, test_num, num_classes=1000, batched_exit=False,
+                 attn_backend='math', attn_query_chunk_size=None, **args):
         super(DynPerceiverDownSampling, self).__init__(init_cfg)
         self.dyn_perceiver = DynPerceiver(
             num_latents=128,
@@ -20,12 +21,16 @@ class DynPerceiverDownSampling(BaseModule):
             with_dwc=True,
             with_z2x=True,
             with_isc=True,
-            zero_padding=False)
+            zero_padding=False,
+            batched_exit=batched_exit,
+            attn_backend=attn_backend,
+            attn_query_chunk_size=attn_query_chunk_size)
         if (init_cfg == None or init_cfg['type'] != 'Pretrained' or init_cfg['checkpoint'] == None or not isinstance(init_cfg['checkpoint'], str)):
             raise 'A pretrained model must be provided.'
         self.test_num = test_num
         self._freeze_stages()
         self.threshold = None
+        self.batched_exit = batched_exit
 
     def forward(self, x):
         y_early3, y_att, y_cnn, y_merge, outs = self.dyn_perceiver.forward(x, threshold=self.threshold)
@@ -68,6 +73,11 @@ class DynPerceiverDownSampling(BaseModule):
         
         #return outs, y_early3, y_att, y_cnn, y_merge
         
+    def forward_all_exits(self, x):
+        # 한 번의 forward로 exit stage 1~4 각각의 feature map list를 구함 (single-pass dynamic evaluation)
+        y_early3, y_att, y_cnn, y_merge, exit_outs = self.dyn_perceiver.forward_all_exits(x)
+        return exit_outs, y_early3, y_att, y_cnn, y_merge
+
     def set_threshold(self, threshold):
         self.threshold = threshold
     
@@ -76,6 +86,15 @@ class DynPerceiverDownSampling(BaseModule):
 
     def get_last_exited_stage(self):
         return self.dyn_perceiver.get_last_exited_stage()
+
+    def get_last_exited_stages(self):
+        return self.dyn_perceiver.get_last_exited_stages()
+
+    def get_active_levels(self, stage):
+        return self.dyn_perceiver.get_active_levels(stage)
+
+    def get_stage_flops(self, input_size):
+        return self.dyn_perceiver.get_stage_flops(input_size)
     
     def train(self, mode=True):
         self.dyn_perceiver.train(mode)
@@ -13,7 +13,7 @@ from mmdet.structures import SampleList
 from mmdet.utils import (InstanceList, OptInstanceList, ConfigType)
 
 from ..utils import images_to_levels, multi_apply, unpack_gt_instances
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import torch.nn.functional as F
 
 
@@ -59,6 +59,7 @@ class DynRetinaHead(AnchorHead):
                          std=0.01,
                          bias_prob=0.01)),
                 loss_dyn: ConfigType = None,
+                 coarse_levels: Tuple[int] = (2, 3, 4),
                  **kwargs
                  ):
         assert stacked_convs >= 0, \
@@ -77,6 +78,45 @@ class DynRetinaHead(AnchorHead):
             self.loss_dyn = MODELS.build(loss_dyn)
         else:
             self.loss_dyn = None
+        # head outputs of inactive (all-zero) levels, which do not depend on
+        # the image. Only used in eval mode.
+        self._zero_level_cache = {}
+        # levels scored first for the coarse exit (P5-P7 by default) and the
+        # score threshold of the exit, see set_coarse_exit_threshold
+        self.coarse_levels = tuple(coarse_levels)
+        self.coarse_exit_threshold = None
+        self.last_coarse_exits = None
+
+    def set_coarse_exit_threshold(self,
+                                  threshold: Optional[float] = None) -> None:
+        """Enable the coarse exit of the head in eval mode.
+
+        The coarse levels are scored first. If the top box score of an
+        image on these levels is at least ``threshold``, the convs of the
+        other (fine) levels are skipped for that image and their scores are
+        filled with a large negative logit, so that only the coarse
+        detections are kept. As anchors on P5-P7 are at least 128 pixels
+        large, a confident coarse score means a confident large object.
+        Only active coarse levels are scored. Inactive levels do not depend
+        on the image, so images whose coarse levels are all inactive (e.g.
+        P5-P7 after an early exit of a zero-padded backbone) never exit.
+
+        Args:
+            threshold (float, optional): Sigmoid score threshold. None
+                disables the coarse exit. Defaults to None.
+        """
+        assert threshold is None or self.use_sigmoid_cls, \
+            'The coarse exit needs sigmoid classification scores.'
+        self.coarse_exit_threshold = threshold
+        self.last_coarse_exits = None
+
+    def train(self, mode: bool = True):
+        self._zero_level_cache.clear()
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._zero_level_cache.clear()
+        super()._load_from_state_dict(*args, **kwargs)
 
     def _init_layers(self):
         """Initialize layers of the head."""
@@ -138,6 +178,161 @@ class DynRetinaHead(AnchorHead):
         # print("cls_score: " + str(list(cls_score.size())))
         # print("bbox_pred: " + str(list(bbox_pred.size())))
         return cls_score, bbox_pred
+
+    def forward(self,
+                x: Tuple[Tensor],
+                active: Optional[List[bool]] = None) -> Tuple[List[Tensor]]:
+        """Forward features from the upstream network.
+
+        Args:
+            x (tuple[Tensor]): Features from the upstream network, each is
+                a 4D-tensor.
+            active (list[bool], optional): Whether each level depends on the
+                image. The outputs of inactive levels are computed once per
+                feature shape and reused. Defaults to None.
+
+        Returns:
+            tuple: A tuple of classification scores and bbox prediction.
+        """
+        if self.coarse_exit_threshold is not None and not self.training:
+            return self.forward_coarse_exit(x, active)
+        if active is None or all(active) or self.training:
+            return multi_apply(self.forward_single, x)
+        cls_scores, bbox_preds = [], []
+        for level, (feat, level_active) in enumerate(zip(x, active)):
+            cls_score, bbox_pred = self._forward_level(level, feat,
+                                                       level_active)
+            cls_scores.append(cls_score)
+            bbox_preds.append(bbox_pred)
+        return cls_scores, bbox_preds
+
+    def _forward_level(self, level: int, feat: Tensor,
+                       level_active: bool) -> Tuple[Tensor, Tensor]:
+        if level_active:
+            return self.forward_single(feat)
+        key = (level, tuple(feat.shape), feat.dtype, feat.device)
+        cached = self._zero_level_cache.get(key)
+        if cached is None:
+            with torch.no_grad():
+                cached = self.forward_single(feat)
+            self._zero_level_cache[key] = cached
+        return cached
+
+    def forward_coarse_exit(
+            self,
+            x: Tuple[Tensor],
+            active: Optional[List[bool]] = None) -> Tuple[List[Tensor]]:
+        """Forward the coarse levels first and the fine levels only for the
+        images which do not exit (see :meth:`set_coarse_exit_threshold`).
+
+        Whether each image of this call exited is stored in
+        ``last_coarse_exits``.
+
+        Args:
+            x (tuple[Tensor]): Features from the upstream network, each is
+                a 4D-tensor.
+            active (list[bool], optional): Whether each level depends on the
+                image. Defaults to None.
+
+        Returns:
+            tuple: A tuple of classification scores and bbox prediction.
+        """
+        if active is None:
+            active = [True] * len(x)
+        outs = [None] * len(x)
+        num_imgs = x[0].size(0)
+        coarse_levels = self.get_active_coarse_levels(len(x), active)
+        if len(coarse_levels) > 0:
+            for level in coarse_levels:
+                outs[level] = self.forward_single(x[level])
+            coarse_scores, _ = self.get_coarse_scores(
+                [outs[level][0] for level in coarse_levels])
+            exit_mask = coarse_scores >= self.coarse_exit_threshold
+        else:
+            exit_mask = x[0].new_zeros(num_imgs, dtype=torch.bool)
+        keep = (~exit_mask).nonzero().squeeze(1)
+        self.last_coarse_exits = exit_mask.tolist()
+
+        for level, feat in enumerate(x):
+            if outs[level] is not None:
+                continue
+            if not active[level] or len(keep) == num_imgs:
+                outs[level] = self._forward_level(level, feat, active[level])
+                continue
+            height, width = feat.shape[-2:]
+            # sigmoid of the filled logit is 0, below any score_thr
+            cls_score = feat.new_full(
+                (num_imgs, self.num_base_priors * self.cls_out_channels,
+                 height, width), -1e4)
+            bbox_pred = feat.new_zeros(
+                (num_imgs, self.num_base_priors * self.bbox_coder.encode_size,
+                 height, width))
+            if len(keep) > 0:
+                cls_score[keep], bbox_pred[keep] = self.forward_single(
+                    feat[keep])
+            outs[level] = (cls_score, bbox_pred)
+        cls_scores, bbox_preds = map(list, zip(*outs))
+        return cls_scores, bbox_preds
+
+    def get_active_coarse_levels(
+            self,
+            num_levels: int,
+            active: Optional[List[bool]] = None) -> List[int]:
+        """Coarse levels which depend on the image.
+
+        Args:
+            num_levels (int): Number of feature levels.
+            active (list[bool], optional): Whether each level depends on the
+                image. None means every level does. Defaults to None.
+
+        Returns:
+            list[int]: Indices of the active coarse levels.
+        """
+        return [
+            level for level in range(num_levels)
+            if level in self.coarse_levels and (active is None
+                                                or active[level])
+        ]
+
+    def get_coarse_scores(
+            self, cls_scores: List[Tensor]) -> Tuple[Tensor, Tensor]:
+        """Top box score and its label of each image.
+
+        Args:
+            cls_scores (list[Tensor]): Cls scores of some levels, each with
+                shape (N, num_anchors * num_classes, H, W).
+
+        Returns:
+            tuple[Tensor, Tensor]: The top sigmoid score and its label, each
+            with shape (N, ).
+        """
+        num_imgs = cls_scores[0].size(0)
+        logits = torch.cat([
+            cls_score.reshape(num_imgs, self.num_base_priors,
+                              self.cls_out_channels, -1).transpose(
+                                  1, 2).flatten(2)
+            for cls_score in cls_scores
+        ], dim=2)
+        max_logits, _ = logits.max(dim=2)
+        top_logits, labels = max_logits.max(dim=1)
+        return top_logits.sigmoid(), labels
+
+    def predict(self,
+                x: Tuple[Tensor],
+                batch_data_samples: SampleList,
+                rescale: bool = False,
+                active: Optional[List[bool]] = None) -> InstanceList:
+        """Same as :meth:`BaseDenseHead.predict`, but skips the convs of
+        inactive levels (see :meth:`forward`)."""
+        batch_img_metas = [
+            data_samples.metainfo for data_samples in batch_data_samples
+        ]
+
+        outs = self(x, active)
+
+        predictions = self.predict_by_feat(
+            *outs, batch_img_metas=batch_img_metas, rescale=rescale)
+        return predictions
     
     def loss(self, x: Tuple[Tensor], batch_data_samples: SampleList, earlyexit_preds = None) -> dict:
         outs = self(x)
@@ -202,7 +397,7 @@ class DynRetinaHead(AnchorHead):
             return dict(loss_cls=losses_cls, loss_bbox=losses_bbox, loss_earlyexit=loss_earlyexit)
 
     def get_earlyexit_target(self, batch_gt_instances: InstanceList) -> Tensor:
-        labels = []
-        for t in batch_gt_instances:
-            labels.append(t.labels.tolist()[0])
-        return F.one_hot(torch.tensor(labels), num_classes=self.num_classes).float().cuda()
\ No newline at end of file
+        """One-hot label of the first gt instance of each image, built on the
+        device of the gt labels."""
+        labels = torch.cat([t.labels[:1] for t in batch_gt_instances])
+        return F.one_hot(labels, num_classes=self.num_classes).float()
\ No newline at end of file
@@ -1,9 +1,10 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 from mmdet.registry import MODELS
-from mmdet.utils import ConfigType, OptConfigType, OptMultiConfig
+from mmdet.utils import (ConfigType, InstanceList, OptConfigType,
+                         OptMultiConfig)
 from .single_stage import SingleStageDetector
 
-from typing import List, Tuple, Union, Dict, OrderedDict
+from typing import List, Optional, Tuple, Union, Dict, OrderedDict
 
 from torch import Tensor
 import torch
@@ -13,14 +14,14 @@ from mmdet.structures import OptSampleList, SampleList
 from mmengine.utils import is_list_of
 
 from mmdet.structures import SampleList
+from mmcv.image import rescale_size
 from mmengine.analysis import get_model_complexity_info
-from mmengine.analysis.print_helper import _format_size
 import numpy as np
+from collections import Counter
 from functools import partial
-from copy import deepcopy
+import time
 from cs470_logger.cs470_print import cs470_print
 import torch.nn as nn
-from mmdet.models.utils.misc import unpack_gt_instances 
 
 @MODELS.register_module()
 class DynRetinaNet(SingleStageDetector):
@@ -31,7 +32,8 @@ class DynRetinaNet(SingleStageDetector):
                  train_cfg: OptConfigType = None,
                  test_cfg: OptConfigType = None,
                  data_preprocessor: OptConfigType = None,
-                 init_cfg: OptMultiConfig = None) -> None:
+                 init_cfg: OptMultiConfig = None,
+                 skip_zero_levels: bool = True) -> None:
         super().__init__(
             backbone=backbone,
             neck=neck,
@@ -50,6 +52,18 @@ class DynRetinaNet(SingleStageDetector):
             self.lambda_factor = 0
         self.metrics = []
         self.classifiy_correct = False
+        self.skip_zero_levels = skip_zero_levels
+        # memoized results of get_stage_flops and get_coarse_exit_flops,
+        # keyed by input (H, W)
+        self._stage_flops_table = {}
+        self._coarse_exit_flops_table = {}
+        self.budget_controller = None
+        # (confidences, corrects, input shapes) of the last predict, see
+        # get_exit_trace
+        self.last_exit_trace = None
+        # whether each image of the last predict took the coarse exit of
+        # the head, None without coarse exit threshold
+        self.last_coarse_exits = None
     
     # Loss functions
     def loss(self, batch_inputs: Tensor,
@@ -99,12 +113,44 @@ class DynRetinaNet(SingleStageDetector):
                 batch_inputs: Tensor,
                 batch_data_samples: SampleList,
                 rescale: bool = True) -> SampleList:
-        x, y_early3, y_att, y_cnn, y_merge = self.extract_feat(batch_inputs)
-        results_list = self.bbox_head.predict(
-            x, batch_data_samples, rescale=rescale)
+        if self.budget_controller is not None:
+            self.set_threshold(self.budget_controller.get_threshold())
+            start = time.perf_counter()
+        groups, y_early3, y_att, y_cnn, y_merge = self.extract_exit_groups(batch_inputs)
+        results_list = [None] * len(batch_data_samples)
+        coarse_exits = [False] * len(batch_data_samples)
+        for sample_idxs, feats, active in groups:
+            group_results = self.bbox_head.predict(
+                feats, [batch_data_samples[i] for i in sample_idxs],
+                rescale=rescale,
+                active=active)
+            for i, results in zip(sample_idxs, group_results):
+                results_list[i] = results
+            if self.bbox_head.coarse_exit_threshold is not None:
+                for i, coarse_exit in zip(sample_idxs,
+                                          self.bbox_head.last_coarse_exits):
+                    coarse_exits[i] = coarse_exit
+        self.last_coarse_exits = coarse_exits \
+            if self.bbox_head.coarse_exit_threshold is not None else None
+        if self.budget_controller is not None:
+            if batch_inputs.is_cuda:
+                torch.cuda.synchronize()
+            self.budget_controller.update(
+                self.backbone.get_last_exited_stages(),
+                time.perf_counter() - start)
         batch_data_samples = self.add_pred_to_datasample(
             batch_data_samples, results_list)
-        self.classifiy_correct = self.get_classifier_correct(y_early3, y_att, y_cnn, y_merge, batch_data_samples)
+        exit_stages = self.backbone.get_last_exited_stages() \
+            if self.backbone.threshold is not None else None
+        confidences, corrects = self.get_exit_trace(
+            (y_early3, y_att, y_cnn, y_merge), batch_data_samples,
+            exit_stages)
+        self.classifiy_correct = self.get_classifier_correct(
+            y_early3, y_att, y_cnn, y_merge, batch_data_samples, corrects)
+        self.last_exit_trace = (confidences, corrects, [
+            tuple(data_sample.batch_input_shape)
+            for data_sample in batch_data_samples
+        ])
         return batch_data_samples
     
     def _forward(
@@ -123,8 +169,13 @@ class DynRetinaNet(SingleStageDetector):
         Returns:
             tuple[list]: A tuple of features from ``bbox_head`` forward.
         """
-        x, _y_early3, _y_att, _y_cnn, _y_merge = self.extract_feat(batch_inputs)
-        results = self.bbox_head.forward(x)
+        groups, _y_early3, _y_att, _y_cnn, _y_merge = self.extract_exit_groups(batch_inputs)
+        if self.is_batched_exit():
+            return tuple(
+                self.bbox_head.forward(feats, active)
+                for _, feats, active in groups)
+        _, x, active = groups[0]
+        results = self.bbox_head.forward(x, active)
         return results
 
     def extract_feat(self, batch_inputs: Tensor) -> Tuple[Tensor]:
@@ -144,69 +195,647 @@ class DynRetinaNet(SingleStageDetector):
         if self.with_neck:
             x = self.neck(x)
         return x, y_early3, y_att, y_cnn, y_merge
+
+    def extract_exit_groups(self, batch_inputs: Tensor) -> tuple:
+        """Extract features of each group of samples sharing an exit.
+
+        With batched early exit, samples whose exits produce the same
+        feature levels are re-batched together. Levels which are all-zero
+        after an early exit are marked inactive, so that the neck and head
+        can skip them (see ``skip_zero_levels``).
+
+        Args:
+            batch_inputs (Tensor): Image tensor with shape (N, C, H ,W).
+
+        Returns:
+            tuple: A list of ``(sample_idxs, features, active)`` groups,
+            where ``active`` is the activity of each feature level or None,
+            followed by the four classifier predictions.
+        """
+        x, y_early3, y_att, y_cnn, y_merge = self.backbone(batch_inputs)
+        if self.is_batched_exit():
+            groups = self.group_exited_feats(
+                x, [self.get_active_levels(stage)
+                    for stage in self.backbone.get_last_exited_stages()])
+        else:
+            stage = self.backbone.get_last_exited_stage() \
+                if self.backbone.threshold is not None else 4
+            active = self.get_active_levels(stage)[:len(x)]
+            groups = [(list(range(batch_inputs.size(0))), tuple(x), active)]
+
+        feat_groups = []
+        for sample_idxs, feats, active in groups:
+            feats, active = self.forward_neck(feats, active)
+            feat_groups.append((sample_idxs, feats, active))
+        return feat_groups, y_early3, y_att, y_cnn, y_merge
+
+    def forward_neck(self, feats: Tuple[Tensor],
+                     active: List[bool]) -> Tuple[Tuple[Tensor], list]:
+        """Forward the neck, skipping inactive levels if possible.
+
+        Args:
+            feats (tuple[Tensor]): Backbone features.
+            active (list[bool]): Activity of each backbone level.
+
+        Returns:
+            tuple: Neck features and the activity of each output level, or
+            None if every level has to be computed.
+        """
+        if not self.skip_zero_levels or all(active):
+            active = None
+        if self.with_neck:
+            if hasattr(self.neck, 'get_active_outs'):
+                feats = self.neck(feats, active)
+                active = self.neck.get_active_outs(active)
+            else:
+                feats = self.neck(feats)
+                active = None
+        return feats, active
+
+    def test_step_all_exits(self, data: Union[dict, tuple, list]) -> tuple:
+        """Preprocess a test batch and predict it at every exit stage.
+
+        Returns:
+            tuple: The preprocessed data samples followed by the outputs of
+            :meth:`predict_all_exits`.
+        """
+        data = self.data_preprocessor(data, False)
+        return (data['data_samples'],
+                *self.predict_all_exits(data['inputs'], data['data_samples']))
+
+    def predict_all_exits(self,
+                          batch_inputs: Tensor,
+                          batch_data_samples: SampleList,
+                          rescale: bool = True) -> tuple:
+        """Predict results as if every sample exited at each stage.
+
+        The backbone runs once without threshold. Since the features up to a
+        stage do not depend on whether the network exits there, the
+        detections of all four exit stages and the predictions of all
+        classifiers come from this single pass. Any threshold vector can
+        then be replayed offline with :meth:`get_exit_stages`.
+
+        Args:
+            batch_inputs (Tensor): Inputs with shape (N, C, H, W).
+            batch_data_samples (List[:obj:`DetDataSample`]): The Data
+                Samples.
+            rescale (bool): Whether to rescale the results.
+                Defaults to True.
+
+        Returns:
+            tuple: ``stage_results`` where ``stage_results[k][i]`` is the
+            :obj:`InstanceData` of the i-th sample when exiting at stage
+            ``k + 1``, followed by the four classifier predictions.
+        """
+        exit_outs, y_early3, y_att, y_cnn, y_merge = \
+            self.backbone.forward_all_exits(batch_inputs)
+        stage_results = [
+            self.predict_exited(x, stage, batch_data_samples, rescale)
+            for stage, x in enumerate(exit_outs, start=1)
+        ]
+        return stage_results, y_early3, y_att, y_cnn, y_merge
+
+    def predict_exited(self,
+                       x: List[Tensor],
+                       stage: int,
+                       batch_data_samples: SampleList,
+                       rescale: bool = True) -> InstanceList:
+        """Predict results from the backbone features of samples which
+        all exited at ``stage``.
+
+        Args:
+            x (list[Tensor]): Backbone features returned when exiting at
+                ``stage``.
+            stage (int): The exit stage (1~4).
+            batch_data_samples (List[:obj:`DetDataSample`]): The Data
+                Samples.
+            rescale (bool): Whether to rescale the results.
+                Defaults to True.
+
+        Returns:
+            list[:obj:`InstanceData`]: Detection results of each sample.
+        """
+        feats, active = self.forward_neck(
+            tuple(x), self.get_active_levels(stage)[:len(x)])
+        return self.bbox_head.predict(
+            feats, batch_data_samples, rescale=rescale, active=active)
+
+    @staticmethod
+    def get_exit_stages(classifier_preds: Tuple[Tensor],
+                        thresholds: Tensor) -> Tensor:
+        """Exit stage of each sample under each threshold vector.
+
+        Args:
+            classifier_preds (tuple[Tensor]): ``y_early3, y_att, y_cnn,
+                y_merge``, each with shape (N, num_classes).
+            thresholds (Tensor): Threshold vectors with shape (T, 4).
+
+        Returns:
+            Tensor: Exit stages (1~4) with shape (T, N).
+        """
+        max_preds = torch.stack(
+            [pred.softmax(dim=1).max(dim=1)[0] for pred in classifier_preds])
+        thresholds = thresholds.to(max_preds)
+        exit_mask = max_preds.unsqueeze(0) >= thresholds.unsqueeze(-1)
+        # the last classifier always exits
+        exit_mask[:, -1] = True
+        # index of the first exiting classifier
+        return exit_mask.to(torch.uint8).argmax(dim=1) + 1
+
+    def get_exit_trace(self,
+                       classifier_preds: Tuple[Tensor],
+                       batch_data_samples: SampleList,
+                       exit_stages: Optional[List[int]] = None) -> tuple:
+        """Confidence and correctness of every classifier for each sample.
+
+        Args:
+            classifier_preds (tuple[Tensor]): ``y_early3, y_att, y_cnn,
+                y_merge``, each with shape (N, num_classes).
+            batch_data_samples (List[:obj:`DetDataSample`]): The Data
+                Samples with ``gt_instances``.
+            exit_stages (list[int], optional): Exit stage of each sample.
+                Classifiers after it were not computed, so their confidence
+                is NaN and they are not correct. Defaults to None, meaning
+                that every classifier was computed.
+
+        Returns:
+            tuple[Tensor, Tensor]: The max softmax of each classifier and
+            whether its prediction is the target label, each with shape
+            (N, 4).
+        """
+        probs = torch.stack([pred.softmax(dim=1) for pred in classifier_preds],
+                            dim=1)
+        confidences, preds = probs.max(dim=2)
+        targets = self.get_target_tensor(batch_data_samples).to(preds.device)
+        corrects = preds == targets.unsqueeze(1)
+        if exit_stages is not None:
+            stages = torch.arange(1, 5, device=preds.device)
+            reached = stages.unsqueeze(0) <= preds.new_tensor(
+                exit_stages).unsqueeze(1)
+            confidences = confidences.masked_fill(~reached, float('nan'))
+            corrects &= reached
+        return confidences, corrects
+
+    def get_sample_flops(self,
+                         input_shapes: List[Tuple[int, int]],
+                         exit_stages: List[int],
+                         coarse_exits: Optional[List[bool]] = None
+                         ) -> List[int]:
+        """FLOPs of each sample given its padded input shape and exit stage,
+        from the memoized :meth:`get_stage_flops`.
+
+        Args:
+            input_shapes (list[tuple[int, int]]): Padded input (H, W) of
+                each sample.
+            exit_stages (list[int]): Exit stage (1~4) of each sample.
+            coarse_exits (list[bool], optional): Whether each sample took
+                the coarse exit of the head, as returned by
+                :meth:`get_last_coarse_exits`. The head convs it skipped
+                (see :meth:`get_coarse_exit_flops`) are not counted.
+                Defaults to None.
+
+        Returns:
+            list[int]: FLOPs of each sample.
+        """
+        flops = [
+            self.get_stage_flops(input_shape)[stage - 1]
+            for input_shape, stage in zip(input_shapes, exit_stages)
+        ]
+        if coarse_exits is not None:
+            flops = [
+                sample_flops -
+                self.get_coarse_exit_flops(input_shape)[stage - 1]
+                if coarse_exit else sample_flops
+                for sample_flops, input_shape, stage, coarse_exit in zip(
+                    flops, input_shapes, exit_stages, coarse_exits)
+            ]
+        return flops
+
+    def get_active_levels(self, stage: int) -> List[bool]:
+        """Whether each backbone level was computed when exiting at
+        ``stage``."""
+        if hasattr(self.backbone, 'get_active_levels'):
+            return self.backbone.get_active_levels(stage)
+        return [True] * 4
+
+    def is_batched_exit(self) -> bool:
+        """Whether the backbone returns per-sample feature lists."""
+        return getattr(self.backbone, 'batched_exit', False) and \
+            self.backbone.threshold is not None
+
+    @staticmethod
+    def group_exited_feats(sample_feats: List[List[Tensor]],
+                           sample_active: List[List[bool]]) -> list:
+        """Re-batch per-sample feature lists by their active levels.
+
+        Samples which exited at stages producing the same feature levels
+        share the neck and head forward.
+
+        Args:
+            sample_feats (list[list[Tensor]]): Feature maps of each sample,
+                each with shape (1, C, H, W).
+            sample_active (list[list[bool]]): Activity of each backbone level
+                of each sample.
+
+        Returns:
+            list[tuple[list[int], tuple[Tensor], list[bool]]]: Sample
+            indices, batched multi-level features and level activity of each
+            group.
+        """
+        groups = {}
+        for i, (feats, active) in enumerate(zip(sample_feats, sample_active)):
+            groups.setdefault(tuple(active[:len(feats)]), []).append(i)
+        return [(sample_idxs,
+                 tuple(
+                     torch.cat([sample_feats[i][level] for i in sample_idxs])
+                     for level in range(len(active))),
+                 list(active))
+                for active, sample_idxs in groups.items()]
     
     # Helper Functions
-    def get_dynamic_flops(self, data_loader, num_images=10):
+    def get_dynamic_flops(self, data_loader, num_images=10,
+                          measure_latency=False):
+        """FLOPs per image of each exit stage, averaged over the input
+        shapes of ``data_loader``.
+
+        The FLOPs of a shape come from :meth:`get_stage_flops`, which is
+        memoized, so only the distinct input shapes are ever computed.
+
+        Args:
+            data_loader (DataLoader): Data loader whose inputs are counted.
+            num_images (int): Number of batches to load when the input shapes
+                cannot be derived from the dataset annotations.
+                Defaults to 10.
+            measure_latency (bool): Whether to also log the latency of each
+                exit stage with and without ``skip_zero_levels``.
+                Defaults to False.
+
+        Returns:
+            Tensor: FLOPs of exiting at each of the four stages.
+        """
+        input_shapes = self.get_input_shapes(data_loader, num_images)
+        num_inputs = sum(input_shapes.values())
+        flops = torch.zeros(4, dtype=torch.float64)
+        for input_shape, count in input_shapes.items():
+            flops += torch.tensor(
+                self.get_stage_flops(input_shape), dtype=torch.float64) * count
+        flops = (flops / num_inputs).long()
+        cs470_print(f"Flops per early exiting stages: {flops.tolist()} "
+                    f"({len(input_shapes)} input shapes, {num_inputs} images)")
+        if measure_latency:
+            self.log_dynamic_latency(data_loader, num_images)
+        return flops
+
+    def get_stage_flops(self, input_shape: Tuple[int, int]) -> List[int]:
+        """FLOPs of one image of ``input_shape`` exiting at each stage.
+
+        The backbone part comes from ``DynPerceiver.forward_calc_flops``.
+        The neck and head part is the sum of the convolutions run when
+        exiting at each stage, so levels skipped by ``skip_zero_levels`` are
+        not counted. A backbone without early exit (e.g.
+        ``DynPerceiverBaseline``) lacks ``get_stage_flops`` and
+        ``forward_all_exits``; the whole model is then counted by the
+        ``FlopAnalyzer`` and every stage costs the same. The coarse exit of
+        the head is disabled while counting, its savings are given by
+        :meth:`get_coarse_exit_flops`. Results are memoized per input shape.
+
+        Args:
+            input_shape (tuple[int, int]): Padded input (H, W).
+
+        Returns:
+            list[int]: FLOPs of exiting at each of the four stages.
+        """
+        input_shape = tuple(input_shape)
+        if input_shape in self._stage_flops_table:
+            return self._stage_flops_table[input_shape]
+        can_exit = hasattr(self.backbone, 'get_stage_flops') and hasattr(
+            self.backbone, 'forward_all_exits')
+        if can_exit:
+            backbone_flops = self.backbone.get_stage_flops(input_shape)
+
+        modes = [(m, m.training) for m in self.modules()]
+        self.eval()
+        # set directly, so that the last coarse exits of the head are kept
+        coarse_exit_threshold = getattr(self.bbox_head,
+                                        'coarse_exit_threshold', None)
+        if coarse_exit_threshold is not None:
+            self.bbox_head.coarse_exit_threshold = None
+        try:
+            with torch.no_grad():
+                x = next(self.backbone.parameters()).new_zeros(
+                    1, 3, *input_shape)
+                if can_exit:
+                    exit_outs = self.backbone.forward_all_exits(x)[0]
+                else:
+                    # fill the zero level caches first, as below
+                    self._forward(x)
+                    model_flops = get_model_complexity_info(
+                        self,
+                        None,
+                        inputs=x,
+                        show_table=False,
+                        show_arch=False)['flops']
+                    exit_outs = [self.backbone(x)[0]] * 4
+                neck_head_flops, coarse_exit_flops = [], []
+                for stage, outs in enumerate(exit_outs, start=1):
+                    active = self.get_active_levels(stage)[:len(outs)]
+                    forward = partial(self._forward_neck_head, tuple(outs),
+                                      active)
+                    # fill the zero level caches first, so that only the image
+                    # dependent part is counted
+                    forward()
+                    neck_head_flops.append(self.count_conv_flops(forward))
+                    coarse_exit_flops.append(
+                        self._count_coarse_exit_flops(tuple(outs), active))
+        finally:
+            for m, mode in modes:
+                m.training = mode
+            if coarse_exit_threshold is not None:
+                self.bbox_head.coarse_exit_threshold = coarse_exit_threshold
+
+        if can_exit:
+            stage_flops = [
+                int(backbone) + neck_head
+                for backbone, neck_head in zip(backbone_flops,
+                                               neck_head_flops)
+            ]
+        else:
+            stage_flops = [int(model_flops)] * 4
+        self._stage_flops_table[input_shape] = stage_flops
+        self._coarse_exit_flops_table[input_shape] = coarse_exit_flops
+        return stage_flops
+
+    def get_coarse_exit_flops(self, input_shape: Tuple[int, int]) -> List[int]:
+        """FLOPs skipped by the coarse exit of the head for one image of
+        ``input_shape`` exiting at each stage.
+
+        A coarse exit skips the head convs of the active fine levels (P3/P4
+        by default). It is only possible when a coarse level is active, so
+        the FLOPs are 0 at the other stages. Memoized with
+        :meth:`get_stage_flops`.
+
+        Args:
+            input_shape (tuple[int, int]): Padded input (H, W).
+
+        Returns:
+            list[int]: Skipped FLOPs at each of the four stages.
+        """
+        input_shape = tuple(input_shape)
+        if input_shape not in self._coarse_exit_flops_table:
+            self.get_stage_flops(input_shape)
+        return self._coarse_exit_flops_table[input_shape]
+
+    def _count_coarse_exit_flops(self, feats: Tuple[Tensor],
+                                 active: List[bool]) -> int:
+        feats, active = self.forward_neck(feats, active)
+        if not hasattr(self.bbox_head, 'get_active_coarse_levels') or \
+                not self.bbox_head.get_active_coarse_levels(
+                    len(feats), active):
+            return 0
+        fine_levels = [
+            level for level in range(len(feats))
+            if level not in self.bbox_head.coarse_levels and (
+                active is None or active[level])
+        ]
+        return sum(
+            self.count_conv_flops(
+                partial(self.bbox_head.forward_single, feats[level]))
+            for level in fine_levels)
+
+    def _forward_neck_head(self, feats: Tuple[Tensor],
+                           active: List[bool]) -> tuple:
+        feats, active = self.forward_neck(feats, active)
+        return self.bbox_head.forward(feats, active)
+
+    def count_conv_flops(self, forward) -> int:
+        """Count the FLOPs (multiply-adds) of the convolutions run by
+        ``forward``. Norms and activations are negligible and not counted.
+        """
+        flops = []
+
+        def hook(module, inputs, output):
+            kernel_h, kernel_w = module.kernel_size
+            flops.append(output.numel() * kernel_h * kernel_w *
+                         module.in_channels // module.groups)
+
+        handles = [
+            m.register_forward_hook(hook) for m in self.modules()
+            if isinstance(m, nn.Conv2d)
+        ]
+        try:
+            forward()
+        finally:
+            for handle in handles:
+                handle.remove()
+        return sum(flops)
+
+    def get_input_shapes(self, data_loader, num_images=10) -> Counter:
+        """Count the padded input shapes (H, W) of ``data_loader``.
+
+        The shapes are derived from the image sizes in the annotations and
+        the ``Resize`` of the dataset pipeline without loading any image.
+        Otherwise, the first ``num_images`` batches are loaded.
+        """
+        dataset = data_loader.dataset
+        resize = None
+        for transform in getattr(dataset.pipeline, 'transforms', []):
+            if type(transform).__name__ == 'Resize':
+                resize = transform
+        divisor = getattr(self.data_preprocessor, 'pad_size_divisor', 1)
+        input_shapes = Counter()
+        if resize is not None and resize.scale is not None:
+            for idx in range(len(dataset)):
+                data_info = dataset.get_data_info(idx)
+                if 'width' not in data_info or 'height' not in data_info:
+                    input_shapes.clear()
+                    break
+                if resize.keep_ratio:
+                    w, h = rescale_size(
+                        (data_info['width'], data_info['height']),
+                        resize.scale)
+                else:
+                    w, h = resize.scale
+                input_shapes[(int(np.ceil(h / divisor)) * divisor,
+                              int(np.ceil(w / divisor)) * divisor)] += 1
+            if len(input_shapes) > 0:
+                return input_shapes
+
+        for idx, data_batch in enumerate(data_loader):
+            if idx == num_images:
+                break
+            data = self.data_preprocessor(data_batch)
+            input_shapes[tuple(data['inputs'].shape[-2:])] += \
+                data['inputs'].size(0)
+        return input_shapes
+
+    def log_dynamic_latency(self, data_loader, num_images=10):
+        """Log the latency of each exit stage with and without
+        ``skip_zero_levels``."""
+        if not self.skip_zero_levels:
+            return
         thresholds = torch.tensor([
             [-1, 10, 10, 10],
             [10, -1, 10, 10],
             [10, 10, -1, 10],
             [10, 10, 10, -1]
         ])
-        flops_list = []
-        model = deepcopy(self)
-        model.eval()
-        model.forward = partial(model._forward)
-
-        for threshold in thresholds:
-            model.set_threshold(threshold)
-            avg_flops = []
-            for idx, data_batch in enumerate(data_loader):
-                if idx == num_images:
-                    break
-                data = model.data_preprocessor(data_batch)
-                outputs = get_model_complexity_info(
-                    model,
-                    None,
-                    inputs=data['inputs'],
-                    show_table=False,
-                    show_arch=False)
-                avg_flops.append(outputs['flops'])
-
-            mean_flops = int(np.average(avg_flops))
-            flops_list.append(mean_flops)
-            model.unset_threshold()
-        flops = torch.tensor(flops_list)
-        cs470_print("Flops per early exiting stages: " + str(flops.tolist()))
-        return flops
+        modes = [(m, m.training) for m in self.modules()]
+        self.eval()
+        try:
+            for stage, threshold in enumerate(thresholds):
+                self.set_threshold(threshold)
+                latency, latency_full = [], []
+                for idx, data_batch in enumerate(data_loader):
+                    if idx == num_images:
+                        break
+                    data = self.data_preprocessor(data_batch)
+                    latency.append(
+                        self._measure_latency(self, data['inputs']))
+                    self.skip_zero_levels = False
+                    latency_full.append(
+                        self._measure_latency(self, data['inputs']))
+                    self.skip_zero_levels = True
+                self.unset_threshold()
+                mean_latency = np.average(latency) * 1e3
+                mean_latency_full = np.average(latency_full) * 1e3
+                cs470_print(f"Exiting stage {stage + 1}: {mean_latency:.1f}ms with zero level skipping, "
+                            f"{mean_latency_full:.1f}ms without (speedup {mean_latency_full / mean_latency:.2f}x)")
+        finally:
+            for m, mode in modes:
+                m.training = mode
+
+    @staticmethod
+    @torch.no_grad()
+    def _measure_latency(model, inputs, num_iters=3):
+        model._forward(inputs)
+        if inputs.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            model._forward(inputs)
+        if inputs.is_cuda:
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / num_iters
     
+    def attach_budget_controller(self, budget_controller) -> None:
+        """Let ``budget_controller`` choose the threshold of every
+        :meth:`predict` call.
+
+        Args:
+            budget_controller (:obj:`BudgetController`): Controller picking
+                among the calibrated thresholds to meet a FLOPs or latency
+                budget per second. The caller reports the request arrivals
+                with ``budget_controller.observe_arrivals``, since the
+                interval between :meth:`predict` calls is the throughput,
+                not the arrival rate. None detaches the current one.
+        """
+        self.budget_controller = budget_controller
+        if budget_controller is None:
+            self.unset_threshold()
+
     def set_threshold(self, threshold):
         self.backbone.set_threshold(threshold)
     
     def unset_threshold(self):
         self.backbone.unset_threshold()
 
-    def get_classifier_correct(self, y_early3, y_att, y_cnn, y_merge, batch_data_samples: SampleList):
-        assert y_early3.size()[0] == 1 and y_att.size()[0] == 1 and y_cnn.size()[0] == 1 and y_merge.size()[0] == 1
-        softmax = nn.Softmax(dim=1).cuda()
-        classifiers = [softmax(y_early3).squeeze(0), softmax(y_att).squeeze(0), softmax(y_cnn).squeeze(0), softmax(y_merge).squeeze(0)]
-        thresholds = self.backbone.threshold
-        if thresholds is not None:
-            for i in range(4):
-                classifier = classifiers[i]
-                threshold = thresholds[i]
-                if (classifier.max().item() >= threshold.item()):
-                    return classifier.argmax().item() == self.get_target_labels(batch_data_samples)[0]
-            return False
-        else:
-            return classifiers[3].argmax().item() == self.get_target_labels(batch_data_samples)[0]
+    def set_head_threshold(self, threshold):
+        """Set the coarse exit threshold of the head (see
+        ``DynRetinaHead.set_coarse_exit_threshold``)."""
+        self.bbox_head.set_coarse_exit_threshold(threshold)
 
+    def unset_head_threshold(self):
+        self.bbox_head.set_coarse_exit_threshold(None)
 
-    def get_target_labels(self, batch_data_samples: SampleList):
-        outputs = unpack_gt_instances(batch_data_samples)
+    def get_last_coarse_exits(self) -> Optional[List[bool]]:
+        """Whether each image of the last :meth:`predict` took the coarse
+        exit of the head, None without coarse exit threshold."""
+        return self.last_coarse_exits
+
+    @torch.no_grad()
+    def get_coarse_scores_all_exits(self, batch_inputs: Tensor) -> tuple:
+        """Top box score and label of each image on the active coarse levels
+        of the head, as if every image exited at each stage. Used to
+        calibrate the coarse exit threshold under any backbone threshold
+        (see :meth:`predict_all_exits`).
 
-        (batch_gt_instances, batch_gt_instances_ignore, batch_img_metas) = outputs
-        labels = []
-        for t in batch_gt_instances:
-            labels.append(t.labels.tolist()[0])
-        return labels
\ No newline at end of file
+        Args:
+            batch_inputs (Tensor): Inputs with shape (N, C, H, W).
+
+        Returns:
+            tuple: Scores and labels, each with shape (4, N), followed by
+            the four classifier predictions. The score is -1 at the stages
+            where no coarse level is active, so those images never exit.
+        """
+        exit_outs, *classifier_preds = \
+            self.backbone.forward_all_exits(batch_inputs)
+        num_imgs = batch_inputs.size(0)
+        scores = batch_inputs.new_full((len(exit_outs), num_imgs), -1.)
+        labels = batch_inputs.new_zeros((len(exit_outs), num_imgs),
+                                        dtype=torch.long)
+        for stage, x in enumerate(exit_outs, start=1):
+            feats, active = self.forward_neck(
+                tuple(x), self.get_active_levels(stage)[:len(x)])
+            levels = self.bbox_head.get_active_coarse_levels(
+                len(feats), active)
+            if len(levels) == 0:
+                continue
+            stage_scores, stage_labels = self.bbox_head.get_coarse_scores([
+                self.bbox_head.forward_single(feats[level])[0]
+                for level in levels
+            ])
+            scores[stage - 1] = stage_scores.to(scores)
+            labels[stage - 1] = stage_labels
+        return (scores, labels, *classifier_preds)
+
+    def get_classifier_correct(self,
+                               y_early3: Tensor,
+                               y_att: Tensor,
+                               y_cnn: Tensor,
+                               y_merge: Tensor,
+                               batch_data_samples: SampleList,
+                               corrects: Optional[Tensor] = None) -> Tensor:
+        """Whether the classifier each sample exits at predicts its target
+        label.
+
+        The exit classifier is the one of the stage the backbone actually
+        exited at (the last one without threshold). Without batched exit,
+        this is the same stage for the whole batch, even for samples which
+        are not confident there. Everything stays on the device of the
+        predictions.
+
+        Args:
+            y_early3, y_att, y_cnn, y_merge (Tensor): Classifier predictions,
+                each with shape (N, num_classes).
+            batch_data_samples (List[:obj:`DetDataSample`]): The Data
+                Samples with ``gt_instances``.
+            corrects (Tensor, optional): Correctness of every classifier with
+                shape (N, 4), as returned by :meth:`get_exit_trace`. Computed
+                if not given. Defaults to None.
+
+        Returns:
+            Tensor: Boolean correctness with shape (N, ).
+        """
+        classifier_preds = (y_early3, y_att, y_cnn, y_merge)
+        if corrects is None:
+            _, corrects = self.get_exit_trace(classifier_preds,
+                                              batch_data_samples)
+        if self.backbone.threshold is None:
+            return corrects[:, -1]
+        # a backbone without early exit reports a single stage
+        stages = torch.as_tensor(
+            self.backbone.get_last_exited_stages(),
+            dtype=torch.long,
+            device=corrects.device).expand(corrects.size(0))
+        return corrects.gather(1, (stages - 1).unsqueeze(1)).squeeze(1)
+
+    def get_target_tensor(self, batch_data_samples: SampleList) -> Tensor:
+        """Label of the first gt instance of each sample, kept on the device
+        of the data samples."""
+        return torch.cat([
+            data_sample.gt_instances.labels[:1]
+            for data_sample in batch_data_samples
+        ])
+
+    def get_target_labels(self, batch_data_samples: SampleList):
+        return self.get_target_tensor(batch_data_samples).tolist()
@@ -5,7 +5,6 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from mmdet.registry import MODELS
-from timm.loss import LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
 
 @MODELS.register_module()
 class DynLoss(nn.Module):
@@ -33,31 +32,38 @@ class DynLoss(nn.Module):
         self.with_kd = with_kd
         self.T_kd=T_kd
         self.alpha_kd=alpha_kd
-
-        if self.mixup_fn is not None:
-            self.criterion = SoftTargetCrossEntropy()
-        elif self.smoothing > 0.:
-            self.criterion = LabelSmoothingCrossEntropy(smoothing=self.smoothing)
-        else:
-            self.criterion = torch.nn.CrossEntropyLoss()
     
     def forward(self, 
                 pred, 
                 target):
-        loss_early3 = self.criterion(pred[0], target)
-        loss_att = self.criterion(pred[1], target)
-        loss_cnn = self.criterion(pred[2], target)
-        loss_merge = self.criterion(pred[3], target)
+        """
+        4개 exit의 logit을 (4, B, C)로 쌓아서 CE와 KD를 한 번에 계산.
+
+        Args:
+            pred : y_early3, y_att, y_cnn, y_merge. 각 (B, C)
+            target : (B, C) soft / one-hot target 또는 (B) class index
+        """
+        logits = torch.stack(pred) # (4, B, C)
+        log_probs = F.log_softmax(logits, dim=2)
+        target = target.to(logits.device)
+        if target.dim() == 1:
+            target = F.one_hot(target, num_classes=logits.size(2)).to(log_probs.dtype)
+        if self.smoothing > 0. and self.mixup_fn is None:
+            # LabelSmoothingCrossEntropy: (1 - s) * nll + s * (-log_probs.mean())
+            target = target * (1. - self.smoothing) + self.smoothing / logits.size(2)
+        # CrossEntropyLoss / SoftTargetCrossEntropy와 같은 -(target * log_softmax).sum().mean()
+        ce = -(target.unsqueeze(0) * log_probs).sum(dim=2).mean(dim=1) # (4)
+        factors = ce.new_tensor([self.loss_att_factor, self.loss_att_factor, self.loss_cnn_factor, self.loss_merge_factor])
+        loss = (factors * ce).sum()
 
-        loss = self.loss_cnn_factor*loss_cnn + self.loss_att_factor*(loss_att+loss_early3) + self.loss_merge_factor*loss_merge
-        
         if self.with_kd:
-            out_teacher = pred[3].detach()
-        
-            kd_loss = F.kl_div(F.log_softmax(pred[0]/self.T_kd, dim=1),F.softmax(out_teacher/self.T_kd, dim=1), reduction='batchmean') * self.T_kd**2 + \
-                    F.kl_div(F.log_softmax(pred[1]/self.T_kd, dim=1),F.softmax(out_teacher/self.T_kd, dim=1), reduction='batchmean') * self.T_kd**2 + \
-                    F.kl_div(F.log_softmax(pred[2]/self.T_kd, dim=1),F.softmax(out_teacher/self.T_kd, dim=1), reduction='batchmean') * self.T_kd**2
+            # teacher (y_merge)의 softmax는 한 번만 계산
+            out_teacher = logits[3].detach() / self.T_kd
+            teacher_probs = F.softmax(out_teacher, dim=1).expand(3, -1, -1)
+            student_log_probs = F.log_softmax(logits[:3] / self.T_kd, dim=2)
+            # 3개 exit의 kl_div(batchmean) 합
+            kd_loss = F.kl_div(student_log_probs, teacher_probs, reduction='sum') / logits.size(1) * self.T_kd**2
 
             loss += self.alpha_kd * kd_loss
 
-        return loss
\ No newline at end of file
+        return loss
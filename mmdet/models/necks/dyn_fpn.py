@@ -1,5 +1,5 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -49,6 +49,12 @@ class DynFPN(BaseModule):
             activation layer in ConvModule. Defaults to None.
         upsample_cfg (:obj:`ConfigDict` or dict, optional): Config dict
             for interpolate layer. Defaults to dict(mode='nearest').
+        static_shapes (bool): Whether the levels missing after an early exit
+            are synthesized by stride-2 pooling of the deepest available
+            lateral. The output shapes are then the same for every exit, as
+            if all backbone levels were given. Otherwise they are nearest
+            downsampled to half (floor) size, which differs from the
+            backbone levels for odd sizes. Defaults to False.
         init_cfg (:obj:`ConfigDict` or dict or list[:obj:`ConfigDict` or \
             dict]): Initialization config dict.
 
@@ -82,6 +88,7 @@ class DynFPN(BaseModule):
         norm_cfg: OptConfigType = None,
         act_cfg: OptConfigType = None,
         upsample_cfg: ConfigType = dict(mode='nearest'),
+        static_shapes: bool = False,
         init_cfg: MultiConfig = dict(
             type='Xavier', layer='Conv2d', distribution='uniform')
     ) -> None:
@@ -95,6 +102,7 @@ class DynFPN(BaseModule):
         self.no_norm_on_lateral = no_norm_on_lateral
         self.fp16_enabled = False
         self.upsample_cfg = upsample_cfg.copy()
+        self.static_shapes = static_shapes
 
         if end_level == -1 or end_level == self.num_ins - 1:
             self.backbone_end_level = self.num_ins
@@ -159,27 +167,45 @@ class DynFPN(BaseModule):
                     inplace=False)
                 self.fpn_convs.append(extra_fpn_conv)
 
-    def forward(self, inputs: Tuple[Tensor]) -> tuple:
+        # outputs of levels computed only from all-zero inputs, which do not
+        # depend on the image. Only used in eval mode.
+        self._zero_level_cache = {}
+
+    def train(self, mode: bool = True):
+        self._zero_level_cache.clear()
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._zero_level_cache.clear()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def forward(self,
+                inputs: Tuple[Tensor],
+                active: Optional[List[bool]] = None) -> tuple:
         """Forward function.
 
         Args:
             inputs (tuple[Tensor]): Features from the upstream network, each
                 is a 4D-tensor.
+            active (list[bool], optional): Whether each input level was
+                actually computed by the backbone. Inactive levels are the
+                all-zero maps padded after an early exit, and must be the
+                deepest ones. Defaults to None, which means all levels are
+                active.
 
         Returns:
             tuple: Feature maps, each is a 4D-tensor.
         """
+        if active is not None and not all(active) and not self.training \
+                and len(inputs) == self.num_ins:
+            return self._forward_partial(inputs, active)
         #assert len(inputs) == len(self.in_channels)
         # len(inputs) == 2 Exiting 1
         # len(inputs) == 3 Exiting 2
         # len(inputs) == 4 Exiting 3, 4 => 건드릴 필요 x
         original_length = len(inputs)
-        # output_fmap_sizes = [[1, 64, 200, 304], [1, 144, 100, 152], [1, 320, 50, 76], [1, 784, 25, 38]]
+        # zero padding은 backbone (DynPerceiver._zero_fmap)에서 처리합니다.
 
-        # #zero padding 구현하는 코드입니다.
-        # for k in range(original_length, 4):
-        #     inputs.append(torch.zeros(output_fmap_sizes[k]).cuda())
-    
         # build laterals
         laterals = [
             lateral_conv(inputs[i + self.start_level])
@@ -189,13 +215,17 @@ class DynFPN(BaseModule):
         if(original_length <= 3):
             used_backbone_levels = len(self.lateral_convs)  # 3
             for i in range(original_length - 2, used_backbone_levels - 1):  # i = 0, 1 for len(inputs) = 2, i = 1 for len(inputs) = 1
-                if 'scale_factor' in self.upsample_cfg:
+                if self.static_shapes:
+                    # backbone level과 같은 ceil(h / 2) x ceil(w / 2) 크기
+                    new_lateral = F.max_pool2d(laterals[i], 1, stride=2)
+                    laterals.append(new_lateral)
+                elif 'scale_factor' in self.upsample_cfg:
                     # Fix runtime error of "+=" inplace operation in PyTorch 1.10
                     new_lateral = F.interpolate(laterals[i], **self.upsample_cfg)
                     laterals.append(new_lateral)
                 else:
                     #아래서 위로 upsamplin하게끔 짜준 코드입니다
-                    new_lateral = F.interpolate(laterals[i], size=(torch.tensor(laterals[i].shape[2:]) / 2).int().tolist(), **self.upsample_cfg)
+                    new_lateral = F.interpolate(laterals[i], size=[size // 2 for size in laterals[i].shape[2:]], **self.upsample_cfg)
                     laterals.append(new_lateral)
         else:
             # 원래 코드라 바뀐 것 없습니다.
@@ -219,6 +249,13 @@ class DynFPN(BaseModule):
             self.fpn_convs[i](laterals[i]) for i in range(used_backbone_levels)
         ] # 3
         # part 2: add extra levels
+        self._add_extra_levels(inputs, laterals, outs, used_backbone_levels)
+        return tuple(outs)
+
+    def _add_extra_levels(self, inputs: Tuple[Tensor], laterals: List[Tensor],
+                          outs: List[Tensor],
+                          used_backbone_levels: int) -> None:
+        """Append the extra output levels to ``outs`` in place."""
         if self.num_outs > len(outs):
             # use max pool to get more levels on top of outputs
             # (e.g., Faster R-CNN, Mask R-CNN)
@@ -241,4 +278,88 @@ class DynFPN(BaseModule):
                         outs.append(self.fpn_convs[i](F.relu(outs[-1])))
                     else:
                         outs.append(self.fpn_convs[i](outs[-1]))
-        return tuple(outs)
+
+    def _upsample(self, x: Tensor, size: torch.Size) -> Tensor:
+        if 'scale_factor' in self.upsample_cfg:
+            return F.interpolate(x, **self.upsample_cfg)
+        return F.interpolate(x, size=size, **self.upsample_cfg)
+
+    def get_active_outs(self, active: Optional[List[bool]]) -> List[bool]:
+        """Whether each output level depends on an active input level.
+
+        Args:
+            active (list[bool], optional): See :meth:`forward`.
+
+        Returns:
+            list[bool]: Activity of each of the ``num_outs`` output levels.
+        """
+        if active is None or all(active) or len(active) != self.num_ins:
+            return [True] * self.num_outs
+        num_active = sum(active[self.start_level:self.backbone_end_level])
+        return [i < num_active for i in range(self.num_outs)]
+
+    def _forward_partial(self, inputs: Tuple[Tensor],
+                         active: List[bool]) -> tuple:
+        """Forward with trailing all-zero input levels.
+
+        Everything computed only from the zero levels (their laterals, their
+        top-down contribution, their FPN convs and the extra levels on top)
+        does not depend on the image, so it is computed once per input shape
+        and cached. Only the active levels are run through the convs.
+        """
+        used_backbone_levels = len(self.lateral_convs)
+        num_active = sum(active[self.start_level:self.backbone_end_level])
+        assert all(active[:self.start_level + num_active]), \
+            'inactive levels must be the deepest ones'
+
+        key = (num_active, ) + tuple(
+            (tuple(feat.shape), feat.dtype, feat.device) for feat in inputs)
+        zero_levels = self._zero_level_cache.get(key)
+        if zero_levels is None:
+            with torch.no_grad():
+                zero_levels = self._forward_zero_levels(
+                    inputs, num_active, used_backbone_levels)
+            self._zero_level_cache[key] = zero_levels
+        topdown, zero_outs = zero_levels
+
+        laterals = [
+            self.lateral_convs[i](inputs[i + self.start_level])
+            for i in range(num_active)
+        ]
+        if num_active > 0:
+            laterals[-1] = laterals[-1] + topdown
+        for i in range(num_active - 1, 0, -1):
+            laterals[i - 1] = laterals[i - 1] + self._upsample(
+                laterals[i], laterals[i - 1].shape[2:])
+        outs = [self.fpn_convs[i](laterals[i]) for i in range(num_active)]
+        return tuple(outs) + zero_outs
+
+    def _forward_zero_levels(self, inputs: Tuple[Tensor], num_active: int,
+                             used_backbone_levels: int) -> tuple:
+        """Compute the image independent part of :meth:`_forward_partial`.
+
+        The result is cached, so it becomes a constant when tracing.
+
+        Returns:
+            tuple: The top-down contribution of the zero levels to the
+            deepest active lateral (None if there is none) and the output
+            levels built only from the zero levels.
+        """
+        laterals = [None] * num_active + [
+            self.lateral_convs[i](inputs[i + self.start_level])
+            for i in range(num_active, used_backbone_levels)
+        ]
+        for i in range(used_backbone_levels - 1, num_active, -1):
+            laterals[i - 1] = laterals[i - 1] + self._upsample(
+                laterals[i], laterals[i - 1].shape[2:])
+        topdown = None
+        if num_active > 0:
+            topdown = self._upsample(
+                laterals[num_active],
+                inputs[num_active - 1 + self.start_level].shape[2:])
+        outs = [None] * num_active + [
+            self.fpn_convs[i](laterals[i])
+            for i in range(num_active, used_backbone_levels)
+        ]
+        self._add_extra_levels(inputs, laterals, outs, used_backbone_levels)
+        return topdown, tuple(outs[num_active:])
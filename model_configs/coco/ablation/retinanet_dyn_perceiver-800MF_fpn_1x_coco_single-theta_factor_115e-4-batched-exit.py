@@ -0,0 +1,4 @@
+_base_ = '../improvements/retinanet_dyn_perceiver-800MF_fpn_1x_coco_single-theta_factor_115e-4.py'
+
+model = dict(backbone=dict(batched_exit=True))
+test_dataloader = dict(batch_size=8)
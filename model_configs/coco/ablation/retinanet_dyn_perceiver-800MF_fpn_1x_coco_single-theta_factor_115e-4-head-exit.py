@@ -0,0 +1,3 @@
+_base_ = '../improvements/retinanet_dyn_perceiver-800MF_fpn_1x_coco_single-theta_factor_115e-4.py'
+
+test_cfg = dict(head_exit_ratio=0.3)
@@ -31,7 +31,8 @@ test_dataloader = dict(
         ann_file='annotations/singlebox_instances_val2017.json',
         data_prefix=dict(img='val_single/')))
 test_evaluator = dict(
-    ann_file='data/coco/annotations/singlebox_instances_val2017.json')
+    ann_file='data/coco/annotations/singlebox_instances_val2017.json',
+    use_fast_eval=True)
 train_dataloader = dict(
     batch_sampler=dict(drop_last=True),
     dataset=dict(
@@ -43,5 +44,6 @@ val_dataloader = dict(
         ann_file='annotations/singlebox_instances_val2017.json',
         data_prefix=dict(img='val_single/')))
 val_evaluator = dict(
-    ann_file='data/coco/annotations/singlebox_instances_val2017.json')
+    ann_file='data/coco/annotations/singlebox_instances_val2017.json',
+    use_fast_eval=True)
 
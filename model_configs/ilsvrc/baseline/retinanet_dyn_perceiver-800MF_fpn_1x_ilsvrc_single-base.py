@@ -33,18 +33,21 @@ dataset_type = 'ILSVRCDataset' # Custom
 test_dataloader = dict(
     dataset=dict(
         ann_file='annotations/filtered_val_xml_files.txt',
+        ann_index='annotations/filtered_val_xml_files_index',
         data_prefix=dict(img='val2014_single/')))
 
 train_dataloader = dict(
     batch_sampler=dict(drop_last=True),
     dataset=dict(
         ann_file='annotations/filtered_train_xml_files.txt',
+        ann_index='annotations/filtered_train_xml_files_index',
         backend_args=None,
         data_prefix=dict(img='train2014_single/')))
 
 val_dataloader = dict(
     dataset=dict(
         ann_file='annotations/filtered_val_xml_files.txt',
+        ann_index='annotations/filtered_val_xml_files_index',
         data_prefix=dict(img='val2014_single/')))
 
 
@@ -0,0 +1,165 @@
+import contextlib
+import copy
+import io
+import os.path as osp
+import tempfile
+import unittest
+
+import numpy as np
+from mmengine.fileio import dump
+
+from mmdet.datasets.api_wrappers import COCO, COCOeval, COCOevalFast
+
+
+class TestCOCOevalFast(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _create_coco(self, rng, num_imgs=20, num_cats=4):
+        """Random ground truths with crowd regions and all area ranges."""
+        images = [
+            dict(id=i + 1, width=640, height=480, file_name=f'{i}.jpg')
+            for i in range(num_imgs)
+        ]
+        categories = [dict(id=c + 1, name=f'cat{c}') for c in range(num_cats)]
+        annotations = []
+        for img in images:
+            for _ in range(rng.integers(0, 8)):
+                x, y = rng.uniform(0, 400, size=2)
+                w, h = rng.choice([8., 20., 50., 120.]) * rng.uniform(
+                    0.5, 2, size=2)
+                annotations.append(
+                    dict(
+                        id=len(annotations) + 1,
+                        image_id=img['id'],
+                        category_id=int(rng.integers(1, num_cats + 1)),
+                        bbox=[x, y, w, h],
+                        area=w * h,
+                        iscrowd=int(rng.random() < 0.1)))
+        ann_file = osp.join(self.tmp_dir.name, 'gt.json')
+        dump(
+            dict(
+                images=images,
+                annotations=annotations,
+                categories=categories), ann_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return COCO(ann_file)
+
+    def _create_dets(self, rng, coco):
+        """Jittered copies of the ground truths plus random false positives,
+        with quantized scores so that there are ties."""
+        dets = []
+        for ann in coco.dataset['annotations']:
+            for _ in range(rng.integers(0, 3)):
+                x, y, w, h = ann['bbox']
+                jitter = rng.normal(0, 0.1, size=4) * [w, h, w, h]
+                dets.append(
+                    dict(
+                        image_id=ann['image_id'],
+                        category_id=ann['category_id'],
+                        bbox=list(np.array([x, y, w, h]) + jitter),
+                        score=float(rng.integers(1, 10) / 10)))
+        for img_id in coco.get_img_ids():
+            for _ in range(rng.integers(0, 5)):
+                x, y = rng.uniform(0, 400, size=2)
+                w, h = rng.uniform(5, 150, size=2)
+                dets.append(
+                    dict(
+                        image_id=img_id,
+                        category_id=int(rng.integers(1, 5)),
+                        bbox=[x, y, w, h],
+                        score=float(rng.integers(1, 10) / 10)))
+        return dets
+
+    def _evaluate(self, coco_eval_cls, coco, dets, **params):
+        with contextlib.redirect_stdout(io.StringIO()):
+            coco_dt = coco.loadRes(copy.deepcopy(dets))
+            coco_eval = coco_eval_cls(coco, coco_dt, 'bbox')
+            for key, value in params.items():
+                setattr(coco_eval.params, key, value)
+            coco_eval.evaluate()
+            coco_eval.accumulate()
+            coco_eval.summarize()
+        return coco_eval
+
+    def _assert_same(self, coco, dets, **params):
+        expected = self._evaluate(COCOeval, coco, dets, **params)
+        result = self._evaluate(COCOevalFast, coco, dets, **params)
+        for key in ('precision', 'recall', 'scores'):
+            np.testing.assert_allclose(
+                result.eval[key], expected.eval[key], rtol=0, atol=1e-12)
+        np.testing.assert_allclose(
+            result.stats, expected.stats, rtol=0, atol=1e-12)
+
+    def test_parity(self):
+        rng = np.random.default_rng(0)
+        coco = self._create_coco(rng)
+        dets = self._create_dets(rng, coco)
+        self._assert_same(coco, dets)
+        # few detections per image, so that maxDets truncates
+        self._assert_same(coco, dets, maxDets=[1, 3, 5])
+        # class agnostic proposal evaluation
+        self._assert_same(coco, dets, useCats=0, maxDets=[10, 30, 100])
+        # a subset of images and categories
+        self._assert_same(coco, dets, imgIds=[2, 3, 5, 8], catIds=[1, 3])
+
+    def test_load_dets(self):
+        rng = np.random.default_rng(1)
+        coco = self._create_coco(rng)
+        dets = self._create_dets(rng, coco)
+        expected = self._evaluate(COCOevalFast, coco, dets)
+        with contextlib.redirect_stdout(io.StringIO()):
+            coco_eval = COCOevalFast(coco)
+            coco_eval.load_dets([det['image_id'] for det in dets],
+                                [det['bbox'] for det in dets],
+                                [det['score'] for det in dets],
+                                [det['category_id'] for det in dets])
+            coco_eval.evaluate()
+            coco_eval.accumulate()
+            coco_eval.summarize()
+        np.testing.assert_array_equal(coco_eval.stats, expected.stats)
+
+    def test_evaluate_images(self):
+        rng = np.random.default_rng(2)
+        coco = self._create_coco(rng)
+        dets = self._create_dets(rng, coco)
+        for params in (dict(), dict(useCats=0, maxDets=[10, 30, 100]),
+                       dict(imgIds=[2, 3, 5, 8], catIds=[1, 3])):
+            expected = self._evaluate(COCOeval, coco, dets, **params)
+            with contextlib.redirect_stdout(io.StringIO()):
+                coco_eval = COCOevalFast(coco)
+                for key, value in params.items():
+                    setattr(coco_eval.params, key, value)
+                # the images without detections are left to load_matches
+                img_ids = sorted({det['image_id'] for det in dets})
+                matches = []
+                for begin in range(0, len(img_ids), 3):
+                    batch = img_ids[begin:begin + 3]
+                    batch_dets = [
+                        det for det in dets if det['image_id'] in batch
+                    ]
+                    matches.append(
+                        coco_eval.evaluate_images(
+                            batch, [det['image_id'] for det in batch_dets],
+                            [det['bbox'] for det in batch_dets],
+                            [det['score'] for det in batch_dets],
+                            [det['category_id'] for det in batch_dets]))
+                coco_eval.load_matches(matches)
+                coco_eval.accumulate()
+                coco_eval.summarize()
+            for key in ('precision', 'recall', 'scores'):
+                np.testing.assert_allclose(
+                    coco_eval.eval[key],
+                    expected.eval[key],
+                    rtol=0,
+                    atol=1e-12)
+            np.testing.assert_allclose(
+                coco_eval.stats, expected.stats, rtol=0, atol=1e-12)
+
+    def test_segm_not_supported(self):
+        with self.assertRaises(ValueError):
+            COCOevalFast(iouType='segm')
@@ -0,0 +1,99 @@
+import contextlib
+import copy
+import io
+import os.path as osp
+import tempfile
+import unittest
+
+import numpy as np
+from mmengine.fileio import dump
+
+from mmdet.datasets.api_wrappers import COCO, COCOeval, COCOevalMP
+
+
+class TestCOCOevalMP(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        images = [
+            dict(id=i + 1, width=640, height=480, file_name=f'{i}.jpg')
+            for i in range(12)
+        ]
+        # the first category dominates, as person does on COCO
+        categories = [dict(id=c + 1, name=f'cat{c}') for c in range(3)]
+        annotations = []
+        self.dets = []
+        for img in images:
+            for _ in range(rng.integers(0, 10)):
+                x, y = rng.uniform(0, 400, size=2)
+                w, h = rng.uniform(5, 150, size=2)
+                cat_id = 1 if rng.random() < 0.7 else int(rng.integers(2, 4))
+                annotations.append(
+                    dict(
+                        id=len(annotations) + 1,
+                        image_id=img['id'],
+                        category_id=cat_id,
+                        bbox=[x, y, w, h],
+                        area=w * h,
+                        iscrowd=int(rng.random() < 0.1)))
+                for _ in range(rng.integers(0, 3)):
+                    jitter = rng.normal(0, 0.1, size=4) * [w, h, w, h]
+                    self.dets.append(
+                        dict(
+                            image_id=img['id'],
+                            category_id=cat_id,
+                            bbox=list(np.array([x, y, w, h]) + jitter),
+                            score=float(rng.integers(1, 10) / 10)))
+        ann_file = osp.join(self.tmp_dir.name, 'gt.json')
+        dump(
+            dict(
+                images=images,
+                annotations=annotations,
+                categories=categories), ann_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.coco = COCO(ann_file)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _evaluate(self, coco_eval_cls, use_cats=1, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            coco_dt = self.coco.loadRes(copy.deepcopy(self.dets))
+            coco_eval = coco_eval_cls(self.coco, coco_dt, 'bbox', **kwargs)
+            coco_eval.params.useCats = use_cats
+            coco_eval.evaluate()
+            coco_eval.accumulate()
+            coco_eval.summarize()
+        return coco_eval
+
+    def test_split_tasks(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            coco_dt = self.coco.loadRes(copy.deepcopy(self.dets))
+        coco_eval = COCOevalMP(self.coco, coco_dt, 'bbox', nproc=2)
+        coco_eval.params.imgIds = list(np.unique(coco_eval.params.imgIds))
+        tasks = coco_eval._split_tasks(coco_eval._prepare())
+        # the dominant category is split by images
+        self.assertGreater(len([task for task in tasks if task[0] == 0]), 1)
+        # the tasks of a category cover disjoint image ranges
+        for k in range(3):
+            ranges = sorted((lo, hi) for cat, lo, hi in tasks if cat == k)
+            for (_, hi), (lo, _) in zip(ranges[:-1], ranges[1:]):
+                self.assertLessEqual(hi, lo)
+
+    def test_evaluate(self):
+        for use_cats in (1, 0):
+            expected = self._evaluate(COCOeval, use_cats)
+            for nproc in (1, 2):
+                result = self._evaluate(
+                    COCOevalMP, use_cats, nproc=nproc, tasks_per_proc=3)
+                np.testing.assert_allclose(
+                    result.eval['precision'],
+                    expected.eval['precision'],
+                    rtol=0,
+                    atol=1e-12)
+                np.testing.assert_allclose(
+                    result.eval['recall'],
+                    expected.eval['recall'],
+                    rtol=0,
+                    atol=1e-12)
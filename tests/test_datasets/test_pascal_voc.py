@@ -1,9 +1,33 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import os
+import os.path as osp
+import tempfile
 import unittest
 
 from mmdet.datasets import VOCDataset
 
 
+def _write_voc(root, annotations):
+    """Write a tiny VOC2007 layout with ``annotations`` (img_id -> size,
+    objects)."""
+    os.makedirs(
+        osp.join(root, 'VOC2007', 'ImageSets', 'Main'), exist_ok=True)
+    os.makedirs(osp.join(root, 'VOC2007', 'Annotations'), exist_ok=True)
+    with open(osp.join(root, 'VOC2007', 'ImageSets', 'Main', 'trainval.txt'),
+              'w') as f:
+        f.write('\n'.join(annotations))
+    for img_id, ((width, height), objects) in annotations.items():
+        objs = ''.join(
+            f'<object><name>{name}</name><difficult>{difficult}</difficult>'
+            f'<bndbox><xmin>{x1}</xmin><ymin>{y1}</ymin><xmax>{x2}</xmax>'
+            f'<ymax>{y2}</ymax></bndbox></object>'
+            for name, difficult, (x1, y1, x2, y2) in objects)
+        with open(osp.join(root, 'VOC2007', 'Annotations', f'{img_id}.xml'),
+                  'w') as f:
+            f.write(f'<annotation><size><width>{width}</width>'
+                    f'<height>{height}</height></size>{objs}</annotation>')
+
+
 class TestVOCDataset(unittest.TestCase):
 
     def test_voc2007_init(self):
@@ -36,3 +60,40 @@ class TestVOCDataset(unittest.TestCase):
         self.assertEqual(len(data_list), 1)
         self.assertEqual(len(data_list[0]['instances']), 1)
         self.assertEqual(dataset.get_cat_ids(0), [18])
+
+    def test_ann_index(self):
+        annotations = {
+            '000001': ((353, 500), [('dog', 0, (48, 240, 195, 371)),
+                                    ('person', 0, (8, 12, 352, 498))]),
+            '000002': ((335, 500), [('train', 1, (139, 200, 207, 301)),
+                                    ('unknown', 0, (1, 1, 10, 10))]),
+            '000003': ((500, 375), []),
+        }
+        with tempfile.TemporaryDirectory() as root:
+            _write_voc(root, annotations)
+            kwargs = dict(
+                data_root=root,
+                ann_file='VOC2007/ImageSets/Main/trainval.txt',
+                data_prefix=dict(sub_data_root='VOC2007/'),
+                filter_cfg=dict(
+                    filter_empty_gt=True, min_size=32, bbox_min_size=100),
+                pipeline=[])
+            data_list = VOCDataset(**kwargs).load_data_list()
+
+            indexed = VOCDataset(ann_index='trainval_index', **kwargs)
+            self.assertTrue(osp.isdir(osp.join(root, 'trainval_index')))
+            self.assertEqual(indexed.load_data_list(), data_list)
+            self.assertEqual(len(indexed), 2)
+
+            # the index is reused without parsing the XML files
+            for img_id in annotations:
+                os.remove(
+                    osp.join(root, 'VOC2007', 'Annotations', f'{img_id}.xml'))
+            indexed = VOCDataset(ann_index='trainval_index', **kwargs)
+            self.assertEqual(indexed.load_data_list(), data_list)
+
+            # a changed ann_file invalidates the index
+            del annotations['000003']
+            _write_voc(root, annotations)
+            indexed = VOCDataset(ann_index='trainval_index', **kwargs)
+            self.assertEqual(indexed.load_data_list(), data_list[:2])
@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+import torch
+
+from dyn_perceiver.perceiver_core import (CrossAttentionLayer,
+                                          SelfAttentionBlock,
+                                          set_attention_backend)
+
+
+class TestAttentionBackend(TestCase):
+
+    def _assert_backends_match(self, module, *inputs, **kwargs):
+        set_attention_backend(module, 'math')
+        with torch.no_grad():
+            expected = module(*inputs, **kwargs)
+        # 7은 query 길이 30을 나누지 않는다. 64는 query 길이보다 길어서 나누지 않는 경우
+        for backend, chunk_size in [('sdpa', None), ('chunked', 7),
+                                    ('chunked', 1), ('chunked', 64),
+                                    ('chunked', None)]:
+            set_attention_backend(module, backend, chunk_size)
+            with torch.no_grad():
+                out = module(*inputs, **kwargs)
+            self.assertEqual(out.shape, expected.shape)
+            self.assertTrue(
+                torch.allclose(out, expected, atol=1e-5, rtol=1e-4),
+                f'{backend} (query_chunk_size={chunk_size}) does not match '
+                f'math: max diff {(out - expected).abs().max().item()}')
+
+    def test_cross_attention(self):
+        torch.manual_seed(0)
+        # feature map (5 x 4 = 20 token)에서 latent 30개로의 cross attention, relative position bias 포함
+        layer = CrossAttentionLayer(
+            num_heads=2,
+            num_q_input_channels=16,
+            num_kv_input_channels=12,
+            num_qk_channels=16,
+            num_v_channels=16,
+            rpb=True,
+            feat_w=5,
+            feat_h=4).eval()
+        torch.nn.init.normal_(layer.cross_attn.attention.relative_position_bias)
+        x_q = torch.randn(3, 30, 16)
+        x_kv = torch.randn(3, 20, 12)
+        self._assert_backends_match(layer, x_q, x_kv)
+
+        pad_mask = torch.zeros(3, 20, dtype=torch.bool)
+        pad_mask[0, 15:] = True
+        pad_mask[2, 3:] = True
+        self._assert_backends_match(layer, x_q, x_kv, pad_mask=pad_mask)
+
+    def test_self_attention(self):
+        torch.manual_seed(0)
+        block = SelfAttentionBlock(
+            num_layers=2, num_heads=4, num_channels=16).eval()
+        x = torch.randn(2, 30, 16)
+        self._assert_backends_match(block, x)
+
+    def test_set_attention_backend(self):
+        block = SelfAttentionBlock(num_layers=2, num_heads=4, num_channels=16)
+        set_attention_backend(block, 'chunked', 8)
+        attentions = [
+            m for m in block.modules() if hasattr(m, 'attn_backend')
+        ]
+        self.assertEqual(len(attentions), 2)
+        for attention in attentions:
+            self.assertEqual(attention.attn_backend, 'chunked')
+            self.assertEqual(attention.query_chunk_size, 8)
+        with self.assertRaises(ValueError):
+            set_attention_backend(block, 'flash')
+        # 'chunked'가 아닌 backend는 query를 나누지 않는다
+        for backend in ('sdpa', 'math'):
+            with self.assertRaises(ValueError):
+                set_attention_backend(block, backend, 8)
@@ -0,0 +1,65 @@
+from unittest import TestCase
+
+import torch
+
+from dyn_perceiver.budget_controller import BudgetController
+
+
+class TestBudgetController(TestCase):
+
+    def _get_controller(self, **kwargs):
+        # threshold마다 모든 image가 stage 1, 2, 3, 4에서 exit하는 경우
+        thresholds = [
+            torch.tensor([-1., 1., 1., -1.]),
+            torch.tensor([1., -1., 1., -1.]),
+            torch.tensor([1., 1., -1., -1.]),
+            torch.tensor([1., 1., 1., -1.])
+        ]
+        controller = BudgetController(
+            thresholds, flops=[1., 2., 3., 4.], flops_budget=45., **kwargs)
+        controller.exit_ratios = torch.eye(4, dtype=torch.float64)
+        return controller
+
+    def test_burst(self):
+        controller = self._get_controller(momentum=0.5)
+        # 초당 10개 -> image당 4.5 FLOPs, 가장 늦게 exit
+        controller.observe_arrivals([i * 0.1 for i in range(20)])
+        controller.get_threshold()
+        self.assertAlmostEqual(controller.request_rate, 10.)
+        self.assertEqual(controller.index, 3)
+
+        # 초당 40개의 burst -> image당 1.125 FLOPs, stage 1에서 exit
+        controller.observe_arrivals([1.9 + i * 0.025 for i in range(1, 41)])
+        self.assertTrue(torch.equal(controller.get_threshold(),
+                                    controller.thresholds[0]))
+        self.assertEqual(controller.index, 0)
+
+        # 다시 초당 10개로 돌아오면 늦게 exit
+        controller.observe_arrivals([2.9 + i * 0.1 for i in range(1, 41)])
+        controller.get_threshold()
+        self.assertEqual(controller.index, 3)
+
+    def test_call_interval_is_not_arrival_rate(self):
+        controller = self._get_controller()
+        # 도착을 알려주지 않으면 get_threshold를 아무리 자주 불러도 threshold가 바뀌지 않는다
+        for _ in range(100):
+            controller.get_threshold()
+        self.assertIsNone(controller.request_rate)
+        self.assertEqual(controller.index, 3)
+
+    def test_queue_length(self):
+        controller = self._get_controller(drain_time=1.)
+        controller.observe_arrivals([i * 0.1 for i in range(20)])
+        # 초당 10개 + 대기 중인 10개 -> image당 2.25 FLOPs
+        controller.get_threshold(queue_length=10)
+        self.assertEqual(controller.index, 1)
+        controller.get_threshold(queue_length=0)
+        self.assertEqual(controller.index, 3)
+
+    def test_update(self):
+        controller = self._get_controller(momentum=0.)
+        controller.update([2, 2, 4, 4], index=0)
+        self.assertTrue(
+            torch.allclose(controller.exit_ratios[0],
+                           torch.tensor([0., 0.5, 0., 0.5],
+                                        dtype=torch.float64)))
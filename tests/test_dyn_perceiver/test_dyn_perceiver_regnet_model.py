@@ -0,0 +1,110 @@
+import tempfile
+from unittest import TestCase
+
+import torch
+
+from dyn_perceiver.dyn_perceiver_regnet_model import DynPerceiver
+
+
+def _build_model(zero_padding):
+    # DynPerceiverZeromap (zero_padding=True), DynPerceiverDownSampling (zero_padding=False)와 같은 구조의 작은 model
+    torch.manual_seed(0)
+    # 생성할 때 forward_calc_flops가 output_dir에 flops.txt를 쓴다
+    with tempfile.TemporaryDirectory() as output_dir:
+        model = DynPerceiver(
+            num_classes=10,
+            cnn_arch='regnet_y_400mf',
+            spatial_reduction=True,
+            zero_padding=zero_padding,
+            output_dir=output_dir)
+    return model.eval()
+
+
+def _mixed_exit_threshold(model, x):
+    """
+    sample마다 exit stage가 1, 2, 3, 4로 섞이도록 threshold를 정한다.
+    stage k까지의 classifier는 exit 여부와 무관하므로 threshold 없이 한 번 돌린 confidence로 고를 수 있다.
+    stage k에서는 아직 exit하지 않은 sample 중 confidence가 가장 큰 sample만 exit한다.
+    batch 크기에 따른 수치 오차로 exit 여부가 바뀌지 않도록 threshold는 1, 2등 confidence의 중간값.
+    """
+    with torch.no_grad():
+        preds = model(x)[:4]
+    threshold = torch.ones(4)
+    threshold[3] = -1
+    remaining = torch.ones(x.size(0), dtype=torch.bool)
+    for k in range(3):
+        confidence = preds[k].softmax(dim=1).max(dim=1)[0]
+        top2 = confidence[remaining].topk(2)[0]
+        threshold[k] = top2.mean()
+        remaining &= confidence < threshold[k]
+    return threshold
+
+
+class TestDynPerceiverBatchedExit(TestCase):
+
+    def _test_batched_exit(self, zero_padding):
+        model = _build_model(zero_padding)
+        x = torch.rand(5, 3, 96, 128)
+        threshold = _mixed_exit_threshold(model, x)
+
+        # image 한 장씩 (batch 전체가 같은 stage에서 exit)
+        model.batched_exit = False
+        expected_stages, expected_preds, expected_outs = [], [], []
+        with torch.no_grad():
+            for i in range(x.size(0)):
+                *preds, outs = model(x[i:i + 1], threshold=threshold)
+                expected_stages.append(model.get_last_exited_stage())
+                expected_preds.append(preds)
+                expected_outs.append(outs)
+        self.assertEqual(sorted(set(expected_stages)), [1, 2, 3, 4])
+
+        model.batched_exit = True
+        with torch.no_grad():
+            *preds, sample_outs = model(x, threshold=threshold)
+        self.assertEqual(model.get_last_exited_stages(), expected_stages)
+        self.assertEqual(model.get_last_exited_stage(), 4)
+        for i in range(x.size(0)):
+            for pred, expected in zip(preds, expected_preds[i]):
+                self.assertTrue(
+                    torch.allclose(pred[i:i + 1], expected, atol=1e-5))
+            self.assertEqual(len(sample_outs[i]), len(expected_outs[i]))
+            for out, expected in zip(sample_outs[i], expected_outs[i]):
+                self.assertEqual(out.shape, expected.shape)
+                self.assertTrue(torch.allclose(out, expected, atol=1e-5))
+            if zero_padding:
+                stage = expected_stages[i]
+                self.assertEqual(len(sample_outs[i]), 4)
+                for k in range(stage + 1, 4):
+                    self.assertFalse(sample_outs[i][k].any())
+
+    def test_batched_exit_downsampling(self):
+        self._test_batched_exit(zero_padding=False)
+
+    def test_batched_exit_zeromap(self):
+        self._test_batched_exit(zero_padding=True)
+
+    def test_threshold_cache(self):
+        model = _build_model(zero_padding=False)
+        torch.manual_seed(1)
+        y = torch.randn(6, 10)
+        confidence = y.softmax(dim=1).max(dim=1)[0]
+        median = confidence.median()
+
+        threshold = torch.tensor([median, 1., 1., -1.])
+        self.assertTrue(
+            torch.equal(model._exit_decision(y, threshold, 0),
+                        confidence >= median))
+        # 같은 threshold로 다시 부르면 cache된 tensor를 그대로 쓴다
+        cached = model._preload_threshold(threshold, y.device)
+        self.assertIs(model._preload_threshold(threshold, y.device), cached)
+
+        # threshold tensor를 새 object로 바꾸면 cache를 갱신
+        threshold = torch.tensor([2., 1., 1., -1.])
+        self.assertFalse(model._exit_decision(y, threshold, 0).any())
+        # 같은 tensor를 in-place로 수정해도 갱신
+        threshold[0] = -1
+        self.assertTrue(model._exit_decision(y, threshold, 0).all())
+        # list로 바꿔도 갱신
+        self.assertTrue(
+            torch.equal(model._exit_decision(y, [median.item(), 1, 1, -1], 0),
+                        confidence >= median))
@@ -0,0 +1,68 @@
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+import torch
+
+from tools.cs470.dynamic_evaluation_logger import (TRACE_DTYPE, DynamicEvaluationLogger,
+                                                   load_trace, replay_trace)
+
+
+def _exit_stages(confidences, threshold):
+    """threshold를 처음 넘는 stage. 마지막 stage에서는 항상 exit"""
+    exit_mask = confidences >= torch.as_tensor(threshold)
+    exit_mask[:, -1] = True
+    return (exit_mask.int().argmax(dim=1) + 1).tolist()
+
+
+class TestDynamicEvaluationLogger(TestCase):
+
+    def test_trace_round_trip(self):
+        torch.manual_seed(0)
+        num_images = 7
+        flops = torch.tensor([1e9, 2e9, 3e9, 4e9])
+        # trace에는 float16으로 저장되므로 float16으로 표현되는 값만 사용
+        confidences = torch.rand(num_images, 4).half().float()
+        corrects = torch.rand(num_images, 4) < 0.5
+        thresholds = [[0.5, 0.6, 0.7, -1.], [0.9, 0.3, 0.8, -1.]]
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            logger = DynamicEvaluationLogger(log_dir, flops, num_images=num_images)
+            for threshold in thresholds:
+                stages = _exit_stages(confidences, threshold)
+                # single pass처럼 모든 classifier의 confidence를 batch로 나눠서 기록
+                for start, end in [(0, 3), (3, 7)]:
+                    batch_stages = stages[start:end]
+                    logger.append(batch_stages, confidences[start:end], corrects[start:end],
+                                  [flops[stage - 1].item() for stage in batch_stages], elapsed=0.1)
+                    logger.append_classifier(
+                        [bool(corrects[start + i, stage - 1]) for i, stage in enumerate(batch_stages)])
+                logger.save_info({'pascal_voc/mAP': 0.1, 'pascal_voc/AP50': 0.2}, threshold)
+            logger.save_trace()
+            trace = np.array(load_trace(logger.trace_file_dir))
+
+        self.assertEqual(trace.dtype, TRACE_DTYPE)
+        self.assertEqual(trace.shape, (len(thresholds), num_images))
+        self.assertEqual(trace.dtype['exit_stage'], np.int8)
+        self.assertEqual(trace.dtype['confidence'].base, np.float16)
+        self.assertEqual(trace.dtype['correct'].base, np.bool_)
+        self.assertEqual(trace.dtype['flops'], np.float32)
+        for i, threshold in enumerate(thresholds):
+            stages = _exit_stages(confidences, threshold)
+            self.assertEqual(trace[i]['exit_stage'].tolist(), stages)
+            self.assertTrue(np.array_equal(trace[i]['confidence'], confidences.half().numpy()))
+            self.assertTrue(np.array_equal(trace[i]['correct'], corrects.numpy()))
+            self.assertTrue(np.array_equal(trace[i]['flops'], flops[torch.tensor(stages) - 1].numpy()))
+            self.assertTrue(np.allclose(trace[i]['time'], 0.1 / np.array([3] * 3 + [4] * 4)))
+
+        # 같은 threshold를 replay하면 기록된 exit 비율, 평균 FLOPs, accuracy가 그대로 나온다
+        for i, threshold in enumerate(thresholds):
+            exit_stage, avg_flops, accuracy = replay_trace(trace[i], thresholds, flops.numpy())
+            self.assertEqual(exit_stage[i].tolist(), trace[i]['exit_stage'].tolist())
+            for j in range(len(thresholds)):
+                ratio = np.bincount(exit_stage[j] - 1, minlength=4) / num_images
+                self.assertTrue(np.allclose(ratio, logger.image_ratio_info[j]))
+                self.assertAlmostEqual(avg_flops[j] / logger.flops_unit, logger.flops_info[j], places=5)
+                self.assertAlmostEqual(accuracy[j], logger.classification_accuracy[j])
+            # FLOPs가 없으면 평균 FLOPs는 다시 계산하지 않는다
+            self.assertIsNone(replay_trace(trace[i], thresholds)[1])
@@ -0,0 +1,158 @@
+import math
+import os
+import os.path as osp
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase, mock
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from dyn_perceiver.get_threshold import Tester, generate_distribution
+
+
+def _find_threshold_loop(logits, targets, p):
+    """The per-distribution loop replaced by dynamic_eval_find_thresholds."""
+    n_stage, n_sample, c = logits.size()
+    max_preds, argmax_preds = logits.max(dim=2, keepdim=False)
+    _, sorted_idx = max_preds.sort(dim=1, descending=True)
+    filtered = torch.zeros(n_sample)
+    T = torch.Tensor(n_stage).fill_(1e8)
+    for k in range(n_stage - 1):
+        count = 0
+        out_n = math.floor(n_sample * p[k])
+        for i in range(n_sample):
+            ori_idx = sorted_idx[k][i]
+            if filtered[ori_idx] == 0:
+                count += 1
+                if count == out_n:
+                    T[k] = max_preds[k][ori_idx]
+                    break
+        filtered.add_(max_preds[k].ge(T[k]).type_as(filtered))
+    T[n_stage - 1] = -1e8
+    acc = 0
+    for i in range(n_sample):
+        for k in range(n_stage):
+            if max_preds[k][i].item() >= T[k]:
+                if int(targets[i].item()) == int(argmax_preds[k][i].item()):
+                    acc += 1
+                break
+    return acc * 100.0 / n_sample, T
+
+
+def _cache_tester():
+    """backbone weight만 있는 model과, calc_logit 호출 횟수를 세는 mock"""
+    torch.manual_seed(0)
+    tester = Tester(model=SimpleNamespace(backbone=nn.Linear(4, 3)))
+    logits = torch.rand(4, 6, 3)
+    targets = torch.randint(0, 3, (6, )).float()
+    tester.calc_logit = mock.Mock(return_value=(logits, targets))
+    return tester, logits, targets
+
+
+def _dataloader(ann_file='val.json', pipeline=('LoadImageFromFile', 'Resize')):
+    dataset = SimpleNamespace(ann_file=ann_file, pipeline=list(pipeline))
+    return SimpleNamespace(dataset=dataset, batch_size=2)
+
+
+class TestGetThreshold(TestCase):
+
+    def test_dynamic_eval_find_thresholds(self):
+        torch.manual_seed(0)
+        n_stage, n_sample, c = 4, 300, 10
+        logits = torch.randn(n_stage, n_sample, c).mul(3).softmax(dim=2)
+        targets = torch.randint(0, c, (n_sample, )).float()
+        probs_list = generate_distribution([0.8, 0.9, 1.0])
+        # exit 비율이 0인 stage가 있는 분포, 한 stage로 모두 나가는 분포
+        probs_list += [
+            torch.tensor([0., 0.5, 0.5, 0.]),
+            torch.tensor([1., 0., 0., 0.])
+        ]
+        tester = Tester(model=None)
+        accs, Ts = tester.dynamic_eval_find_thresholds(logits, targets,
+                                                       torch.stack(probs_list))
+        self.assertEqual(Ts.shape, (len(probs_list), n_stage))
+        for probs, acc, T in zip(probs_list, accs.tolist(), Ts):
+            expected_acc, expected_T = _find_threshold_loop(
+                logits, targets, probs)
+            self.assertTrue(torch.equal(T, expected_T))
+            self.assertAlmostEqual(acc, expected_acc, places=4)
+
+        # single distribution wrapper
+        acc, T = tester.dynamic_eval_find_threshold(logits, targets,
+                                                    probs_list[5])
+        expected_acc, expected_T = _find_threshold_loop(
+            logits, targets, probs_list[5])
+        self.assertTrue(torch.equal(T, expected_T))
+        self.assertAlmostEqual(acc, expected_acc, places=4)
+
+    def test_find_head_thresholds(self):
+        tester = Tester(model=None)
+        scores = torch.tensor([[0.875, 0.25, 0.75, 0.5],
+                               [0.875, -1., -1., 0.5],
+                               [-1., -1., -1., -1.]])
+        # floor(4 * 0.5) = 2번째로 큰 score. exit할 수 없는 image (-1)는 세지 않는다
+        self.assertEqual(tester.find_head_thresholds(scores, 0.5),
+                         [0.75, 0.5, 1e8])
+        self.assertEqual(tester.find_head_thresholds(scores, 1.0),
+                         [0.25, 0.5, 1e8])
+        self.assertEqual(tester.find_head_thresholds(scores, 0.),
+                         [1e8, 1e8, 1e8])
+
+    def test_logit_cache_hit(self):
+        tester, logits, targets = _cache_tester()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            results = [tester.calc_logit_cached(_dataloader(), cache_dir, False)
+                       for _ in range(2)]
+            # 두 번째는 model forward 없이 cache에서 읽는다
+            self.assertEqual(tester.calc_logit.call_count, 1)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+        for ts_logits, ts_targets in results:
+            self.assertTrue(torch.equal(ts_logits, logits))
+            self.assertTrue(torch.equal(ts_targets, targets))
+
+    def test_logit_cache_miss(self):
+        tester, _, _ = _cache_tester()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            tester.calc_logit_cached(_dataloader(), cache_dir, False)
+            # ann_file, pipeline이 바뀌면 다시 계산
+            tester.calc_logit_cached(_dataloader(ann_file='test.json'), cache_dir, False)
+            self.assertEqual(tester.calc_logit.call_count, 2)
+            tester.calc_logit_cached(_dataloader(pipeline=('LoadImageFromFile', )), cache_dir, False)
+            self.assertEqual(tester.calc_logit.call_count, 3)
+            # weight가 바뀌어도 다시 계산
+            with torch.no_grad():
+                tester.model.backbone.weight[0, 0] += 1.
+            tester.calc_logit_cached(_dataloader(), cache_dir, False)
+            self.assertEqual(tester.calc_logit.call_count, 4)
+            self.assertEqual(len(os.listdir(cache_dir)), 8)
+
+    def test_logit_cache_atomic_write(self):
+        tester, logits, targets = _cache_tester()
+        replaced = []
+
+        def replace(src, dst):
+            # 다 쓴 임시 파일을 rename하기 전까지 cache 파일은 없다
+            self.assertTrue(src.endswith('.tmp'))
+            self.assertFalse(osp.exists(dst))
+            replaced.append((np.load(src), dst))
+            os.rename(src, dst)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with mock.patch('dyn_perceiver.get_threshold.os.replace', side_effect=replace):
+                tester.calc_logit_cached(_dataloader(), cache_dir, False)
+            self.assertEqual(len(replaced), 2)
+            self.assertTrue(np.array_equal(replaced[0][0], logits.numpy()))
+            self.assertTrue(np.array_equal(replaced[1][0], targets.numpy()))
+            self.assertEqual(sorted(os.listdir(cache_dir)),
+                             sorted(osp.basename(dst) for _, dst in replaced))
+
+        # 쓰다가 실패하면 cache 파일이 남지 않으므로 다음에 다시 계산
+        with tempfile.TemporaryDirectory() as failed_dir:
+            with mock.patch('dyn_perceiver.get_threshold.np.save', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    tester.calc_logit_cached(_dataloader(), failed_dir, False)
+            self.assertFalse(any(file.endswith('.npy') for file in os.listdir(failed_dir)))
+            tester.calc_logit_cached(_dataloader(), failed_dir, False)
+            self.assertEqual(tester.calc_logit.call_count, 3)
@@ -0,0 +1,138 @@
+import csv
+import os.path as osp
+import tempfile
+from concurrent import futures
+from unittest import TestCase, skipIf
+
+import numpy as np
+import torch
+from mmengine.structures import InstanceData
+
+from mmdet.structures import DetDataSample
+from tools.cs470.qualitive_logger import QualitiveLogger, pq
+
+
+def _outputs(batch_idx, num_boxes):
+    """image마다 num_boxes개의 box가 있는 batch의 prediction"""
+    torch.manual_seed(batch_idx)
+    outputs = []
+    for i, n in enumerate(num_boxes):
+        output = DetDataSample(metainfo=dict(img_path=f'data/{batch_idx}_{i}.jpg'))
+        output.pred_instances = InstanceData(
+            bboxes=torch.rand(n, 4) * 1000,
+            labels=torch.randint(80, (n, )),
+            scores=torch.rand(n))
+        outputs.append(output)
+    return outputs
+
+
+def _expected_columns(batches):
+    columns = {name: [] for name in QualitiveLogger.fieldnames}
+    for batch_idx, outputs, stages in batches:
+        for output, stage in zip(outputs, stages):
+            pred_instances = output.pred_instances
+            n = len(pred_instances.labels)
+            columns['image_id'] += [osp.basename(output.img_path)] * n
+            for k in range(4):
+                columns[f'bbox_{k + 1}'] += pred_instances.bboxes[:, k].tolist()
+            columns['label'] += pred_instances.labels.tolist()
+            columns['score'] += pred_instances.scores.tolist()
+            columns['early_exit'] += [stage] * n
+            columns['batch_idx'] += [batch_idx] * n
+    return {name: np.asarray(values, dtype=dtype) for (name, values), dtype
+            in zip(columns.items(), QualitiveLogger.dtypes)}
+
+
+def _read(logger):
+    """저장된 파일의 column 이름과 column별 값"""
+    if logger.file_format == 'parquet':
+        table = pq.read_table(logger.file_dir)
+        return table.column_names, {name: table.column(name).to_numpy() for name in table.column_names}
+    with open(logger.file_dir) as f:
+        rows = list(csv.reader(f))
+    header, rows = rows[0], rows[1:]
+    columns = {}
+    for j, (name, dtype) in enumerate(zip(header, QualitiveLogger.dtypes)):
+        values = [row[j] for row in rows]
+        if dtype is str:
+            columns[name] = np.asarray(values, dtype=str)
+        else:
+            # float32는 %.9g로 쓰였으므로 float32로 읽으면 같은 값
+            columns[name] = np.asarray([float(value) for value in values]).astype(dtype)
+    return header, columns
+
+
+class TestQualitiveLogger(TestCase):
+
+    def tearDown(self):
+        QualitiveLogger.shutdown()
+
+    def _test_round_trip(self, file_format):
+        with tempfile.TemporaryDirectory() as log_dir:
+            # flush_rows보다 box가 많이 모일 때마다 flush하므로 여러 번 나눠서 쓴다
+            logger = QualitiveLogger(log_dir, 1, file_format, flush_rows=5)
+            batches = [(0, _outputs(0, [3, 0]), [1, 2]),
+                       (1, _outputs(1, [2, 4]), [4, 4]),
+                       (2, _outputs(2, [0, 0]), [3, 1]),
+                       (3, _outputs(3, [1]), [2])]
+            for batch_idx, outputs, stages in batches:
+                logger.process(batch_idx, None, outputs, stages)
+            logger.save_info()
+            logger.wait()
+
+            header, columns = _read(logger)
+            if file_format == 'parquet':
+                # 9개 (batch 0, 1)에서 한 번, save_info에서 남은 1개
+                self.assertEqual(pq.ParquetFile(logger.file_dir).num_row_groups, 2)
+        self.assertEqual(header, QualitiveLogger.fieldnames)
+        expected = _expected_columns(batches)
+        for name in QualitiveLogger.fieldnames:
+            self.assertEqual(len(columns[name]), 10)
+            self.assertTrue(np.array_equal(columns[name], expected[name]), name)
+
+    @skipIf(pq is None, 'pyarrow is not installed')
+    def test_parquet_round_trip(self):
+        self._test_round_trip('parquet')
+
+    def test_csv_round_trip(self):
+        self._test_round_trip('csv')
+
+    def _test_no_boxes(self, file_format):
+        with tempfile.TemporaryDirectory() as log_dir:
+            logger = QualitiveLogger(log_dir, 1, file_format)
+            logger.process(0, None, _outputs(0, [0, 0]), 4)
+            logger.save_info()
+            logger.wait()
+            # box가 없어도 header만 있는 파일을 남긴다
+            header, columns = _read(logger)
+        self.assertEqual(header, QualitiveLogger.fieldnames)
+        for name in QualitiveLogger.fieldnames:
+            self.assertEqual(len(columns[name]), 0)
+
+    @skipIf(pq is None, 'pyarrow is not installed')
+    def test_parquet_no_boxes(self):
+        self._test_no_boxes('parquet')
+
+    def test_csv_no_boxes(self):
+        self._test_no_boxes('csv')
+
+    def test_failed_write(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            # directory에는 파일을 쓸 수 없으므로 writer thread에서의 write가 실패
+            logger = QualitiveLogger(log_dir, 1, 'csv', flush_rows=1)
+            logger.file_dir = log_dir
+            logger.process(0, None, _outputs(0, [2]), 1)
+            futures.wait(logger.writes)
+            # 다음 flush, save_info에서 다시 raise
+            with self.assertRaises(OSError):
+                logger.save_info()
+            # close도 실패로 남는다
+            with self.assertRaises(OSError):
+                logger.wait()
+
+            # close에서 처음 실패하는 경우도 wait에서 raise
+            logger = QualitiveLogger(log_dir, 2, 'csv')
+            logger.file_dir = log_dir
+            logger.save_info()
+            with self.assertRaises(OSError):
+                logger.wait()
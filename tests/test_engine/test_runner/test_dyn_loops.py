@@ -0,0 +1,214 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import copy
+import os.path as osp
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock
+
+import numpy as np
+import torch
+from mmengine.dataset import pseudo_collate
+from mmengine.evaluator import Evaluator
+from mmengine.structures import InstanceData
+from parameterized import parameterized
+from torch.utils.data import DataLoader, Dataset
+
+from mmdet.engine.runner.dyn_loops import DynamicTestLoop
+from mmdet.registry import MODELS
+from mmdet.structures import DetDataSample
+from mmdet.testing import get_detector_cfg
+from mmdet.utils import register_all_modules
+
+_CFG_FILE = '../model_configs/coco/baseline/' \
+    'retinanet_dyn_perceiver-800MF_fpn_1x_coco_single-base.py'
+_NUM_CLASSES = 80
+
+
+class _ToyDetDataset(Dataset):
+    """Random images with one gt box each, already packed."""
+
+    # no Resize to derive the input shapes from, the batches are loaded
+    pipeline = None
+
+    def __init__(self, num_images=6, img_shapes=((96, 128), )):
+        torch.manual_seed(0)
+        self.metainfo = dict(
+            classes=tuple(f'class_{i}' for i in range(_NUM_CLASSES)))
+        self.data = []
+        for i in range(num_images):
+            h, w = img_shapes[i % len(img_shapes)]
+            data_sample = DetDataSample(
+                metainfo=dict(
+                    img_id=i,
+                    img_path=f'{i}.jpg',
+                    img_shape=(h, w),
+                    ori_shape=(h, w),
+                    scale_factor=(1., 1.)))
+            gt_instances = InstanceData()
+            gt_instances.bboxes = torch.tensor([[8., 8., w / 2, h / 2]])
+            gt_instances.labels = torch.randint(_NUM_CLASSES, (1, ))
+            data_sample.gt_instances = gt_instances
+            ignored_instances = InstanceData()
+            ignored_instances.bboxes = torch.zeros(0, 4)
+            ignored_instances.labels = torch.zeros(0, dtype=torch.long)
+            data_sample.ignored_instances = ignored_instances
+            self.data.append(
+                dict(
+                    inputs=torch.randint(256, (3, h, w), dtype=torch.uint8),
+                    data_samples=data_sample))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        return copy.deepcopy(self.data[idx])
+
+
+def _build_detector(batched_exit=False):
+    register_all_modules()
+    model = get_detector_cfg(_CFG_FILE)
+    model.backbone.batched_exit = batched_exit
+    torch.manual_seed(0)
+    return MODELS.build(model).eval()
+
+
+def _build_dataloader(batch_size, **kwargs):
+    return DataLoader(
+        _ToyDetDataset(**kwargs),
+        batch_size=batch_size,
+        shuffle=False,
+        collate_fn=pseudo_collate)
+
+
+def _build_loop(detector, dataloader, log_dir, thresholds,
+                head_thresholds=None, **kwargs):
+    """A DynamicTestLoop with the given thresholds instead of the
+    calibrated ones."""
+    runner = Mock()
+    runner.model = detector
+    runner._log_dir = log_dir
+    runner.work_dir = log_dir
+    runner.build_evaluator = Evaluator
+    loop = DynamicTestLoop(
+        runner,
+        dataloader,
+        dict(type='VOCMetric'),
+        dynamic_evaluate=True,
+        **kwargs)
+
+    def get_threshold_and_flops():
+        loop.thresholds = thresholds
+        loop.head_thresholds = head_thresholds
+
+    loop.get_threshold_and_flops = get_threshold_and_flops
+    return loop
+
+
+def _mixed_thresholds(detector, dataloader):
+    """Threshold vectors under which the images exit at mixed stages.
+
+    Each threshold lies halfway between two confidences, so that numerical
+    differences between batch compositions do not change any exit.
+    """
+    confidences = []
+    with torch.no_grad():
+        for data_batch in dataloader:
+            inputs = detector.data_preprocessor(data_batch, False)['inputs']
+            preds = detector.backbone.forward_all_exits(inputs)[1:]
+            confidences.append(
+                torch.stack(
+                    [pred.softmax(dim=1).max(dim=1)[0] for pred in preds],
+                    dim=1))
+    confidences = torch.cat(confidences).sort(dim=0)[0]
+    thresholds = []
+    for quantile in (0.5, 0.8):
+        j = int(len(confidences) * quantile)
+        threshold = (confidences[j - 1] + confidences[j]) / 2
+        threshold[3] = -1
+        thresholds.append(threshold)
+    # every image exits at the last stage
+    thresholds.append(torch.tensor([2., 2., 2., -1.]))
+    return thresholds
+
+
+class TestDynamicTestLoop(TestCase):
+
+    @parameterized.expand([(True, 3), (False, 1)])
+    def test_single_pass(self, batched_exit, batch_size):
+        detector = _build_detector(batched_exit)
+        dataloader = _build_dataloader(
+            batch_size, num_images=8, img_shapes=((96, 128), (128, 96)))
+        thresholds = _mixed_thresholds(detector, dataloader)
+
+        loggers = []
+        for single_pass in (False, True):
+            with tempfile.TemporaryDirectory() as log_dir:
+                loop = _build_loop(
+                    detector,
+                    dataloader,
+                    log_dir,
+                    thresholds,
+                    single_pass=single_pass)
+                loop.run()
+            loggers.append(loop.evaluate_logger)
+        logger, single_pass_logger = loggers
+
+        self.assertEqual(len(single_pass_logger.traces), len(thresholds))
+        for trace, expected in zip(single_pass_logger.traces, logger.traces):
+            np.testing.assert_array_equal(trace['exit_stage'],
+                                          expected['exit_stage'])
+            np.testing.assert_array_equal(trace['flops'], expected['flops'])
+            # correctness of the classifier each image exits at. The other
+            # classifiers are only computed in the single pass
+            exit_idx = trace['exit_stage'].astype(np.int64)[:, None] - 1
+            np.testing.assert_array_equal(
+                np.take_along_axis(trace['correct'], exit_idx, axis=1),
+                np.take_along_axis(expected['correct'], exit_idx, axis=1))
+        # half of the images exit at stage 1 under the first threshold
+        self.assertEqual((logger.traces[0]['exit_stage'] == 1).sum(), 4)
+        self.assertEqual(single_pass_logger.image_ratio_info,
+                         logger.image_ratio_info)
+        self.assertEqual(single_pass_logger.classification_accuracy,
+                         logger.classification_accuracy)
+        self.assertEqual(single_pass_logger.flops_info, logger.flops_info)
+        # the detections may differ by rounding between batch compositions
+        np.testing.assert_allclose(
+            single_pass_logger.mAP_info, logger.mAP_info, rtol=0, atol=1e-4)
+        np.testing.assert_allclose(
+            single_pass_logger.mAP_50_info,
+            logger.mAP_50_info,
+            rtol=0,
+            atol=1e-3)
+
+    def test_coarse_exit_flops(self):
+        detector = _build_detector()
+        dataloader = _build_dataloader(batch_size=2)
+        # every image exits at stage 4, where all coarse levels are active
+        threshold = torch.tensor([2., 2., 2., -1.])
+        with tempfile.TemporaryDirectory() as log_dir:
+            # every image takes the coarse exit of the head, then none
+            loop = _build_loop(
+                detector,
+                dataloader,
+                log_dir, [threshold, threshold],
+                head_thresholds=[0., 2.])
+            loop.run()
+            with open(osp.join(log_dir, 'cs470_log', 'test_info.csv')) as f:
+                header = f.readline().strip().split(',')
+        self.assertEqual(header[-1], 'coarse_exit_ratio')
+
+        logger = loop.evaluate_logger
+        self.assertEqual(logger.coarse_exit_ratio_info, [1., 0.])
+        self.assertLess(logger.flops_info[0], logger.flops_info[1])
+        coarse_exit_trace, full_trace = logger.traces
+        self.assertTrue((coarse_exit_trace['exit_stage'] == 4).all())
+        self.assertTrue(
+            (coarse_exit_trace['flops'] < full_trace['flops']).all())
+
+        stage_flops = detector.get_stage_flops((96, 128))[3]
+        skipped_flops = detector.get_coarse_exit_flops((96, 128))[3]
+        self.assertGreater(skipped_flops, 0)
+        self.assertTrue(np.allclose(full_trace['flops'], stage_flops))
+        self.assertTrue(
+            np.allclose(coarse_exit_trace['flops'],
+                        stage_flops - skipped_flops))
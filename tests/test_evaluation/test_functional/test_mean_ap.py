@@ -0,0 +1,118 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import contextlib
+import io
+from functools import partial
+from unittest import TestCase
+
+import numpy as np
+
+from mmdet.evaluation.functional import eval_map
+from mmdet.evaluation.functional.mean_ap import (tpfp_default,
+                                                 tpfp_default_batched,
+                                                 tpfp_imagenet,
+                                                 tpfp_imagenet_batched)
+
+
+def _random_bboxes(rng, num, with_score=False):
+    xy = rng.uniform(0, 300, size=(num, 2))
+    wh = rng.uniform(2, 100, size=(num, 2))
+    bboxes = np.hstack((xy, xy + wh)).astype(np.float32)
+    if with_score:
+        # distinct scores, so that the order of the dets is well defined
+        scores = rng.permutation(1000)[:num] / 1000
+        bboxes = np.hstack((bboxes, scores[:, None].astype(np.float32)))
+    return bboxes
+
+
+class TestMeanAP(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.num_classes = 3
+        self.det_results = []
+        self.annotations = []
+        for i in range(20):
+            num_gts = int(rng.integers(0, 8))
+            gts = _random_bboxes(rng, num_gts)
+            labels = rng.integers(0, self.num_classes, size=num_gts)
+            ignores = _random_bboxes(rng, int(rng.integers(0, 2)))
+            self.annotations.append(
+                dict(
+                    bboxes=gts,
+                    labels=labels,
+                    bboxes_ignore=ignores,
+                    labels_ignore=rng.integers(
+                        0, self.num_classes, size=len(ignores))))
+            dets = []
+            for c in range(self.num_classes):
+                # dets around the gts and the ignored gts, and random ones
+                near = np.vstack((gts[labels == c], ignores))
+                near = near + rng.normal(0, 5, size=near.shape).astype(
+                    np.float32)
+                near = np.vstack((near, near[:1]))
+                cls_dets = np.vstack(
+                    (np.hstack((near, np.zeros((len(near), 1), np.float32))),
+                     _random_bboxes(rng, int(rng.integers(0, 4)), True)))
+                cls_dets[:, 4] = rng.permutation(1000)[:len(cls_dets)] / 1000
+                dets.append(cls_dets)
+            self.det_results.append(dets)
+
+    def _cls_results(self, class_id):
+        cls_dets = [dets[class_id] for dets in self.det_results]
+        cls_gts = [
+            ann['bboxes'][ann['labels'] == class_id]
+            for ann in self.annotations
+        ]
+        cls_gts_ignore = [
+            ann['bboxes_ignore'][ann['labels_ignore'] == class_id]
+            for ann in self.annotations
+        ]
+        return cls_dets, cls_gts, cls_gts_ignore
+
+    def test_tpfp_batched(self):
+        area_ranges = [(0, 1e10), (0, 32**2), (32**2, 64**2), (64**2, 1e10)]
+        for tpfp_fn, batched_fn in ((tpfp_default, tpfp_default_batched),
+                                    (tpfp_imagenet, tpfp_imagenet_batched)):
+            for c in range(self.num_classes):
+                for ranges in (None, area_ranges):
+                    for legacy in (False, True):
+                        cls_results = self._cls_results(c)
+                        expected = [
+                            tpfp_fn(*args, 0.5, ranges, legacy)
+                            for args in zip(*cls_results)
+                        ]
+                        # a small max_elements splits the images to chunks
+                        tp, fp = batched_fn(
+                            *cls_results, 0.5, ranges, legacy, max_elements=64)
+                        np.testing.assert_array_equal(
+                            tp, np.hstack([res[0] for res in expected]))
+                        np.testing.assert_array_equal(
+                            fp, np.hstack([res[1] for res in expected]))
+
+    def test_eval_map(self):
+        for dataset in (None, 'det'):
+            for scale_ranges in (None, [(0, 32), (32, 1e5)]):
+                kwargs = dict(
+                    scale_ranges=scale_ranges,
+                    dataset=dataset,
+                    use_legacy_coordinate=True)
+                tpfp_fn = tpfp_imagenet if dataset else tpfp_default
+                with contextlib.redirect_stdout(io.StringIO()):
+                    # a partial function is evaluated image by image
+                    expected, expected_results = eval_map(
+                        self.det_results,
+                        self.annotations,
+                        tpfp_fn=partial(tpfp_fn),
+                        nproc=1,
+                        **kwargs)
+                    for nproc in (1, 2):
+                        mean_ap, results = eval_map(
+                            self.det_results,
+                            self.annotations,
+                            nproc=nproc,
+                            **kwargs)
+                        np.testing.assert_allclose(mean_ap, expected)
+                        for result, expected_result in zip(
+                                results, expected_results):
+                            np.testing.assert_array_equal(
+                                result['ap'], expected_result['ap'])
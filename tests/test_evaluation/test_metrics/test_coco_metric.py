@@ -1,11 +1,12 @@
 import os.path as osp
 import tempfile
 from unittest import TestCase
+from unittest.mock import patch
 
 import numpy as np
 import pycocotools.mask as mask_util
 import torch
-from mmengine.fileio import dump
+from mmengine.fileio import dump, load
 
 from mmdet.evaluation import CocoMetric
 
@@ -223,6 +224,107 @@ class TestCocoMetric(TestCase):
         }
         self.assertDictEqual(eval_results, target)
 
+    def test_fast_evaluate(self):
+        # create dummy data
+        fake_json_file = osp.join(self.tmp_dir.name, 'fake_data.json')
+        self._create_dummy_coco_json(fake_json_file)
+        dummy_pred = self._create_dummy_results()
+        # a duplicated and a shifted box, so that not every AP is 1
+        dummy_pred['bboxes'][1] = torch.tensor([50, 60, 70, 80])
+        dummy_pred['bboxes'][3] = torch.tensor([260, 270, 360, 370])
+
+        eval_results = []
+        for use_fast_eval in (False, True):
+            coco_metric = CocoMetric(
+                ann_file=fake_json_file,
+                metric=['bbox', 'proposal'],
+                classwise=True,
+                use_fast_eval=use_fast_eval)
+            coco_metric.dataset_meta = dict(classes=['car', 'bicycle'])
+            coco_metric.process({}, [
+                dict(
+                    pred_instances=dummy_pred, img_id=0, ori_shape=(640, 640))
+            ])
+            eval_results.append(coco_metric.evaluate(size=1))
+        self.assertDictEqual(eval_results[1], eval_results[0])
+
+    def test_streaming_evaluate(self):
+        fake_json_file = osp.join(self.tmp_dir.name, 'fake_data.json')
+        self._create_dummy_coco_json(fake_json_file)
+        dummy_pred = self._create_dummy_results()
+        dummy_pred['bboxes'][1] = torch.tensor([50, 60, 70, 80])
+        dummy_pred['bboxes'][3] = torch.tensor([260, 270, 360, 370])
+
+        eval_results = []
+        for streaming in (False, True):
+            coco_metric = CocoMetric(
+                ann_file=fake_json_file,
+                metric=['bbox', 'proposal'],
+                classwise=True,
+                streaming=streaming)
+            coco_metric.dataset_meta = dict(classes=['car', 'bicycle'])
+            coco_metric.process({}, [
+                dict(
+                    pred_instances=dummy_pred, img_id=0, ori_shape=(640, 640))
+            ])
+            eval_results.append(coco_metric.evaluate(size=1))
+        self.assertDictEqual(eval_results[1], eval_results[0])
+
+        # the masks are not matched while testing
+        with self.assertRaises(AssertionError):
+            CocoMetric(ann_file=fake_json_file, metric='segm', streaming=True)
+
+    def test_results2json(self):
+        fake_json_file = osp.join(self.tmp_dir.name, 'fake_data.json')
+        self._create_dummy_coco_json(fake_json_file)
+        dummy_pred = self._create_dummy_results()
+
+        coco_metric = CocoMetric(ann_file=fake_json_file)
+        coco_metric.dataset_meta = dict(classes=['car', 'bicycle'])
+        coco_metric.cat_ids = [0, 1]
+        # more than one chunk
+        coco_metric.json_chunk_size = 3
+        coco_metric.process(
+            {},
+            [dict(pred_instances=dummy_pred, img_id=0, ori_shape=(640, 640))])
+        preds = [result for _, result in coco_metric.results]
+        result_files = coco_metric.results2json(preds,
+                                                f'{self.tmp_dir.name}/test')
+        bbox_results = load(result_files['bbox'])
+        segm_results = load(result_files['segm'])
+        self.assertEqual(len(bbox_results), 4)
+        self.assertEqual(len(segm_results), 4)
+        for i, (bbox_result, segm_result) in enumerate(
+                zip(bbox_results, segm_results)):
+            self.assertEqual(bbox_result['image_id'], 0)
+            self.assertEqual(bbox_result['bbox'],
+                             coco_metric.xyxy2xywh(preds[0]['bboxes'][i]))
+            self.assertEqual(bbox_result['score'],
+                             float(preds[0]['scores'][i]))
+            self.assertEqual(bbox_result['category_id'],
+                             int(preds[0]['labels'][i]))
+            self.assertEqual(segm_result['bbox'], bbox_result['bbox'])
+            self.assertIn('segmentation', segm_result)
+
+    def test_evaluate_in_memory(self):
+        fake_json_file = osp.join(self.tmp_dir.name, 'fake_data.json')
+        self._create_dummy_coco_json(fake_json_file)
+        dummy_pred = self._create_dummy_results()
+
+        # no json file is written without outfile_prefix
+        coco_metric = CocoMetric(
+            ann_file=fake_json_file, metric=['bbox', 'segm'])
+        coco_metric.dataset_meta = dict(classes=['car', 'bicycle'])
+        with patch.object(coco_metric, 'results2json') as results2json:
+            coco_metric.process({}, [
+                dict(
+                    pred_instances=dummy_pred, img_id=0, ori_shape=(640, 640))
+            ])
+            eval_results = coco_metric.evaluate(size=1)
+        results2json.assert_not_called()
+        self.assertEqual(eval_results['coco/bbox_mAP'], 1.0)
+        self.assertEqual(eval_results['coco/segm_mAP'], 1.0)
+
     def test_manually_set_iou_thrs(self):
         # create dummy data
         fake_json_file = osp.join(self.tmp_dir.name, 'fake_data.json')
@@ -0,0 +1,121 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from unittest import TestCase
+
+import numpy as np
+import torch
+from parameterized import parameterized
+
+from mmdet.evaluation import VOCMetric
+from mmdet.evaluation.functional import eval_map
+
+
+class TestVOCMetric(TestCase):
+
+    classes = ('car', 'bicycle', 'person')
+
+    def _create_dummy_data_samples(self, num_imgs=7):
+        """Data samples with jittered and false positive predictions, gts
+        of various sizes and some ignored gts."""
+        rng = np.random.RandomState(0)
+        data_samples = []
+        for i in range(num_imgs):
+            num_gts = rng.randint(1, 5)
+            xy = rng.uniform(0, 400, (num_gts, 2))
+            # from 8 to 200 pixels, across the scale ranges
+            wh = rng.uniform(8, 200, (num_gts, 2))
+            gt_bboxes = np.hstack([xy, xy + wh])
+            gt_labels = rng.randint(len(self.classes), size=num_gts)
+
+            pred_bboxes = gt_bboxes + rng.uniform(-10, 10, gt_bboxes.shape)
+            pred_labels = gt_labels.copy()
+            # some predictions take the wrong class
+            wrong = rng.rand(num_gts) < 0.3
+            pred_labels[wrong] = rng.randint(
+                len(self.classes), size=wrong.sum())
+            num_fps = rng.randint(0, 4)
+            fp_xy = rng.uniform(0, 400, (num_fps, 2))
+            fp_bboxes = np.hstack(
+                [fp_xy, fp_xy + rng.uniform(8, 200, (num_fps, 2))])
+            pred_bboxes = np.vstack([pred_bboxes, fp_bboxes])
+            pred_labels = np.concatenate(
+                [pred_labels,
+                 rng.randint(len(self.classes), size=num_fps)])
+            pred_scores = rng.rand(len(pred_labels))
+
+            # ignored gts on every other image, one of them predicted
+            num_ignored = i % 2
+            ignored_bboxes = gt_bboxes[:num_ignored] + 5
+            ignored_labels = gt_labels[:num_ignored]
+
+            data_samples.append(
+                dict(
+                    gt_instances=dict(
+                        bboxes=torch.from_numpy(gt_bboxes).float(),
+                        labels=torch.from_numpy(gt_labels)),
+                    ignored_instances=dict(
+                        bboxes=torch.from_numpy(ignored_bboxes).float(),
+                        labels=torch.from_numpy(ignored_labels)),
+                    pred_instances=dict(
+                        bboxes=torch.from_numpy(pred_bboxes).float(),
+                        scores=torch.from_numpy(pred_scores).float(),
+                        labels=torch.from_numpy(pred_labels))))
+        return data_samples
+
+    @parameterized.expand([
+        ('VOC2007', None),
+        ('VOC2007', [(0, 32), (32, 96), (96, 1e5)]),
+        (None, None),
+        (None, [(0, 32), (32, 96), (96, 1e5)]),
+    ])
+    def test_streaming_evaluate(self, dataset_type, scale_ranges):
+        data_samples = self._create_dummy_data_samples()
+        dataset_meta = dict(classes=self.classes)
+        if dataset_type is not None:
+            # tpfp_default, otherwise tpfp_imagenet as eval_map with 'det'
+            dataset_meta['dataset_type'] = dataset_type
+        eval_mode = '11points' if dataset_type == 'VOC2007' else 'area'
+        iou_thrs = [0.5, 0.75]
+
+        metrics = []
+        for streaming in (False, True):
+            metric = VOCMetric(
+                iou_thrs=iou_thrs,
+                scale_ranges=scale_ranges,
+                eval_mode=eval_mode,
+                streaming=streaming)
+            metric.dataset_meta = dataset_meta
+            # several batches of different sizes
+            for start, end in [(0, 3), (3, 4), (4, 7)]:
+                metric.process({}, data_samples[start:end])
+            metrics.append(metric)
+        metric, stream_metric = metrics
+        stream_metric._stream_worker.join()
+        self.assertEqual(len(stream_metric.results), len(data_samples))
+
+        # the same AP as eval_map at each IoU threshold
+        gts, preds = zip(*metric.results)
+        dataset_name = 'voc' if dataset_type is not None else 'det'
+        for i, iou_thr in enumerate(iou_thrs):
+            expected_map, expected_results = eval_map(
+                preds,
+                gts,
+                scale_ranges=scale_ranges,
+                iou_thr=iou_thr,
+                dataset=dataset_name,
+                logger='silent',
+                eval_mode=eval_mode,
+                use_legacy_coordinate=True)
+            stream_map, stream_results = stream_metric._eval_stream_map(
+                stream_metric.results, i, dataset_name, 'silent')
+            np.testing.assert_allclose(stream_map, expected_map)
+            for stream_result, expected_result in zip(stream_results,
+                                                      expected_results):
+                np.testing.assert_array_equal(stream_result['num_gts'],
+                                              expected_result['num_gts'])
+                np.testing.assert_allclose(stream_result['ap'],
+                                           expected_result['ap'])
+
+        eval_results = [m.evaluate(size=len(data_samples)) for m in metrics]
+        self.assertEqual(list(eval_results[1]), list(eval_results[0]))
+        for key, value in eval_results[0].items():
+            np.testing.assert_allclose(eval_results[1][key], value)
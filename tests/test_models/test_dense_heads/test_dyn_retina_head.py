@@ -0,0 +1,122 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from unittest import TestCase
+
+import torch
+
+from mmdet import *  # noqa
+from mmdet.models.dense_heads import DynRetinaHead
+
+
+class TestDynRetinaHead(TestCase):
+
+    def _get_head_and_feats(self, num_imgs=3, s=256):
+        torch.manual_seed(0)
+        head = DynRetinaHead(num_classes=4, in_channels=1, feat_channels=2,
+                             stacked_convs=1)
+        head.init_weights()
+        head.eval()
+        feats = tuple(
+            torch.rand(num_imgs, 1, s // stride, s // stride)
+            for stride in head.prior_generator.strides)
+        return head, feats
+
+    def test_coarse_exit(self):
+        head, feats = self._get_head_and_feats()
+        with torch.no_grad():
+            cls_scores, bbox_preds = head(feats)
+            coarse_scores, _ = head.get_coarse_scores(
+                [cls_scores[level] for level in head.coarse_levels])
+
+            # every image exits, the fine levels are filled
+            head.set_coarse_exit_threshold(0.)
+            exit_cls_scores, exit_bbox_preds = head(feats)
+        self.assertEqual(head.last_coarse_exits, [True] * 3)
+        for level in range(len(feats)):
+            if level in head.coarse_levels:
+                self.assertTrue(
+                    torch.allclose(exit_cls_scores[level], cls_scores[level]))
+            else:
+                self.assertTrue((exit_cls_scores[level] == -1e4).all())
+                self.assertTrue((exit_bbox_preds[level] == 0).all())
+
+        # only the images above the threshold exit
+        threshold = coarse_scores.median().item()
+        head.set_coarse_exit_threshold(threshold)
+        with torch.no_grad():
+            exit_cls_scores, _ = head(feats)
+        expected_exits = (coarse_scores >= threshold).tolist()
+        self.assertEqual(head.last_coarse_exits, expected_exits)
+        for i, coarse_exit in enumerate(expected_exits):
+            if not coarse_exit:
+                self.assertTrue(
+                    torch.allclose(exit_cls_scores[0][i], cls_scores[0][i],
+                                   atol=1e-6))
+
+    def test_coarse_exit_inactive_levels(self):
+        head, feats = self._get_head_and_feats()
+        # P5~P7 after an early exit of a zero-padded backbone
+        feats = feats[:2] + tuple(torch.zeros_like(feat)
+                                  for feat in feats[2:])
+        active = [True, True, False, False, False]
+        with torch.no_grad():
+            cls_scores, _ = head(feats, active)
+            # the constant coarse levels must not let any image exit
+            head.set_coarse_exit_threshold(0.)
+            exit_cls_scores, _ = head(feats, active)
+        self.assertEqual(head.last_coarse_exits, [False] * 3)
+        for exit_cls_score, cls_score in zip(exit_cls_scores, cls_scores):
+            self.assertTrue(torch.allclose(exit_cls_score, cls_score))
+
+        # only the active coarse level is scored
+        active = [True, True, True, False, False]
+        self.assertEqual(head.get_active_coarse_levels(len(feats), active),
+                         [2])
+        with torch.no_grad():
+            p5_scores, _ = head.get_coarse_scores(
+                [head.forward_single(feats[2])[0]])
+            threshold = p5_scores.median().item()
+            head.set_coarse_exit_threshold(threshold)
+            head(feats, active)
+        self.assertEqual(head.last_coarse_exits,
+                         (p5_scores >= threshold).tolist())
+
+    def test_zero_level_cache(self):
+        head, feats = self._get_head_and_feats()
+        # levels built only from the zero maps after an early exit
+        for num_active in range(1, len(feats) + 1):
+            active = [level < num_active for level in range(len(feats))]
+            with torch.no_grad():
+                expected = head(feats)
+                # the first call fills the cache, the second uses it
+                for _ in range(2):
+                    cls_scores, bbox_preds = head(feats, active)
+                    for out, expected_out in zip(cls_scores + bbox_preds,
+                                                 expected[0] + expected[1]):
+                        self.assertTrue(
+                            torch.allclose(out, expected_out, atol=1e-6))
+        self.assertEqual(len(head._zero_level_cache), len(feats) - 1)
+
+        # train() clears the cache, which is not used in train mode
+        head.train()
+        self.assertEqual(len(head._zero_level_cache), 0)
+        active = [True, True, False, False, False]
+        with torch.no_grad():
+            head(feats, active)
+        self.assertEqual(len(head._zero_level_cache), 0)
+
+        # loading new weights clears the cache
+        head.eval()
+        with torch.no_grad():
+            head(feats, active)
+        self.assertEqual(len(head._zero_level_cache), 3)
+        other, _ = self._get_head_and_feats()
+        with torch.no_grad():
+            for param in other.parameters():
+                param.add_(1)
+        head.load_state_dict(other.state_dict())
+        self.assertEqual(len(head._zero_level_cache), 0)
+        with torch.no_grad():
+            cls_scores, _ = head(feats, active)
+            expected_cls_scores, _ = other(feats)
+        for out, expected_out in zip(cls_scores, expected_cls_scores):
+            self.assertTrue(torch.allclose(out, expected_out, atol=1e-5))
@@ -0,0 +1,121 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from unittest import TestCase
+
+import torch
+import torch.nn as nn
+from mmengine.analysis import FlopAnalyzer
+from mmengine.structures import InstanceData
+from parameterized import parameterized
+
+from mmdet.registry import MODELS
+from mmdet.structures import DetDataSample
+from mmdet.testing import get_detector_cfg
+from mmdet.utils import register_all_modules
+
+_CFG_FILE = '../model_configs/coco/baseline/' \
+    'retinanet_dyn_perceiver-800MF_fpn_1x_coco_single-base.py'
+
+
+class _NeckHead(nn.Module):
+    """Neck and head of an early exit, as traced by the previous counter."""
+
+    def __init__(self, detector, active):
+        super().__init__()
+        self.detector = detector
+        self.active = active
+
+    def forward(self, *feats):
+        return self.detector._forward_neck_head(feats, self.active)
+
+
+class TestDynRetinaNet(TestCase):
+
+    def setUp(self):
+        register_all_modules()
+
+    @parameterized.expand(['DynPerceiverZeromap', 'DynPerceiverDownSampling'])
+    def test_stage_flops(self, backbone_type):
+        model = get_detector_cfg(_CFG_FILE)
+        model.backbone.type = backbone_type
+        detector = MODELS.build(model).eval()
+
+        # odd feature sizes on the deeper levels
+        input_shape = (96, 160)
+        stage_flops = detector.get_stage_flops(input_shape)
+        backbone_flops = detector.backbone.get_stage_flops(input_shape)
+        self.assertEqual(len(stage_flops), 4)
+        self.assertEqual(stage_flops, sorted(stage_flops))
+        # memoized per input shape
+        self.assertIs(detector.get_stage_flops(input_shape), stage_flops)
+
+        x = torch.zeros(1, 3, *input_shape)
+        with torch.no_grad():
+            exit_outs = detector.backbone.forward_all_exits(x)[0]
+        for stage, outs in enumerate(exit_outs, start=1):
+            active = detector.get_active_levels(stage)[:len(outs)]
+            neck_head = _NeckHead(detector, active).eval()
+            with torch.no_grad():
+                # the previous counter also ran once to fill the zero level
+                # caches first
+                neck_head(*outs)
+                analyzer = FlopAnalyzer(neck_head, tuple(outs))
+                analyzer.unsupported_ops_warnings(False)
+                analyzer.uncalled_modules_warnings(False)
+                conv_flops = sum(
+                    flops for op, flops in analyzer.by_operator().items()
+                    if 'conv' in op)
+            self.assertEqual(
+                stage_flops[stage - 1] - int(backbone_flops[stage - 1]),
+                conv_flops)
+
+        self.assertEqual(
+            detector.get_sample_flops([input_shape] * 4, [1, 2, 3, 4]),
+            stage_flops)
+
+    def test_stage_flops_without_exit(self):
+        model = get_detector_cfg(_CFG_FILE)
+        model.backbone.type = 'DynPerceiverBaseline'
+        detector = MODELS.build(model).eval()
+        input_shape = (96, 160)
+        stage_flops = detector.get_stage_flops(input_shape)
+        # the whole model runs whatever the threshold
+        self.assertEqual(len(set(stage_flops)), 1)
+        with torch.no_grad():
+            analyzer = FlopAnalyzer(detector,
+                                    torch.zeros(1, 3, *input_shape))
+            analyzer.unsupported_ops_warnings(False)
+            analyzer.uncalled_modules_warnings(False)
+            self.assertEqual(stage_flops[0], analyzer.total())
+        self.assertEqual(
+            detector.get_sample_flops([input_shape] * 2, [4, 4]),
+            stage_flops[:2])
+
+    def test_classifier_correct(self):
+        detector = MODELS.build(get_detector_cfg(_CFG_FILE)).eval()
+        x = torch.rand(2, 3, 96, 128)
+        with torch.no_grad():
+            y_early3 = detector.backbone.forward_all_exits(x)[1]
+        confidences, labels = y_early3.softmax(dim=1).max(dim=1)
+        self.assertNotEqual(confidences[0].item(), confidences[1].item())
+
+        data_samples = []
+        for label in labels:
+            data_sample = DetDataSample(
+                metainfo=dict(
+                    img_shape=(96, 128),
+                    ori_shape=(96, 128),
+                    scale_factor=(1., 1.),
+                    batch_input_shape=(96, 128)))
+            # the label predicted by the stage 1 classifier
+            data_sample.gt_instances = InstanceData(
+                bboxes=torch.zeros(1, 4), labels=label.view(1))
+            data_samples.append(data_sample)
+
+        # only the more confident image reaches the stage 1 threshold, but
+        # without batched exit the whole batch exits there
+        detector.set_threshold(
+            torch.tensor([confidences.mean().item(), 2., 2., -1.]))
+        with torch.no_grad():
+            detector.predict(x, data_samples)
+        self.assertEqual(detector.backbone.get_last_exited_stages(), [1, 1])
+        self.assertEqual(detector.classifiy_correct.tolist(), [True, True])
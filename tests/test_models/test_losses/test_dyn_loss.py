@@ -0,0 +1,79 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import pytest
+import torch
+import torch.nn.functional as F
+
+from mmdet.models.losses.dyn_loss import DynLoss
+
+
+def _reference_criterion(loss_fn, pred, target):
+    """Per-exit criterion of the previous DynLoss.
+
+    ``SoftTargetCrossEntropy`` with mixup, ``LabelSmoothingCrossEntropy``
+    with smoothing and ``CrossEntropyLoss`` otherwise.
+    """
+    log_probs = F.log_softmax(pred, dim=1)
+    if loss_fn.mixup_fn is None and loss_fn.smoothing > 0.:
+        nll = F.nll_loss(log_probs, target, reduction='none')
+        smooth = -log_probs.mean(dim=1)
+        return ((1. - loss_fn.smoothing) * nll +
+                loss_fn.smoothing * smooth).mean()
+    if target.dim() == 1:
+        return F.cross_entropy(pred, target)
+    return -(target * log_probs).sum(dim=1).mean()
+
+
+def _reference_forward(loss_fn, pred, target):
+    """The previous DynLoss.forward, one exit at a time."""
+    loss_early3, loss_att, loss_cnn, loss_merge = (
+        _reference_criterion(loss_fn, p, target) for p in pred)
+    loss = loss_fn.loss_cnn_factor * loss_cnn + \
+        loss_fn.loss_att_factor * (loss_att + loss_early3) + \
+        loss_fn.loss_merge_factor * loss_merge
+    if loss_fn.with_kd:
+        teacher_probs = F.softmax(pred[3].detach() / loss_fn.T_kd, dim=1)
+        kd_loss = sum(
+            F.kl_div(
+                F.log_softmax(p / loss_fn.T_kd, dim=1),
+                teacher_probs,
+                reduction='batchmean') * loss_fn.T_kd**2 for p in pred[:3])
+        loss += loss_fn.alpha_kd * kd_loss
+    return loss
+
+
+def _loss_and_grads(fn, pred, target):
+    pred = [p.detach().clone().requires_grad_() for p in pred]
+    loss = fn(pred, target)
+    loss.backward()
+    return loss.detach(), [p.grad for p in pred]
+
+
+@pytest.mark.parametrize('with_kd', [True, False])
+@pytest.mark.parametrize('target_type',
+                         ['one_hot', 'class_index', 'smoothing', 'mixup'])
+def test_dyn_loss_matches_per_exit(target_type, with_kd):
+    torch.manual_seed(0)
+    num_imgs, num_classes = 6, 10
+    pred = [torch.randn(num_imgs, num_classes) for _ in range(4)]
+    labels = torch.randint(num_classes, (num_imgs, ))
+    kwargs = dict(with_kd=with_kd, T_kd=2.0)
+    if target_type == 'one_hot':
+        target = F.one_hot(labels, num_classes=num_classes).float()
+    elif target_type == 'class_index':
+        target = labels
+    elif target_type == 'smoothing':
+        target = labels
+        kwargs['smoothing_'] = 0.1
+    else:
+        # mixed soft target, smoothing is ignored with mixup
+        target = torch.rand(num_imgs, num_classes).softmax(dim=1)
+        kwargs.update(mixup_fn=lambda x, y: (x, y), smoothing_=0.1)
+    loss_fn = DynLoss(theta_factor=1.15e-2, lambda_factor=1.0, **kwargs)
+
+    loss, grads = _loss_and_grads(loss_fn, pred, target)
+    expected_loss, expected_grads = _loss_and_grads(
+        lambda p, t: _reference_forward(loss_fn, p, t), pred, target)
+    assert loss.shape == expected_loss.shape
+    assert torch.allclose(loss, expected_loss, atol=1e-5)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-6)
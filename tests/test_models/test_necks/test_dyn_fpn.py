@@ -0,0 +1,99 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import torch
+
+from mmdet.models.necks import DynFPN
+
+
+def _build_dyn_fpn(**kwargs):
+    torch.manual_seed(0)
+    # the RetinaNet neck of the DynPerceiver configs
+    return DynFPN(
+        in_channels=[4, 6, 8, 10],
+        out_channels=8,
+        start_level=1,
+        add_extra_convs='on_output',
+        num_outs=5,
+        **kwargs).eval()
+
+
+def _exit_inputs(neck, feat_sizes, stage, num_imgs=2):
+    """Backbone levels of a zero-padded early exit at ``stage`` and their
+    activity."""
+    active = [level <= stage for level in range(len(feat_sizes))]
+    inputs = []
+    for level, (h, w) in enumerate(feat_sizes):
+        feat = torch.rand(num_imgs, neck.in_channels[level], h, w)
+        inputs.append(feat if active[level] else torch.zeros_like(feat))
+    return tuple(inputs), active
+
+
+def test_dyn_fpn_zero_level_cache():
+    """The cached zero levels match the uncached forward at every exit."""
+    neck = _build_dyn_fpn()
+    # odd sizes, as halved with ceil by the backbone
+    feat_sizes = [(50, 38), (25, 19), (13, 10), (7, 5)]
+    for stage in range(1, 5):
+        inputs, active = _exit_inputs(neck, feat_sizes, stage)
+        with torch.no_grad():
+            expected = neck(inputs)
+            # twice: the first call fills the cache, the second uses it
+            for _ in range(2):
+                outs = neck(inputs, active)
+                assert len(outs) == len(expected)
+                for out, expected_out in zip(outs, expected):
+                    assert out.shape == expected_out.shape
+                    assert torch.allclose(out, expected_out, atol=1e-5)
+        num_active = sum(active[neck.start_level:])
+        assert neck.get_active_outs(active) == [
+            i < num_active or all(active) for i in range(neck.num_outs)
+        ]
+    # one entry per early exit with inactive levels (stage 1 and 2)
+    assert len(neck._zero_level_cache) == 2
+
+
+def test_dyn_fpn_zero_level_cache_clear():
+    neck = _build_dyn_fpn()
+    feat_sizes = [(32, 32), (16, 16), (8, 8), (4, 4)]
+    inputs, active = _exit_inputs(neck, feat_sizes, 1)
+    with torch.no_grad():
+        neck(inputs, active)
+    assert len(neck._zero_level_cache) == 1
+
+    # train() clears the cache, which is not used in train mode
+    neck.train()
+    assert len(neck._zero_level_cache) == 0
+    with torch.no_grad():
+        neck(inputs, active)
+    assert len(neck._zero_level_cache) == 0
+
+    # loading new weights clears the cache
+    neck.eval()
+    with torch.no_grad():
+        neck(inputs, active)
+    assert len(neck._zero_level_cache) == 1
+    other = _build_dyn_fpn()
+    with torch.no_grad():
+        for param in other.parameters():
+            param.add_(1)
+    neck.load_state_dict(other.state_dict())
+    assert len(neck._zero_level_cache) == 0
+    with torch.no_grad():
+        outs = neck(inputs, active)
+        expected = other(inputs)
+    for out, expected_out in zip(outs, expected):
+        assert torch.allclose(out, expected_out, atol=1e-5)
+
+
+def test_dyn_fpn_static_shapes():
+    """With ``static_shapes`` every exit gives the output shapes of the full
+    backbone, also for odd sizes."""
+    neck = _build_dyn_fpn(static_shapes=True)
+    # odd sizes, as halved with ceil by the backbone
+    feat_sizes = [(50, 38), (25, 19), (13, 10), (7, 5)]
+    inputs, _ = _exit_inputs(neck, feat_sizes, 3)
+    with torch.no_grad():
+        expected_shapes = [out.shape for out in neck(inputs)]
+        # an early exit without zero padding gives only the computed levels
+        for num_levels in range(2, 5):
+            outs = neck(inputs[:num_levels])
+            assert [out.shape for out in outs] == expected_shapes
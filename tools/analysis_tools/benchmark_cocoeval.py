@@ -0,0 +1,130 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import argparse
+import contextlib
+import io
+import os
+import platform
+import time
+import warnings
+
+import numpy as np
+
+from mmdet.datasets.api_wrappers import COCO, COCOeval, COCOevalMP
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the scaling of COCOevalMP')
+    parser.add_argument('ann_file', help='coco annotation file')
+    parser.add_argument(
+        'result_file', help='coco style result json file to evaluate')
+    parser.add_argument(
+        '--iou-type',
+        choices=['bbox', 'segm', 'keypoints'],
+        default='bbox',
+        help='iou type to evaluate')
+    parser.add_argument(
+        '--nproc',
+        type=int,
+        nargs='+',
+        default=[2, 4, 8, 16, 32],
+        help='numbers of processes to benchmark')
+    parser.add_argument(
+        '--tasks-per-proc',
+        type=int,
+        default=4,
+        help='number of tasks per process of COCOevalMP')
+    parser.add_argument(
+        '--repeat-num',
+        type=int,
+        default=1,
+        help='number of repeat times of measurement for averaging the results')
+    parser.add_argument(
+        '--markdown',
+        action='store_true',
+        help='print the results as a markdown table with the hardware, as '
+        'recorded in the documentation')
+    return parser.parse_args()
+
+
+def hardware_info():
+    """Return the CPU model and the number of logical cores."""
+    model = platform.processor() or platform.machine()
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    model = line.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return f'{model}, {os.cpu_count()} logical cores'
+
+
+def run(coco_gt, result_file, iou_type, nproc=None, tasks_per_proc=4):
+    """Evaluate once and return (evaluate time, stats)."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_dt = coco_gt.loadRes(result_file)
+        if nproc is None:
+            coco_eval = COCOeval(coco_gt, coco_dt, iou_type)
+        else:
+            coco_eval = COCOevalMP(
+                coco_gt,
+                coco_dt,
+                iou_type,
+                nproc=nproc,
+                tasks_per_proc=tasks_per_proc)
+        start = time.perf_counter()
+        coco_eval.evaluate()
+        elapsed = time.perf_counter() - start
+        coco_eval.accumulate()
+        coco_eval.summarize()
+    return elapsed, coco_eval.stats
+
+
+def main():
+    args = parse_args()
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_gt = COCO(args.ann_file)
+
+    def measure(nproc=None):
+        times = []
+        for _ in range(args.repeat_num):
+            elapsed, stats = run(coco_gt, args.result_file, args.iou_type,
+                                 nproc, args.tasks_per_proc)
+            times.append(elapsed)
+        return float(np.mean(times)), stats
+
+    num_cores = os.cpu_count()
+    if num_cores is not None and max(args.nproc) > num_cores:
+        warnings.warn(f'--nproc {max(args.nproc)} exceeds the {num_cores} '
+                      'cores of this machine, the efficiency is not '
+                      'meaningful beyond them')
+
+    base_time, base_stats = measure()
+    results = []
+    for nproc in args.nproc:
+        elapsed, stats = measure(nproc)
+        speedup = base_time / elapsed
+        same = bool(np.allclose(stats, base_stats, rtol=0, atol=1e-12))
+        results.append((nproc, elapsed, speedup, same))
+
+    if args.markdown:
+        print(f'Hardware: {hardware_info()}\n')
+        print('| nproc | evaluate (s) | speedup | efficiency | same stats |')
+        print('| :---: | :----------: | :-----: | :--------: | :--------: |')
+        print(f'| COCOeval | {base_time:.2f} | 1.00x | - | - |')
+        for nproc, elapsed, speedup, same in results:
+            print(f'| {nproc} | {elapsed:.2f} | {speedup:.2f}x | '
+                  f'{speedup / nproc:.2f} | {same} |')
+        return
+
+    print(f'COCOeval: evaluate {base_time:.2f}s')
+    print(f'{"nproc":>6} {"time":>8} {"speedup":>8} {"efficiency":>10} '
+          f'{"same stats":>10}')
+    for nproc, elapsed, speedup, same in results:
+        print(f'{nproc:>6} {elapsed:>7.2f}s {speedup:>7.2f}x '
+              f'{speedup / nproc:>10.2f} {str(same):>10}')
+
+if __name__ == '__main__':
+    main()
@@ -41,11 +41,15 @@ set_name = "val2017" # 측정하고자 하는 set name
 output_dir = "coco_analysis" # 어디다가 저장할건지?
 pretrained_file = 'baselines/regnety_800mf_with_dyn_perceiver/reg800m_perceiver_t128.pth' # dynamic perceiver의 pre-train weight을 가져오면 됨.
 draw_bbox_indexes = [] # bbox 그리고 싶은 config의 index를 넣어주면 됩니다. 안그리고 싶으면 비워두면 됨.
+batch_size = 16 # 같은 크기의 image끼리 묶어서 forward할 batch 크기
+num_workers = 4 # image를 읽는 DataLoader worker 수
+device = 'cuda' # GPU가 없으면 'cpu'
 
 # ----------------------------------------------------------------------------------------------------
 
 import pycocotools.coco as _coco
 import os
+from PIL import Image
 from tools.cs470.anaylsis_helper.draw_bbox import draw_bbox, get_size, sanitize_text
 from tools.cs470.anaylsis_helper.dyn_perceiver_test import DynPerceiverTest
 from tools.cs470.anaylsis_helper.imagenet_mapping import get_imagenet_id
@@ -74,15 +78,31 @@ bbox_ratios = []
 exit_stages = []
 estimated_classes = []
 
-def analysis_image(image_id, model, coco, config):
-    annotations = coco.loadAnns(coco.getAnnIds(image_id))
-    if (len(annotations) == 1):
-        image_info = coco.loadImgs(image_id)[0]
+def analysis_images(model, coco, config):
+    """
+    annotation이 하나인 image들을 batch로 forward하고 (cache에 없는 것만), 모든 config의 exit stage를 한 번에 구한다.
+    """
+    image_infos = []
+    for image_id in coco.getImgIds():
+        annotations = coco.loadAnns(coco.getAnnIds(image_id))
+        if (len(annotations) == 1):
+            image_infos.append((coco.loadImgs(image_id)[0], annotations))
+    image_paths = [f"{data_dir}/{set_name}/{str(image_info['id']).zfill(12)}.jpg" for image_info, _ in image_infos]
+    model.run([image_info['id'] for image_info, _ in image_infos], image_paths,
+              [(image_info['width'], image_info['height']) for image_info, _ in image_infos])
+
+    found, values, indexes = model.get([image_info['id'] for image_info, _ in image_infos])
+    thresholds = [config_entry["threshold"] for config_entry in config]
+    # (image 수 x config 수)
+    stages, estimated = model.analysis_thresholds(values[found], indexes[found], thresholds)
+    stages, estimated = stages.tolist(), estimated.tolist()
+    class_names = {}
+    valid = [k for k in range(len(image_infos)) if found[k]]
+    for j, k in enumerate(valid):
+        image_info, annotations = image_infos[k]
+        image_id = image_info['id']
         image_width = image_info["width"]
         image_height = image_info["height"]
-        result, image, value, index = model.forward(image_id, f"{data_dir}/{set_name}/{str(image_id).zfill(12)}.jpg", len(draw_bbox_indexes) > 0)
-        if (result is False):
-            return
         annotation = annotations[0]
 
         x, y, w, h = [int(b) for b in annotation['bbox']]
@@ -90,16 +110,16 @@ def analysis_image(image_id, model, coco, config):
         class_name = sanitize_text(coco.loadCats(annotation["category_id"])[0]["name"])
         append_default(image_id,class_name,image_width,image_height,w,h,w*h,size,(w * h) / (image_width * image_height))
         for config_entry in config:
-            T = config_entry["threshold"]
-            exit_stage, estimated = model.analysis_threshold(value, index, T)
-            estimated_class = sanitize_text(get_imagenet_id(estimated))
-            append_threshold(config_entry['index'], exit_stage, estimated_class)
+            i = config_entry['index']
+            estimated_id = estimated[j][i]
+            if estimated_id not in class_names:
+                class_names[estimated_id] = sanitize_text(get_imagenet_id(estimated_id))
+            append_threshold(i, stages[j][i], class_names[estimated_id])
 
         if (len(draw_bbox_indexes) > 0):
+            image = Image.open(image_paths[k])
             for draw_bbox_index in draw_bbox_indexes:
-                T = config[draw_bbox_index]["threshold"]
-                exit_stage, estimated = model.analysis_threshold(value, index, T)
-                draw_bbox(coco, image, f"{output_dir}/images/{file_name(config[draw_bbox_index], 'images', '')}", set_name, image_id, exit_stage, estimated, annotations)
+                draw_bbox(coco, image, f"{output_dir}/images/{file_name(config[draw_bbox_index], 'images', '')}", set_name, image_id, stages[j][draw_bbox_index], estimated[j][draw_bbox_index], annotations)
 
 def append_default(image_id, class_name, image_width, image_height, bbox_width, bbox_height, bbox_size_1, bbox_size_2, bbox_ratio):
     image_ids.append(image_id)
@@ -133,11 +153,8 @@ def analysis(config):
             os.makedirs(f"{output_dir}/images/{file_name(config[draw_bbox_index], 'images', '')}", exist_ok=True)
         print("\n")
     coco = _coco.COCO(f"{data_dir}/annotations/instances_{set_name}.json")
-    dyn_perceiver = DynPerceiverTest(base_dir, output_dir, pretrained_file)
-    for image_id in tqdm(coco.getImgIds(), desc=f'Analyzing {set_name} images'):
-        analysis_image(image_id, dyn_perceiver, coco, config)
-    
-    dyn_perceiver.save_cache()
+    dyn_perceiver = DynPerceiverTest(base_dir, output_dir, pretrained_file, batch_size, num_workers, device)
+    analysis_images(dyn_perceiver, coco, config)
 
     small_total = 0
     medium_total = 0
@@ -2,19 +2,60 @@ from dyn_perceiver.dyn_perceiver_regnet_model import DynPerceiver
 import torch
 from PIL import Image
 from torchvision import transforms
-import torch.nn as nn
+from torch.utils.data import DataLoader, Dataset
+import numpy as np
 import os
 import json
 import traceback
+from collections import defaultdict
+from tqdm import tqdm
+
+# cache.bin의 record 하나. value / index는 y_early3, y_att, y_cnn, y_merge의 max softmax와 argmax
+CACHE_DTYPE = np.dtype([
+    ('image_id', np.int64),
+    ('value', np.float32, (4,)),
+    ('index', np.int32, (4,)),
+])
+
+class AnalysisDataset(Dataset):
+    def __init__(self, image_ids, image_paths, transform):
+        self.image_ids = image_ids
+        self.image_paths = image_paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getitem__(self, i):
+        try:
+            return self.image_ids[i], self.transform(Image.open(self.image_paths[i])), None
+        except Exception as e:
+            return self.image_ids[i], None, str(e) + "\n" + str(traceback.format_exc())
+
+def collate(batch):
+    # image마다 shape이 다를 수 있으므로 (grayscale 등) stack은 forward 직전에 한다
+    return batch
 
 class DynPerceiverTest:
-    def __init__(self, base_dir, output_dir, pretrained_file, save_frequency = 10):
+    """
+    DynPerceiver의 classifier 결과를 image 단위로 구하고 cache하는 analysis engine.
+    같은 크기의 image끼리 batch로 묶어서 DataLoader로 읽고 forward한다 (padding하지 않으므로 결과는 한 장씩 한 것과 같음).
+    결과는 cache.bin에 고정 크기 record로 append만 하므로, 중간에 끊겨도 이미 저장된 image는 다시 계산하지 않는다.
+    error는 errors.jsonl에 한 줄씩 append한다.
+    """
+    def __init__(self, base_dir, output_dir, pretrained_file, batch_size = 16, num_workers = 4, device = 'cpu'):
         self.checkpoint_path = base_dir + pretrained_file
-        self.cache_path = output_dir + "/cache.json"
+        self.cache_path = output_dir + "/cache.bin"
+        self.errors_path = output_dir + "/errors.jsonl"
+        self.legacy_cache_path = output_dir + "/cache.json"
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.device = device
         self.model = None
-        self.transform = None
-        self.softmax = None
-        self.save_frequency = save_frequency
+        self.transform = transforms.Compose([
+            transforms.ToTensor(),  # 이미지를 텐서로 변환
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),  # 정규화
+        ])
         self.load_cache()
 
     def load_model(self):
@@ -29,87 +70,192 @@ class DynPerceiverTest:
                     with_dwc=True,
                     with_z2x=True,
                     with_isc=True)
-        checkpoint = torch.load(self.checkpoint_path)
+        checkpoint = torch.load(self.checkpoint_path, map_location='cpu')
         self.model.load_state_dict(checkpoint['model'])
-        self.transform = transforms.Compose([
-            transforms.ToTensor(),  # 이미지를 텐서로 변환
-            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),  # 정규화
-        ])
+        self.model.to(self.device)
         self.model.eval()
-        self.softmax = nn.Softmax(dim=0)
-
-    def id_forward(self, image_id):
-        cache = self.cache.get(str(image_id))
-        if (cache is None):
-            return False, [], []
-        value = cache['value']
-        index = cache['index']
-        return True, value, index
-    
-    def model_forward(self, image: Image, image_id):
-        try:
-            image_tensor = self.transform(image).unsqueeze(0)
-            with torch.no_grad():
-                y_early3, y_att, y_cnn, y_merge, _ = self.model.forward(image_tensor)
-        except Exception as e:
-            self.errors[f"{image_id}"] = str(e) + "\n" + str(traceback.format_exc())
-            self.save_cache()
-            return False, [], []
-        value = []
-        index = []
-        value, index = self.formatting(y_early3, value, index)
-        value, index = self.formatting(y_att, value, index)
-        value, index = self.formatting(y_cnn, value, index)
-        value, index = self.formatting(y_merge, value, index)
-        return True, value, index
-    
-    def formatting(self, result, value, index):
-        result = self.softmax(result.squeeze())
-        value.append(torch.max(result).item())
-        index.append(torch.argmax(result).item())
-        return value, index
-    
-    def analysis_threshold(self, value, index, T):
-        # Skip stage 3 - It is unnecessary
-        for i in range(2):
-            if (T[i] < value[i]):
-                return i + 1, index[i]
-        return 3, index[3]
-    
+
     # Cache operation
     def load_cache(self):
-        self.cache = {}
         self.errors = {}
-        self.save_frequency_count = 0
+        records = np.zeros(0, dtype=CACHE_DTYPE)
         if os.path.exists(self.cache_path):
-            with open(self.cache_path, 'r') as json_file:
-                json_data = json.load(json_file)
-                self.cache = json_data['cache']
-                self.errors = json_data['errors']
-    
-    def save_cache(self):
-        with open(self.cache_path, 'w') as f:
-            json.dump({'errors': self.errors, 'cache' : self.cache}, f, indent = 2)
-        self.save_frequency_count = 0
-    
-    def forward(self, image_id, image_path, require_image):
-        if (self.errors.get(f"{image_id}") is not None):
-            return False, None, [], []
-        found, value, index = self.id_forward(image_id)
-        if (found):
-            image = Image.open(image_path) if require_image else None
+            raw = np.fromfile(self.cache_path, dtype=np.uint8)
+            # 쓰는 도중에 끊긴 마지막 record는 버린다
+            num_records = len(raw) // CACHE_DTYPE.itemsize
+            records = raw[:num_records * CACHE_DTYPE.itemsize].view(CACHE_DTYPE)
+            if len(raw) != num_records * CACHE_DTYPE.itemsize:
+                with open(self.cache_path, 'r+b') as f:
+                    f.truncate(num_records * CACHE_DTYPE.itemsize)
+        elif os.path.exists(self.legacy_cache_path):
+            records = self.convert_legacy_cache()
+        if os.path.exists(self.errors_path):
+            with open(self.errors_path, 'r') as f:
+                for line in f:
+                    try:
+                        error = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.errors[str(error['image_id'])] = error['error']
+        self.set_records(records)
+
+    def convert_legacy_cache(self):
+        # 이전 버전의 cache.json을 한 번만 cache.bin / errors.jsonl로 옮긴다
+        with open(self.legacy_cache_path, 'r') as json_file:
+            json_data = json.load(json_file)
+        records = np.zeros(len(json_data['cache']), dtype=CACHE_DTYPE)
+        for i, (image_id, entry) in enumerate(json_data['cache'].items()):
+            records[i] = (int(image_id), entry['value'], entry['index'])
+        self.append_records(records)
+        for image_id, error in json_data['errors'].items():
+            self.append_error(image_id, error)
+        return records
+
+    def set_records(self, records):
+        self.records = records
+        self.row = {int(image_id): i for i, image_id in enumerate(records['image_id'])}
+
+    def append_records(self, records):
+        with open(self.cache_path, 'ab') as f:
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append_error(self, image_id, error):
+        self.errors[str(image_id)] = error
+        with open(self.errors_path, 'a') as f:
+            f.write(json.dumps({'image_id': str(image_id), 'error': error}) + "\n")
+
+    def run(self, image_ids, image_paths, image_sizes):
+        """
+        cache에 없는 image들을 forward해서 cache에 추가한다.
+
+        Args:
+            image_ids : 분석할 image id list
+            image_paths : image 파일 경로 list
+            image_sizes : (width, height) list. 같은 크기끼리 batch로 묶는다
+        """
+        todo = [i for i, image_id in enumerate(image_ids)
+                if int(image_id) not in self.row and self.errors.get(str(image_id)) is None]
+        if len(todo) == 0:
+            return
+        if self.model is None:
+            self.load_model()
+
+        # 같은 크기의 image끼리 batch_size개씩 묶는다
+        size_groups = defaultdict(list)
+        for i in todo:
+            size_groups[tuple(image_sizes[i])].append(i)
+        batches = [group[j:j + self.batch_size] for group in size_groups.values()
+                   for j in range(0, len(group), self.batch_size)]
+        dataset = AnalysisDataset(image_ids, image_paths, self.transform)
+        data_loader = DataLoader(dataset, batch_sampler=batches, num_workers=self.num_workers, collate_fn=collate)
+
+        new_records = [self.records]
+        for batch in tqdm(data_loader, desc='Forwarding images'):
+            records = self.forward_batch(batch)
+            self.append_records(records)
+            new_records.append(records)
+        self.set_records(np.concatenate(new_records))
+
+    @torch.no_grad()
+    def forward_batch(self, batch):
+        ids, images = [], []
+        for image_id, image, error in batch:
+            if error is not None:
+                self.append_error(image_id, error)
+            elif image.shape[0] != 3:
+                # grayscale 등 3 channel이 아닌 image는 이전처럼 error로 남긴다
+                self.append_error(image_id, f"Expected 3 channels, got image of shape {tuple(image.shape)}")
+            else:
+                ids.append(image_id)
+                images.append(image)
+        if len(ids) == 0:
+            return np.zeros(0, dtype=CACHE_DTYPE)
+        try:
+            return self.forward_images(ids, images)
+        except Exception as e:
+            if len(ids) == 1:
+                return self.handle_forward_error(ids[0], e)
+        # batch 전체의 error (e.g. OOM)는 어느 image 때문인지 모르므로 한 장씩 다시 forward한다
+        self.release_memory()
+        records = []
+        for image_id, image in zip(ids, images):
+            try:
+                records.append(self.forward_images([image_id], [image]))
+            except Exception as e:
+                records.append(self.handle_forward_error(image_id, e))
+        return np.concatenate(records)
+
+    def forward_images(self, ids, images):
+        y_early3, y_att, y_cnn, y_merge, _ = self.model.forward(torch.stack(images).to(self.device))
+        probs = torch.stack([y.softmax(dim=1) for y in (y_early3, y_att, y_cnn, y_merge)], dim=1)
+        value, index = probs.max(dim=2)
+        records = np.zeros(len(ids), dtype=CACHE_DTYPE)
+        records['image_id'] = ids
+        records['value'] = value.cpu().numpy()
+        records['index'] = index.cpu().numpy()
+        return records
+
+    def handle_forward_error(self, image_id, e):
+        """
+        image 한 장의 forward error. OOM처럼 image와 무관한 error는 errors.jsonl에 남기지 않아서 다음 run에서 다시 시도한다.
+        """
+        if self.is_transient_error(e):
+            self.release_memory()
+            print(f"Skipping image {image_id} for this run: {e}")
         else:
-            if (self.model is None):
-                self.load_model()
-            image = Image.open(image_path)
-            result, value, index = self.model_forward(image, image_id)
-            if (result is False):
-                return False, image, value, index
-            self.append_cache(image_id, value, index)
-        return True, image, value, index
-    
-    def append_cache(self, image_id, value, index):
-        self.cache[f"{image_id}"] = {'value': value, 'index': index}
-        self.save_frequency_count += 1
-        if (self.save_frequency_count >= self.save_frequency):
-            self.save_cache()
\ No newline at end of file
+            self.append_error(image_id, str(e) + "\n" + str(traceback.format_exc()))
+        return np.zeros(0, dtype=CACHE_DTYPE)
+
+    @staticmethod
+    def is_transient_error(e):
+        oom_error = getattr(torch.cuda, 'OutOfMemoryError', None)
+        return (oom_error is not None and isinstance(e, oom_error)) or 'out of memory' in str(e)
+
+    def release_memory(self):
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def get(self, image_ids):
+        """
+        image_ids의 cache된 결과. cache에 없는 image는 found가 False.
+
+        Returns:
+            found (N), value (N x 4), index (N x 4)
+        """
+        rows = np.array([self.row.get(int(image_id), -1) for image_id in image_ids], dtype=np.int64)
+        found = rows >= 0
+        records = self.records[np.where(found, rows, 0)] if len(self.records) > 0 else np.zeros(len(rows), dtype=CACHE_DTYPE)
+        return found, records['value'], records['index']
+
+    @staticmethod
+    def analysis_thresholds(value, index, thresholds):
+        """
+        모든 image, 모든 threshold config의 exit stage와 예측 class를 한 번에 계산.
+        stage 1, 2의 confidence가 threshold보다 크면 그 stage에서 exit하고, 아니면 stage 3에서 y_merge로 exit한다.
+        (stage 3 = y_cnn은 사용하지 않음)
+
+        Args:
+            value, index : (N x 4)
+            thresholds : (C x 4)
+
+        Returns:
+            exit stage (N x C), 예측 class (N x C)
+        """
+        value = torch.as_tensor(value, dtype=torch.float)
+        index = torch.as_tensor(index, dtype=torch.long)
+        thresholds = torch.as_tensor(thresholds, dtype=torch.float)
+        exit_mask = value[:, None, :2] > thresholds[None, :, :2] # N x C x 2
+        exited = exit_mask.any(dim=2)
+        first = exit_mask.to(torch.uint8).argmax(dim=2)
+        exit_stage = torch.where(exited, first + 1, torch.full_like(first, 3))
+        # stage 1, 2는 y_early3, y_att, stage 3은 y_merge의 예측
+        column = torch.where(exited, first, torch.full_like(first, 3))
+        estimated = index.gather(1, column.view(len(index), -1)).view_as(column)
+        return exit_stage, estimated
+
+    def analysis_threshold(self, value, index, T):
+        # 한 image, 한 config에 대한 analysis_thresholds
+        exit_stage, estimated = self.analysis_thresholds([value], [index], [T])
+        return exit_stage.item(), estimated.item()
@@ -0,0 +1,94 @@
+# DynPerceiver의 attention site별로 attention backend ('math', 'sdpa', 'chunked')의 latency, peak memory를 비교하고
+# 'math'와 output이 tolerance 안에서 같은지 확인하는 benchmark.
+# python tools/cs470/attention_benchmark.py
+
+input_sizes = [(800, 1216), (1333, 800)] # detection 해상도 (H, W)
+batch_size = 2
+backends = ['math', 'sdpa', 'chunked']
+query_chunk_size = 4096 # 'chunked'에서 한 번에 계산할 query 수
+num_iters = 10
+num_warmup = 3
+atol = 1e-4
+device = 'cuda' # GPU가 없으면 'cpu' (peak memory는 GPU에서만 측정)
+
+# ----------------------------------------------------------------------------------------------------
+
+import time
+import torch
+from dyn_perceiver.dyn_perceiver_regnet_model import DynPerceiver
+from dyn_perceiver.perceiver_core import MultiHeadAttention, set_attention_backend
+
+def build_model():
+    model = DynPerceiver(
+        num_latents=128,
+        num_classes=80,
+        cnn_arch='regnet_y_800mf',
+        depth_factor=[1,1,1,2],
+        spatial_reduction=True,
+        with_last_CA=True,
+        SA_widening_factor=4,
+        with_x2z=True,
+        with_dwc=True,
+        with_z2x=True,
+        with_isc=True)
+    return model.to(device).eval()
+
+def capture_inputs(model, x):
+    # 한 번 forward해서 각 attention site (MultiHeadAttention)에 들어가는 (x_q, x_kv)를 저장
+    inputs = {}
+    handles = []
+    for name, m in model.named_modules():
+        if isinstance(m, MultiHeadAttention):
+            def hook(module, args, name=name):
+                inputs[name] = (module, args[0], args[1])
+            handles.append(m.register_forward_pre_hook(hook))
+    model.forward(x)
+    for handle in handles:
+        handle.remove()
+    return inputs
+
+def sync():
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+def run_site(module, x_q, x_kv):
+    for _ in range(num_warmup):
+        module(x_q, x_kv)
+    sync()
+    peak_memory = None
+    if device.startswith('cuda'):
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        o = module(x_q, x_kv)
+    sync()
+    latency = (time.perf_counter() - start) / num_iters
+    if device.startswith('cuda'):
+        peak_memory = torch.cuda.max_memory_allocated() - base_memory
+    return o, latency, peak_memory
+
+@torch.no_grad()
+def benchmark(model, input_size):
+    print(f"Input {batch_size}x3x{input_size[0]}x{input_size[1]}")
+    set_attention_backend(model, 'math')
+    x = torch.randn(batch_size, 3, *input_size, device=device)
+    inputs = capture_inputs(model, x)
+    for name, (module, x_q, x_kv) in inputs.items():
+        print(f"  {name}: q {tuple(x_q.shape)}, kv {tuple(x_kv.shape)}, heads {module.num_heads}")
+        reference = None
+        for backend in backends:
+            set_attention_backend(module, backend, query_chunk_size if backend == 'chunked' else None)
+            o, latency, peak_memory = run_site(module, x_q, x_kv)
+            if reference is None:
+                reference = o
+            max_diff = (o - reference).abs().max().item()
+            memory = '' if peak_memory is None else f", peak {peak_memory / 2**20:.1f}MB"
+            match = 'ok' if max_diff <= atol else 'MISMATCH'
+            print(f"    {backend:>8}: {latency * 1e3:.2f}ms{memory}, max diff {max_diff:.2e} ({match})")
+        set_attention_backend(module, 'math')
+
+if __name__ == '__main__':
+    model = build_model()
+    for input_size in input_sizes:
+        benchmark(model, input_size)
@@ -1,44 +1,80 @@
 # 이찬규 작성
+# 객체가 하나뿐인 COCO image들로 single split을 만든다.
+# 1) annotations/singlebox_instances_{split}2017.json: single image들과 그 annotation만 남긴 annotation 파일.
+#    image의 file_name은 원본 그대로이므로 data_prefix를 원본 폴더 ({split}2017/)로 두면 image를 복사하지 않아도 된다.
+# 2) image_mode가 'hardlink' 또는 'copy'이면 {split}_single/ 폴더도 만든다 (기존 config의 data_prefix용).
+# python tools/cs470/divide_coco.py
+
+data_dir = './data/coco' # COCO 위치
+annotation_dir = 'annotations' # data_dir 기준 annotation 폴더
+image_dirs = {'val': 'val2017', 'train': 'train2017'} # data_dir 기준 원본 image 폴더
+image_mode = 'hardlink' # 'none': annotation만 작성, 'hardlink': hardlink (실패하면 copy), 'copy': 복사
+num_threads = 16 # image를 link / copy할 thread 수
+
+# ----------------------------------------------------------------------------------------------------
+
 import os
 import shutil
 import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm  # tqdm 라이브러리를 불러옵니다.
 
-# 각 데이터셋 경로 설정
-annotation_path = './annotations_trainval2017'
-image_paths = {'val': './val2017', 'train': './train2017/train2017'}
-# 새로운 폴더 생성
-for dataset_type in ['val', 'train']:
-    os.makedirs(f'{dataset_type}_single', exist_ok=True)
-# 각 .json 파일을 순회하며 처리
-for dataset_type, path in image_paths.items():
-    annFile = f'{annotation_path}/instances_{dataset_type}2017.json'
+def get_single_obj_split(coco_data):
+    """
+    객체가 하나뿐인 image들만 남긴 annotation dict. images, annotations 외의 key (info, categories 등)는 그대로 둔다.
+    """
+    # 이미지 ID별 객체 수 카운트
+    img_to_objs = Counter(ann['image_id'] for ann in coco_data['annotations'])
+    single_obj_imgs = set(img_id for img_id, count in img_to_objs.items() if count == 1)
+    split = {key: value for key, value in coco_data.items() if key not in ('images', 'annotations')}
+    # 원본 image 순서를 유지
+    split['images'] = [img for img in coco_data['images'] if img['id'] in single_obj_imgs]
+    split['annotations'] = [ann for ann in coco_data['annotations'] if ann['image_id'] in single_obj_imgs]
+    return split
+
+def place_image(src, dst):
+    if os.path.exists(dst):
+        return
+    if image_mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            # 다른 file system 등 hardlink가 안 되는 경우
+            pass
+    shutil.copyfile(src, dst)
+
+def place_images(images, src_dir, dst_dir):
+    os.makedirs(dst_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [executor.submit(place_image, os.path.join(src_dir, img['file_name']), os.path.join(dst_dir, img['file_name']))
+                   for img in images]
+        for future in tqdm(futures, desc=f'Placing images in {dst_dir}'):
+            future.result()
+
+def build_split(dataset_type, image_dir):
+    annFile = os.path.join(data_dir, annotation_dir, f'instances_{dataset_type}2017.json')
     # JSON 파일 읽기
     with open(annFile, 'r') as f:
         coco_data = json.load(f)
-    # 이미지 ID별 객체 수 카운트
-    img_to_objs = {}
-    for ann in coco_data['annotations']:
-        img_id = ann['image_id']
-        if img_id in img_to_objs:
-            img_to_objs[img_id] += 1
-        else:
-            img_to_objs[img_id] = 1
-    # 한 개의 객체만 포함하는 이미지 식별
-    single_obj_imgs = [img_id for img_id, count in img_to_objs.items() if count == 1]
-    # 전체 이미지 수와 한 개의 객체만 포함하는 이미지의 수 계산
+    split = get_single_obj_split(coco_data)
+    # 전체 이미지 수와 한 개의 객체만 포함하는 이미지의 수
     total_images = len(coco_data['images'])
-    num_single_obj_imgs = len(single_obj_imgs)
-    ratio_single_obj_imgs = num_single_obj_imgs / total_images
-    # 한 개의 객체만 포함하는 이미지의 비율과 개수 출력
-    # print(f'{dataset_type} dataset: {num_single_obj_imgs} out of {total_images} images have a single object. Ratio: {ratio_single_obj_imgs:.2f}')
-    # 한 개의 객체만 포함하는 이미지 식별
-    single_obj_imgs = [img_id for img_id, count in img_to_objs.items() if count == 1]
-    # 해당 이미지 파일을 새 폴더로 복사, tqdm을 적용해 진행 상황 표시
-    for img_id in tqdm(single_obj_imgs, desc=f'Copying {dataset_type} images'):
-        # 이미지 ID를 사용하여 파일 이름 찾기
-        file_name = next((item['file_name'] for item in coco_data['images'] if item['id'] == img_id), None)
-        if file_name:
-            src = os.path.join(path, file_name)
-            dst = os.path.join(f'{dataset_type}_single', file_name)
-            shutil.copy(src, dst)
+    num_single_obj_imgs = len(split['images'])
+    print(f'{dataset_type} dataset: {num_single_obj_imgs} out of {total_images} images have a single object. Ratio: {num_single_obj_imgs / total_images:.2f}')
+
+    split_file = os.path.join(data_dir, annotation_dir, f'singlebox_instances_{dataset_type}2017.json')
+    tmp_file = f'{split_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(split, f)
+    os.replace(tmp_file, split_file)
+    print(f'{split_file} saved. Use data_prefix=dict(img=\'{image_dir}/\') to read the original images.')
+
+    if image_mode != 'none':
+        place_images(split['images'], os.path.join(data_dir, image_dir), os.path.join(data_dir, f'{dataset_type}_single'))
+
+if __name__ == '__main__':
+    assert image_mode in ('none', 'hardlink', 'copy'), f'unknown image_mode {image_mode}'
+    for dataset_type, image_dir in image_dirs.items():
+        build_split(dataset_type, image_dir)
@@ -0,0 +1,78 @@
+# DynLoss의 stacked 구현을 이전 구현 (exit마다 CE, kl_div를 따로 계산)과 비교하는 micro-benchmark.
+# forward + backward 시간, peak memory를 출력한다. (loss 값 비교는 tests/test_models/test_losses/test_dyn_loss.py)
+# python tools/cs470/dyn_loss_benchmark.py
+
+num_classes = 80 # classifier output 크기 (COCO: 80, ImageNet: 1000)
+batch_size = 16
+num_iters = 200
+num_warmup = 20
+device = 'cuda' # GPU가 없으면 'cpu' (peak memory는 GPU에서만 측정)
+
+# ----------------------------------------------------------------------------------------------------
+
+import time
+import torch
+import torch.nn.functional as F
+from mmdet.models.losses.dyn_loss import DynLoss
+
+# 이전 DynLoss의 criterion (mixup, smoothing이 없을 때)
+criterion = torch.nn.CrossEntropyLoss()
+
+def legacy_forward(self, pred, target):
+    # 이전 DynLoss.forward
+    loss_early3 = criterion(pred[0], target)
+    loss_att = criterion(pred[1], target)
+    loss_cnn = criterion(pred[2], target)
+    loss_merge = criterion(pred[3], target)
+
+    loss = self.loss_cnn_factor*loss_cnn + self.loss_att_factor*(loss_att+loss_early3) + self.loss_merge_factor*loss_merge
+
+    if self.with_kd:
+        out_teacher = pred[3].detach()
+
+        kd_loss = F.kl_div(F.log_softmax(pred[0]/self.T_kd, dim=1),F.softmax(out_teacher/self.T_kd, dim=1), reduction='batchmean') * self.T_kd**2 + \
+                F.kl_div(F.log_softmax(pred[1]/self.T_kd, dim=1),F.softmax(out_teacher/self.T_kd, dim=1), reduction='batchmean') * self.T_kd**2 + \
+                F.kl_div(F.log_softmax(pred[2]/self.T_kd, dim=1),F.softmax(out_teacher/self.T_kd, dim=1), reduction='batchmean') * self.T_kd**2
+
+        loss += self.alpha_kd * kd_loss
+
+    return loss
+
+def sync():
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+def step(fn, pred, target):
+    loss = fn(pred, target)
+    loss.backward()
+    for p in pred:
+        p.grad = None
+    return loss
+
+def benchmark(name, fn, pred, target):
+    for _ in range(num_warmup):
+        step(fn, pred, target)
+    sync()
+    if device.startswith('cuda'):
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        step(fn, pred, target)
+    sync()
+    latency = (time.perf_counter() - start) / num_iters
+    memory = ''
+    if device.startswith('cuda'):
+        memory = f", peak {(torch.cuda.max_memory_allocated() - base_memory) / 2**10:.1f}KB"
+    print(f"{name}: {latency * 1e6:.1f}us/step{memory}")
+    return latency
+
+if __name__ == '__main__':
+    loss_fn = DynLoss(theta_factor=1.15e-2, lambda_factor=1.0, T_kd=2.0)
+    pred = [torch.randn(batch_size, num_classes, device=device, requires_grad=True) for _ in range(4)]
+    labels = torch.randint(num_classes, (batch_size,), device=device)
+    target = F.one_hot(labels, num_classes=num_classes).float()
+
+    legacy_latency = benchmark('legacy', lambda p, t: legacy_forward(loss_fn, p, t), pred, target)
+    latency = benchmark('stacked', loss_fn, pred, target)
+    print(f"speedup {legacy_latency / latency:.2f}x")
@@ -1,13 +1,62 @@
 from os import path
 import os
+import numpy as np
 import torch
 from cs470_logger.cs470_print import cs470_print
 
+# image 한 장의 trace. classifier가 계산되지 않은 stage의 confidence는 NaN, correct는 False
+TRACE_DTYPE = np.dtype([
+    ('exit_stage', np.int8),
+    ('confidence', np.float16, (4,)),
+    ('correct', np.bool_, (4,)),
+    ('flops', np.float32),
+    ('time', np.float32),
+])
+
+def load_trace(file):
+    """
+    DynamicEvaluationLogger.process가 저장한 trace를 memory-map으로 불러온다. (threshold 수 x image 수)
+    """
+    return np.load(file, mmap_mode='r')
+
+def replay_trace(trace, thresholds, flops=None):
+    """
+    저장된 trace의 confidence로 다른 threshold를 적용했을 때의 exit stage, 평균 FLOPs, classification accuracy를 다시 계산.
+    모든 classifier의 confidence가 있어야 하므로 single pass로 구한 trace (또는 원래 threshold보다 일찍 exit하는 threshold)에서만 정확하다.
+
+    Args:
+        trace : 한 threshold의 trace (image 수)
+        thresholds : threshold들 (T x 4)
+        flops : exit stage별 FLOPs. None이면 trace의 image별 FLOPs는 원래 exit stage 기준이라 다시 계산할 수 없으므로 None을 반환
+
+    Returns:
+        exit stage (T x image 수), 평균 FLOPs (T), accuracy (T)
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float32)
+    confidence = trace['confidence'].astype(np.float32)
+    exit_mask = confidence[None] >= thresholds[:, None, :] # T x n x 4
+    exit_mask[:, :, -1] = True
+    exit_stage = exit_mask.argmax(axis=2) + 1
+    correct = np.take_along_axis(trace['correct'][None], (exit_stage - 1)[..., None], axis=2)[..., 0]
+    avg_flops = None if flops is None else np.asarray(flops, dtype=np.float64)[exit_stage - 1].mean(axis=1)
+    return exit_stage, avg_flops, correct.mean(axis=1)
+
 class DynamicEvaluationLogger:
-    def __init__(self, log_dir, flops, filename = "test_info.csv"):
+    """
+    threshold마다 exit stage 비율, 평균 FLOPs, mAP, classification accuracy를 csv로 저장하는 logger.
+    head의 coarse exit을 쓰면 coarse exit한 image 비율도 저장하고, 평균 FLOPs에서 건너뛴 head의 FLOPs를 뺀다.
+    num_images가 주어지면 image별 trace (exit stage, 각 classifier의 confidence / correct, FLOPs, 시간)를
+    dataset 크기의 array에 미리 잡아두고 batch마다 slice 하나에 쓴 다음, process에서 한 번에 .npy로 저장한다.
+    """
+    def __init__(self, log_dir, flops, filename = "test_info.csv", num_images = None):
         self.log_dir = path.join(log_dir, "cs470_log")
         os.makedirs(self.log_dir, exist_ok=True)
         self.csv_file_dir = path.join(self.log_dir, filename)
+        self.trace_file_dir = path.join(self.log_dir, path.splitext(filename)[0] + "_trace.npy")
+        self.num_images = num_images
+        self.traces = []
+        self.trace = self._new_trace()
+        self.image_idx = 0
         self.flops = flops
         self.num_exiting_images = torch.tensor([0, 0, 0, 0])
         self.flops_info = []
@@ -23,6 +72,10 @@ class DynamicEvaluationLogger:
         self.flops_unit = 1e9
         self.is_coco = None
         self.correct_classify_images = 0
+        # coarse exit을 쓰지 않으면 None
+        self.num_coarse_exits = None
+        self.coarse_exit_flops = 0.
+        self.coarse_exit_ratio_info = []
 
     def _set_is_coco(self, metrics):
         if self.is_coco is not None:
@@ -51,17 +104,96 @@ class DynamicEvaluationLogger:
             self.mAP_50_info.append(metrics['pascal_voc/AP50'])
         self.thresholds_info.append(thresholds)
         self.classification_accuracy.append(self.get_classification_accuracy())
+        self.coarse_exit_ratio_info.append(self.get_coarse_exit_ratio())
         self.num_exiting_images = torch.tensor([0, 0, 0, 0])
         self.correct_classify_images = 0
+        self.num_coarse_exits = None
+        self.coarse_exit_flops = 0.
+        if self.trace is not None:
+            self.traces.append(self.trace[:self.image_idx])
+            self.trace = self._new_trace()
+            self.image_idx = 0
+
+    def _new_trace(self):
+        if self.num_images is None:
+            return None
+        return self._empty_trace(self.num_images)
+
+    @staticmethod
+    def _empty_trace(n):
+        trace = np.zeros(n, dtype=TRACE_DTYPE)
+        trace['confidence'] = np.nan
+        trace['flops'] = np.nan
+        trace['time'] = np.nan
+        return trace
 
-    def append(self, exiting_stage):
-        self.num_exiting_images[exiting_stage - 1] += 1
+    def append(self, exiting_stage, confidences=None, corrects=None, flops=None, elapsed=None):
+        """
+        Args:
+            exiting_stage : 한 image의 stage 또는 batch 안 image들의 stage list
+            confidences : (batch, 4) 각 classifier의 max softmax
+            corrects : (batch, 4) 각 classifier의 prediction이 맞았는지
+            flops : image별 FLOPs
+            elapsed : batch 전체의 inference 시간 (초). image 수로 나눠서 저장
+        """
+        if isinstance(exiting_stage, int):
+            exiting_stage = [exiting_stage]
+        stages = torch.as_tensor(exiting_stage, dtype=torch.long)
+        self.num_exiting_images += torch.bincount(stages - 1, minlength=4)
+        if self.trace is None:
+            return
+
+        n = len(stages)
+        if self.image_idx + n > len(self.trace):
+            # dataloader가 dataset보다 많은 image를 주는 경우 (distributed sampler의 padding 등)
+            extra = self._empty_trace(max(n, len(self.trace) // 2))
+            self.trace = np.concatenate([self.trace, extra])
+        trace = self.trace[self.image_idx:self.image_idx + n]
+        trace['exit_stage'] = stages.numpy()
+        if confidences is not None:
+            trace['confidence'] = self._to_numpy(confidences)
+        if corrects is not None:
+            trace['correct'] = self._to_numpy(corrects)
+        if flops is not None:
+            trace['flops'] = self._to_numpy(flops)
+        if elapsed is not None:
+            trace['time'] = elapsed / n
+        self.image_idx += n
+
+    @staticmethod
+    def _to_numpy(x):
+        if isinstance(x, torch.Tensor):
+            return x.detach().cpu().numpy()
+        return np.asarray(x)
 
     def append_classifier(self, correct):
-        self.correct_classify_images += 1 if correct else 0
+        # correct: 한 image의 bool, bool list 또는 DynRetinaNet.get_classifier_correct의 bool tensor
+        if isinstance(correct, bool):
+            correct = [correct]
+        self.correct_classify_images += int(torch.as_tensor(correct).sum())
+
+    def append_coarse_exits(self, coarse_exits, skipped_flops):
+        """
+        Args:
+            coarse_exits : batch 안 image들이 head의 coarse exit을 했는지 (DynRetinaNet.get_last_coarse_exits)
+            skipped_flops : image별로 coarse exit 때문에 건너뛴 FLOPs (coarse exit하지 않은 image는 0)
+        """
+        if self.num_coarse_exits is None:
+            self.num_coarse_exits = 0
+        self.num_coarse_exits += int(sum(coarse_exits))
+        self.coarse_exit_flops += float(sum(skipped_flops))
 
     def get_average_flops(self):
-        return torch.sum((self.num_exiting_images / torch.sum(self.num_exiting_images)) * self.flops).item() / self.flops_unit
+        num_images = torch.sum(self.num_exiting_images)
+        flops = torch.sum((self.num_exiting_images / num_images) * self.flops).item()
+        return (flops - self.coarse_exit_flops / num_images.item()) / self.flops_unit
+
+    def get_coarse_exit_ratio(self):
+        if self.num_coarse_exits is None:
+            return None
+        ratio = self.num_coarse_exits / torch.sum(self.num_exiting_images).item()
+        cs470_print(f"Coarse Exit Ratio: {ratio}")
+        return ratio
     
     def get_ratio_of_exiting_stages(self):
         return (self.num_exiting_images / torch.sum(self.num_exiting_images)).tolist()
@@ -73,14 +205,35 @@ class DynamicEvaluationLogger:
     def process(self):
         csv_file = open(self.csv_file_dir, "w")
         label, _ = self._get_mAP(0)
-        csv_file.write(f"flops(GF),{label},exiting_in_1,exiting_in_2,exiting_in_3,exiting_in_4,threshold_1,threshold_2,threshold_3,threshold_4,classification_accuracy\n")
+        # coarse exit을 쓴 threshold가 있을 때만 coarse_exit_ratio column을 추가
+        with_coarse_exit = any(ratio is not None for ratio in self.coarse_exit_ratio_info)
+        csv_file.write(f"flops(GF),{label},exiting_in_1,exiting_in_2,exiting_in_3,exiting_in_4,threshold_1,threshold_2,threshold_3,threshold_4,classification_accuracy"
+                       f"{',coarse_exit_ratio' if with_coarse_exit else ''}\n")
         for i in range(len(self.flops_info)):
             _, mAP_info = self._get_mAP(i)
             output = [self.flops_info[i]] + mAP_info + self.image_ratio_info[i] + self.thresholds_info[i] + [self.classification_accuracy[i]]
+            if with_coarse_exit:
+                output.append(self.coarse_exit_ratio_info[i] or 0.)
             csv_file.write(",".join(str(num) for num in output) + "\n")
         csv_file.close()
         cs470_print(self.csv_file_dir + " saved.")
+        self.save_trace()
         return
+
+    def save_trace(self):
+        # threshold (csv의 row) 순서대로 (threshold 수 x image 수) array 하나로 저장
+        if len(self.traces) == 0:
+            return
+        num_images = max(len(trace) for trace in self.traces)
+        trace_file = np.lib.format.open_memmap(self.trace_file_dir, mode='w+', dtype=TRACE_DTYPE,
+                                               shape=(len(self.traces), num_images))
+        empty = self._empty_trace(1)[0]
+        for i, trace in enumerate(self.traces):
+            trace_file[i, :len(trace)] = trace
+            trace_file[i, len(trace):] = empty
+        trace_file.flush()
+        del trace_file
+        cs470_print(self.trace_file_dir + " saved.")
     
     def _get_mAP(self, i):
         if self.is_coco:
@@ -89,5 +242,5 @@ class DynamicEvaluationLogger:
             return "pascal_voc_mAP,pascal_voc_AP50", [self.mAP_info[i], self.mAP_50_info[i]]
 
 class DynamicValidationLogger(DynamicEvaluationLogger):
-    def __init__(self, log_dir, flops, epoch):
-        super().__init__(log_dir, flops, f"epoch_{epoch}_validation_info.csv")
+    def __init__(self, log_dir, flops, epoch, num_images = None):
+        super().__init__(log_dir, flops, f"epoch_{epoch}_validation_info.csv", num_images)
@@ -0,0 +1,87 @@
+# Early exit 판단 부분의 CPU per-image latency를 이전 구현과 비교하는 micro-benchmark.
+# python tools/cs470/exit_decision_benchmark.py
+
+num_classes = 80 # classifier output 크기 (COCO: 80, ImageNet: 1000)
+batch_size = 1 # DynamicTestLoop 기준 batch 크기
+num_iters = 2000 # 반복 횟수
+num_warmup = 100
+threshold = [0.5, 0.4, 0.3, -1] # 각 exit stage의 threshold
+run_forward = True # 전체 DynPerceiver.forward의 per-image latency도 측정할지 여부
+input_size = (800, 1216)
+
+# ----------------------------------------------------------------------------------------------------
+
+import time
+import torch
+import torch.nn as nn
+from dyn_perceiver.dyn_perceiver_regnet_model import DynPerceiver
+
+softmax = nn.Softmax(dim=1)
+
+def legacy_exit_decision(y, threshold, k):
+    # 이전 DynPerceiver.forward의 exit 판단: CPU tensor를 새로 만들어 copy하고 sample마다 .item()
+    logits = [[softmax(y)]]
+    logits[0] = torch.cat(logits[0], dim=0)
+    size = (1, logits[0].size(0), logits[0].size(1))
+    ts_logits = torch.Tensor().resize_(size).zero_()
+    ts_logits[0].copy_(logits[0])
+    _, n_sample, _ = ts_logits.size()
+    max_preds, _ = ts_logits.max(dim=2, keepdim=False)
+    for i in range(n_sample):
+        if max_preds[0][i].item() >= threshold[k]:
+            return True
+    return False
+
+def exit_decision(y, threshold, k):
+    # DynPerceiver._exit_decision과 같은 연산: device 위에서 mask를 만들고 branch에서 한 번만 sync
+    max_preds, _ = softmax(y).max(dim=1)
+    return bool((max_preds >= threshold[k]).any())
+
+def timeit(fn, *args):
+    for _ in range(num_warmup):
+        fn(*args)
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn(*args)
+    return (time.perf_counter() - start) / num_iters
+
+def benchmark_decision():
+    y = torch.randn(batch_size, num_classes)
+    legacy_threshold = torch.tensor(threshold, dtype=torch.float)
+    preloaded_threshold = torch.as_tensor(threshold, dtype=torch.float, device=y.device)
+    for k in range(3):
+        before = timeit(legacy_exit_decision, y, legacy_threshold, k) / batch_size
+        after = timeit(exit_decision, y, preloaded_threshold, k) / batch_size
+        print(f"Exit {k + 1}: before {before * 1e6:.2f}us/image, after {after * 1e6:.2f}us/image, speedup {before / after:.2f}x")
+
+@torch.no_grad()
+def benchmark_forward():
+    model = DynPerceiver(
+        num_latents=128,
+        num_classes=num_classes,
+        cnn_arch='regnet_y_800mf',
+        depth_factor=[1,1,1,2],
+        spatial_reduction=True,
+        with_last_CA=True,
+        SA_widening_factor=4,
+        with_x2z=True,
+        with_dwc=True,
+        with_z2x=True,
+        with_isc=True)
+    model.eval()
+    x = torch.randn(batch_size, 3, *input_size)
+    thresholds = [torch.tensor(threshold, dtype=torch.float)] + [
+        torch.tensor([10.0 if i != k else -1.0 for i in range(4)]) for k in range(4)]
+    for T in thresholds:
+        model.forward(x, threshold=T)
+        start = time.perf_counter()
+        for _ in range(10):
+            model.forward(x, threshold=T)
+        latency = (time.perf_counter() - start) / 10 / batch_size
+        print(f"Threshold {T.tolist()}: exit stage {model.get_last_exited_stage()}, {latency * 1e3:.1f}ms/image")
+
+if __name__ == '__main__':
+    torch.set_num_threads(1)
+    benchmark_decision()
+    if run_forward:
+        benchmark_forward()
@@ -1,44 +1,165 @@
 from os import path
 import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
 from cs470_logger.cs470_print import cs470_print
-from typing import Sequence
+from typing import Optional, Sequence
 from mmdet.structures import DetDataSample
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 class QualitiveLogger:
-    def __init__(self, log_dir, threshold_number):
+    """
+    predicted box마다 (image_id, bbox, label, score, early_exit, batch_idx)를 저장하는 logger.
+    batch마다 column별 numpy array로 모아두고, flush_rows개 이상 모이면 background writer thread에서 파일에 이어서 쓴다.
+    test loop는 GPU -> CPU copy만 하고 파일 I/O를 기다리지 않는다.
+    writer thread에서 실패한 write의 exception은 다음 flush 또는 save_info에서 다시 raise된다.
+
+    Args:
+        log_dir : runner의 log dir
+        threshold_number : 파일 이름에 붙는 threshold 번호
+        file_format : 'parquet' 또는 'csv'. None이면 pyarrow가 있으면 'parquet', 없으면 'csv'
+        flush_rows : 한 번에 쓰는 box 수 (parquet의 row group 크기)
+    """
+    fieldnames = ['image_id', 'bbox_1', 'bbox_2', 'bbox_3', 'bbox_4', 'label', 'score', 'early_exit', 'batch_idx']
+    dtypes = [str, np.float32, np.float32, np.float32, np.float32, np.int64, np.float32, np.int64, np.int64]
+    # %.9g는 float32를 정확히 다시 읽을 수 있는 자릿수
+    csv_fmt = ['%s', '%.9g', '%.9g', '%.9g', '%.9g', '%d', '%.9g', '%d', '%d']
+
+    # 모든 logger가 공유하는 writer thread. worker가 하나라서 같은 파일에 대한 write는 submit한 순서대로 수행된다.
+    _writer = None
+
+    def __init__(self, log_dir, threshold_number, file_format: Optional[str] = None, flush_rows: int = 65536):
+        if file_format is None:
+            file_format = 'parquet' if pq is not None else 'csv'
+        assert file_format in ('parquet', 'csv'), f'unknown file format {file_format}'
+        assert file_format != 'parquet' or pq is not None, 'pyarrow is required for the parquet format'
+        self.file_format = file_format
+        self.flush_rows = flush_rows
         self.log_dir = path.join(log_dir, "cs470_log")
         os.makedirs(self.log_dir, exist_ok=True)
-        self.csv_file_dir = path.join(self.log_dir, f"threshold_{threshold_number}_qualitive.csv")
-        self.fieldnames = ['image_id', 'bbox_1', 'bbox_2', 'bbox_3', 'bbox_4', 'label', 'score', 'early_exit', 'batch_idx']
-        self.content = []
+        self.file_dir = path.join(self.log_dir, f"threshold_{threshold_number}_qualitive.{file_format}")
+        # 아직 flush하지 않은 batch들의 column
+        self.buffer = []
+        self.num_buffered = 0
+        self.file = None
+        # writer thread에 넘긴 write의 future. 끝난 것은 flush할 때 정리한다.
+        self.writes = []
+        if QualitiveLogger._writer is None:
+            QualitiveLogger._writer = ThreadPoolExecutor(max_workers=1)
 
-    def process(self, batch_idx:int , data_batch: dict, outputs: Sequence[DetDataSample], early_exit_stage: int):
+    def process(self, batch_idx:int , data_batch: dict, outputs: Sequence[DetDataSample], early_exit_stages: Sequence[int]):
+        if isinstance(early_exit_stages, int):
+            early_exit_stages = [early_exit_stages] * len(outputs)
+        img_ids, bboxes, labels, scores = [], [], [], []
         for output in outputs:
-            img_id = os.path.basename(output.metainfo['img_path'])
-            bboxes = output.pred_instances.bboxes.tolist() if output.pred_instances.bboxes.numel() > 0 else []
-            labels = output.pred_instances.labels.tolist() if output.pred_instances.labels.numel() > 0 else []
-            scores = output.pred_instances.scores.tolist() if output.pred_instances.scores.numel() > 0 else []
-
-            for bbox, label, score in zip(bboxes, labels, scores):
-                self.content.append({
-                    'image_id': img_id,
-                    'bbox_1': bbox[0],
-                    'bbox_2': bbox[1],
-                    'bbox_3': bbox[2],
-                    'bbox_4': bbox[3],
-                    'label': label,
-                    'score': score,
-                    'early_exit' : early_exit_stage,
-                    'batch_idx' : batch_idx
-                })
-        
-    
+            img_ids.append(os.path.basename(output.metainfo['img_path']))
+            pred_instances = output.pred_instances
+            bboxes.append(pred_instances.bboxes.reshape(-1, 4))
+            labels.append(pred_instances.labels)
+            scores.append(pred_instances.scores)
+        counts = np.array([len(label) for label in labels])
+        num_boxes = int(counts.sum())
+        if num_boxes == 0:
+            return
+        # batch 전체를 (N, 6) [bbox, score, label] 하나로 합쳐서 CPU로 한 번만 copy. label (< 2^24)은 float32로 정확히 표현된다
+        bboxes = torch.cat(bboxes).detach()
+        rows = torch.cat([bboxes, torch.cat(scores).detach()[:, None].to(bboxes.dtype),
+                          torch.cat(labels).detach()[:, None].to(bboxes.dtype)], dim=1)
+        rows = rows.cpu().numpy().astype(np.float32)
+        columns = {
+            'image_id': np.repeat(np.array(img_ids), counts),
+            'bbox_1': rows[:, 0],
+            'bbox_2': rows[:, 1],
+            'bbox_3': rows[:, 2],
+            'bbox_4': rows[:, 3],
+            'label': rows[:, 5].astype(np.int64),
+            'score': rows[:, 4],
+            'early_exit': np.repeat(np.asarray(early_exit_stages, dtype=np.int64), counts),
+            'batch_idx': np.full(num_boxes, batch_idx, dtype=np.int64),
+        }
+        self.buffer.append(columns)
+        self.num_buffered += num_boxes
+        if self.num_buffered >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        # buffer를 하나의 chunk로 합쳐서 writer thread에 넘긴다
+        self._raise_write_error()
+        if self.num_buffered == 0:
+            return
+        chunk = {name: np.concatenate([columns[name] for columns in self.buffer]) for name in self.fieldnames}
+        self.buffer = []
+        self.num_buffered = 0
+        self.writes.append(QualitiveLogger._writer.submit(self._write, chunk))
+
+    def _raise_write_error(self):
+        # 끝난 write는 정리하고, 실패한 write가 있으면 그 exception을 다시 raise
+        pending = []
+        for future in self.writes:
+            if not future.done():
+                pending.append(future)
+            elif future.exception() is not None:
+                self.writes = [write for write in self.writes if write is not future]
+                raise future.exception()
+        self.writes = pending
+
+    def _write(self, chunk):
+        if self.file_format == 'parquet':
+            table = pa.table(chunk)
+            if self.file is None:
+                self.file = pq.ParquetWriter(self.file_dir, table.schema)
+            self.file.write_table(table)
+        else:
+            if self.file is None:
+                self.file = open(self.file_dir, "w")
+                self.file.write(",".join(self.fieldnames) + "\n")
+            rows = np.rec.fromarrays([chunk[name] for name in self.fieldnames], names=self.fieldnames)
+            np.savetxt(self.file, rows, fmt=self.csv_fmt, delimiter=',')
+
+    def _close(self, writes):
+        if self.file is None:
+            # box가 하나도 없어도 header만 있는 파일을 남긴다
+            self._write({name: np.zeros(0, dtype=dtype) for name, dtype in zip(self.fieldnames, self.dtypes)})
+        self.file.close()
+        self.file = None
+        # worker가 하나라서 앞서 submit한 write는 모두 끝나 있다. 실패한 write가 있으면 close도 실패로 남긴다
+        for future in writes:
+            if future.exception() is not None:
+                raise future.exception()
+
     def save_info(self):
-        csv_file = open(self.csv_file_dir, "w")
-        csv_file.write(",".join(self.fieldnames) + "\n")
-        for content in self.content:
-            csv_file.write(",".join(str(content[fieldname]) for fieldname in self.fieldnames) + "\n")
-        csv_file.close()
-        cs470_print(self.csv_file_dir + " saved.")
+        # 남은 buffer를 쓰고 파일을 닫는다. 쓰기가 끝날 때까지 기다리지 않는다.
+        # 이미 실패한 write가 있으면 raise하고, 아직 끝나지 않은 write의 실패는 close의 future에 남는다.
+        try:
+            self.flush()
+        finally:
+            close = QualitiveLogger._writer.submit(self._close, self.writes)
+            close.add_done_callback(self._log_saved)
+            self.writes = [close]
         return
 
+    def _log_saved(self, future):
+        if future.exception() is not None:
+            cs470_print(f"Failed to save {self.file_dir}: {future.exception()}")
+        else:
+            cs470_print(self.file_dir + " saved.")
+
+    def wait(self):
+        # submit한 write가 모두 끝날 때까지 기다리고, 실패한 write가 있으면 raise
+        writes, self.writes = self.writes, []
+        for future in writes:
+            future.result()
+
+    @classmethod
+    def shutdown(cls):
+        # 남은 write를 모두 끝내고 writer thread를 종료한다. 다음에 만드는 logger가 새 thread를 만든다.
+        if cls._writer is not None:
+            cls._writer.shutdown(wait=True)
+            cls._writer = None
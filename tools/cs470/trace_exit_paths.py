@@ -0,0 +1,69 @@
+# DynRetinaNet의 neck + head를 exit path (exit stage 1~4)마다 torch.jit.trace로 한 번씩 compile하고,
+# eager 결과와 같은지, latency가 얼마나 되는지 확인한다.
+# DynFPN의 static_shapes를 켜면 exit stage와 무관하게 output shape이 같아서, 같은 input 크기에 대해 exit path당 한 번만 trace하면 된다.
+# python tools/cs470/trace_exit_paths.py
+
+config_file = 'model_configs/coco/improvements/retinanet_dyn_perceiver-800MF_fpn_1x_coco_single-theta_factor_115e-4.py'
+checkpoint_file = 'work_dirs/coco_single/improvements/retinanet_dyn_perceiver-800MF_fpn_1x_coco_single-theta_factor_115e-4/epoch_12.pth'
+input_size = (800, 1216) # padding된 input (H, W)
+static_shapes = True # DynFPN.static_shapes
+num_iters = 20
+atol = 1e-4
+device = 'cuda:0'
+
+# ----------------------------------------------------------------------------------------------------
+
+import time
+import torch
+import torch.nn as nn
+from mmdet.apis import init_detector
+
+class NeckHead(nn.Module):
+    # 한 exit stage의 backbone output -> neck -> head. tensor tuple만 주고받아서 trace할 수 있다
+    def __init__(self, model, stage):
+        super().__init__()
+        self.model = model
+        self.stage = stage
+
+    def forward(self, *feats):
+        active = self.model.get_active_levels(self.stage)[:len(feats)]
+        cls_scores, bbox_preds = self.model._forward_neck_head(tuple(feats), active)
+        return tuple(cls_scores) + tuple(bbox_preds)
+
+def sync():
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+def timeit(fn, inputs):
+    fn(*inputs)
+    sync()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        fn(*inputs)
+    sync()
+    return (time.perf_counter() - start) / num_iters
+
+@torch.no_grad()
+def main():
+    model = init_detector(config_file, checkpoint_file, device=device)
+    model.neck.static_shapes = static_shapes
+    # coarse exit은 image마다 다른 branch를 타므로 trace할 수 없다
+    model.unset_head_threshold()
+    x = torch.randn(1, 3, *input_size, device=device)
+    exit_outs = model.backbone.forward_all_exits(x)[0]
+    for stage, outs in enumerate(exit_outs, start=1):
+        neck_head = NeckHead(model, stage)
+        outs = tuple(outs)
+        eager = neck_head(*outs)
+        traced = torch.jit.trace(neck_head, outs, check_trace=False)
+        out = traced(*outs)
+        max_diff = max((a - b).abs().max().item() for a, b in zip(eager, out))
+        shapes = [tuple(o.shape[-2:]) for o in eager[:len(eager) // 2]]
+        eager_latency = timeit(neck_head, outs)
+        traced_latency = timeit(traced, outs)
+        match = 'ok' if max_diff <= atol else 'MISMATCH'
+        print(f"Exit {stage}: levels {shapes}, max diff {max_diff:.2e} ({match}), "
+              f"eager {eager_latency * 1e3:.2f}ms, traced {traced_latency * 1e3:.2f}ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+import asyncio
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from mmcv.transforms import Compose
+
+from mmdet.structures import DetDataSample
+from mmdet.utils import get_test_pipeline_cfg
+
+
+class ExitAwareBatchingServer:
+    """Asyncio micro-batching server for the early-exit ``DynRetinaNet``.
+
+    ``MMdetHandler`` runs one request at a time through the whole network.
+    Here, requests arriving within ``max_wait_ms`` are batched through the
+    stem and the stages before the first exit. Images which exit are run
+    through the neck and head and answered right away. The survivors wait at
+    the next segment (see ``DynPerceiver.forward_segment``), where they are
+    re-batched with the survivors of the following micro-batches. A segment
+    runs as soon as it has ``max_batch_size`` images or its oldest image has
+    waited ``max_wait_ms``. Only survivors with the same feature shape are
+    batched together, so passing a fixed ``pad_shape`` lets all of them
+    share the deeper stages.
+
+    Args:
+        model (nn.Module): A ``DynRetinaNet`` built by ``init_detector``.
+        threshold (Sequence[float]): Exit threshold of each classifier.
+        max_batch_size (int): Maximum number of images per segment run.
+            Defaults to 8.
+        max_wait_ms (float): Maximum time an image waits for a segment to
+            fill up. Defaults to 10.
+        pad_shape (tuple[int, int], optional): Pad every input to this
+            (H, W) instead of the largest image of the micro-batch. It grows
+            to fit any larger input. Defaults to None.
+        budget_controller (:obj:`BudgetController`, optional): If given,
+            picks the threshold of each micro-batch from the request
+            arrival times and the queue length instead of ``threshold``.
+            Defaults to None.
+    """
+
+    def __init__(self,
+                 model,
+                 threshold: Sequence[float],
+                 max_batch_size: int = 8,
+                 max_wait_ms: float = 10,
+                 pad_shape: Optional[Tuple[int, int]] = None,
+                 budget_controller=None) -> None:
+        self.model = model
+        self.perceiver = model.backbone.dyn_perceiver
+        self.threshold = torch.as_tensor(
+            threshold, dtype=torch.float, device=model.data_preprocessor.device)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.pad_shape = pad_shape
+        self.budget_controller = budget_controller
+
+        test_pipeline = get_test_pipeline_cfg(model.cfg.copy())
+        test_pipeline[0].type = 'mmdet.LoadImageFromNDArray'
+        self.test_pipeline = Compose(test_pipeline)
+
+        # a single worker thread serializes the model, while the event loop
+        # keeps accepting requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.requests = None
+        self.worker = None
+        # pending[stage][feature shape]: chunks of survivors waiting for the
+        # segment ``stage``
+        self.pending = [defaultdict(list) for _ in range(5)]
+        self.num_exited = [0] * 4
+
+    async def start(self) -> None:
+        self.requests = asyncio.Queue()
+        self.worker = asyncio.create_task(self._serve())
+
+    async def stop(self) -> None:
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown()
+
+    async def infer(self, img: np.ndarray) -> DetDataSample:
+        """Detect objects in a BGR image.
+
+        Returns:
+            :obj:`DetDataSample`: The prediction, as ``inference_detector``.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self.budget_controller is not None:
+            self.budget_controller.observe_arrivals([time.perf_counter()])
+        await self.requests.put((img, future))
+        return await future
+
+    async def _serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect(self._next_deadline())
+            responses = []
+            if len(batch) > 0:
+                responses += await loop.run_in_executor(
+                    self.executor, self._run_first_segment, batch,
+                    self.requests.qsize())
+            responses += await loop.run_in_executor(
+                self.executor, self._run_due_segments, len(batch) == 0)
+            for future, data_sample in responses:
+                if not future.done():
+                    future.set_result(data_sample)
+
+    def _next_deadline(self) -> Optional[float]:
+        deadlines = [
+            chunks[0]['since'] + self.max_wait
+            for pending in self.pending for chunks in pending.values()
+            if len(chunks) > 0
+        ]
+        return min(deadlines) if len(deadlines) > 0 else None
+
+    async def _collect(self, deadline: Optional[float]) -> list:
+        """Collect the requests of the next micro-batch.
+
+        Waits for the first request (at most until ``deadline`` if
+        survivors are pending), then for up to ``max_wait_ms`` more.
+        """
+        batch = []
+        try:
+            timeout = None if deadline is None else \
+                max(deadline - time.perf_counter(), 0)
+            batch.append(await asyncio.wait_for(self.requests.get(), timeout))
+        except asyncio.TimeoutError:
+            return batch
+        end = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = end - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.requests.get(),
+                                                    timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    @torch.no_grad()
+    def _run_first_segment(self, batch: list, queue_length: int = 0) -> list:
+        data = dict(inputs=[], data_samples=[])
+        for img, _ in batch:
+            data_ = self.test_pipeline(dict(img=img, img_id=0))
+            data['inputs'].append(data_['inputs'])
+            data['data_samples'].append(data_['data_samples'])
+        data = self.model.data_preprocessor(data, False)
+        inputs, data_samples = data['inputs'], data['data_samples']
+        if self.pad_shape is not None:
+            # grow instead of cropping a larger input. Survivors are grouped
+            # by feature shape, so the ones padded before stay separate.
+            self.pad_shape = (max(self.pad_shape[0], inputs.shape[-2]),
+                              max(self.pad_shape[1], inputs.shape[-1]))
+            inputs = F.pad(inputs, (0, self.pad_shape[1] - inputs.shape[-1],
+                                    0, self.pad_shape[0] - inputs.shape[-2]))
+            for data_sample in data_samples:
+                data_sample.set_metainfo(
+                    dict(batch_input_shape=tuple(self.pad_shape)))
+        threshold, index = self.threshold, None
+        if self.budget_controller is not None:
+            threshold = torch.as_tensor(
+                self.budget_controller.get_threshold(queue_length),
+                dtype=torch.float,
+                device=self.threshold.device)
+            index = self.budget_controller.index
+        chunk = dict(
+            state=self.perceiver.init_state(inputs),
+            data_samples=data_samples,
+            futures=[future for _, future in batch],
+            # each image keeps the threshold of its micro-batch
+            thresholds=threshold.expand(len(batch), -1),
+            indexes=[index] * len(batch))
+        return self._run_segment(1, chunk)
+
+    @torch.no_grad()
+    def _run_due_segments(self, flush: bool) -> list:
+        """Run the deeper segments which are full or waited long enough.
+
+        Args:
+            flush (bool): Whether to also run segments which are not due,
+                as there is no new request to wait for.
+        """
+        responses = []
+        for stage in range(2, 5):
+            for shape, chunks in list(self.pending[stage].items()):
+                num_images = sum(len(chunk['futures']) for chunk in chunks)
+                due = time.perf_counter() >= chunks[0]['since'] + self.max_wait
+                if not (flush or due or num_images >= self.max_batch_size):
+                    continue
+                del self.pending[stage][shape]
+                chunk = dict(
+                    state=self.perceiver.cat_states(
+                        [chunk['state'] for chunk in chunks]),
+                    data_samples=[
+                        data_sample for chunk in chunks
+                        for data_sample in chunk['data_samples']
+                    ],
+                    futures=[
+                        future for chunk in chunks
+                        for future in chunk['futures']
+                    ],
+                    thresholds=torch.cat(
+                        [chunk['thresholds'] for chunk in chunks]),
+                    indexes=[
+                        index for chunk in chunks
+                        for index in chunk['indexes']
+                    ])
+                responses += self._run_segment(stage, chunk)
+        return responses
+
+    def _run_segment(self, stage: int, chunk: dict) -> list:
+        """Run ``chunk`` through the segment ``stage``, answer the images
+        which exit and queue the survivors for the next segment."""
+        state = self.perceiver.forward_segment(stage, chunk['state'])
+        if stage == 4:
+            exit_mask = torch.ones(
+                len(chunk['futures']), dtype=torch.bool,
+                device=self.threshold.device)
+        else:
+            max_preds, _ = state['preds'][stage - 1].softmax(dim=1).max(dim=1)
+            exit_mask = max_preds >= chunk['thresholds'][:, stage - 1]
+        exit_mask = exit_mask.tolist()
+        exit_idx = [i for i, exit in enumerate(exit_mask) if exit]
+        keep_idx = [i for i, exit in enumerate(exit_mask) if not exit]
+
+        responses = []
+        if len(exit_idx) > 0:
+            data_samples = [chunk['data_samples'][i] for i in exit_idx]
+            exited = self.perceiver.select_state(state, exit_idx)
+            results_list = self.model.predict_exited(
+                self.perceiver.get_exit_outs(exited, stage), stage,
+                data_samples)
+            for i, data_sample, results in zip(exit_idx, data_samples,
+                                               results_list):
+                data_sample.pred_instances = results
+                responses.append((chunk['futures'][i], data_sample))
+            self.num_exited[stage - 1] += len(exit_idx)
+            if self.budget_controller is not None:
+                indexes = [chunk['indexes'][i] for i in exit_idx]
+                for index in set(indexes):
+                    self.budget_controller.update(
+                        [stage] * indexes.count(index), index=index)
+        if len(keep_idx) > 0:
+            survivors = self.perceiver.select_state(state, keep_idx)
+            self.pending[stage + 1][tuple(survivors['x'].shape[1:])].append(
+                dict(
+                    state=survivors,
+                    data_samples=[chunk['data_samples'][i] for i in keep_idx],
+                    futures=[chunk['futures'][i] for i in keep_idx],
+                    thresholds=chunk['thresholds'][keep_idx],
+                    indexes=[chunk['indexes'][i] for i in keep_idx],
+                    since=time.perf_counter()))
+        return responses
+
+    def get_exit_ratios(self) -> List[float]:
+        total = max(sum(self.num_exited), 1)
+        return [num / total for num in self.num_exited]
@@ -0,0 +1,143 @@
+import asyncio
+import os
+import time
+from argparse import ArgumentParser
+
+import mmcv
+import numpy as np
+import torch
+
+from mmdet.apis import inference_detector, init_detector
+
+from tools.deployment.dyn_batching_server import ExitAwareBatchingServer
+
+
+def parse_args():
+    parser = ArgumentParser(
+        description='Local load generator comparing the exit-aware '
+        'micro-batching server with one-at-a-time inference as in '
+        'MMdetHandler')
+    parser.add_argument('img_dir', help='Directory of request images')
+    parser.add_argument('config', help='Config file')
+    parser.add_argument('checkpoint', help='Checkpoint file')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        nargs=4,
+        default=[0.5, 0.4, 0.3, -1],
+        help='Exit threshold of each classifier')
+    parser.add_argument(
+        '--num-requests', type=int, default=200, help='Number of requests')
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=20,
+        help='Mean request rate (requests per second, Poisson arrivals)')
+    parser.add_argument(
+        '--max-batch-size', type=int, default=8, help='Server batch size')
+    parser.add_argument(
+        '--max-wait-ms',
+        type=float,
+        default=10,
+        help='Server batching window in ms')
+    parser.add_argument(
+        '--pad-shape',
+        type=int,
+        nargs=2,
+        default=None,
+        help='Pad every input to this (H, W) on the server')
+    parser.add_argument(
+        '--device', default='cuda:0', help='Device used for inference')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+    return args
+
+
+def load_images(img_dir, num_requests):
+    files = sorted(
+        os.path.join(img_dir, name) for name in os.listdir(img_dir)
+        if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+    assert len(files) > 0, f'No image in {img_dir}'
+    images = [mmcv.imread(file) for file in files[:num_requests]]
+    return [images[i % len(images)] for i in range(num_requests)]
+
+
+async def run_load(infer, images, rate, seed):
+    """Send ``images`` with Poisson arrivals and return the latencies and
+    the total time."""
+    intervals = np.random.default_rng(seed).exponential(1 / rate, len(images))
+    latencies = [None] * len(images)
+
+    async def request(i, img):
+        start = time.perf_counter()
+        await infer(img)
+        latencies[i] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tasks = []
+    for i, (img, interval) in enumerate(zip(images, intervals)):
+        await asyncio.sleep(interval)
+        tasks.append(asyncio.create_task(request(i, img)))
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - start
+
+
+async def run_handler(model, images, rate, seed):
+    # MMdetHandler: requests are queued and run one at a time
+    loop = asyncio.get_running_loop()
+    lock = asyncio.Lock()
+
+    async def infer(img):
+        async with lock:
+            return await loop.run_in_executor(None, inference_detector, model,
+                                              img)
+
+    return await run_load(infer, images, rate, seed)
+
+
+async def run_server(model, images, args):
+    server = ExitAwareBatchingServer(
+        model,
+        args.threshold,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        pad_shape=args.pad_shape)
+    await server.start()
+    try:
+        latencies, total_time = await run_load(server.infer, images,
+                                               args.rate, args.seed)
+    finally:
+        await server.stop()
+    return latencies, total_time, server.get_exit_ratios()
+
+
+def report(name, latencies, total_time):
+    latencies = np.array(latencies) * 1e3
+    print(f'{name}: p50 {np.percentile(latencies, 50):.1f}ms, '
+          f'p99 {np.percentile(latencies, 99):.1f}ms, '
+          f'throughput {len(latencies) / total_time:.1f} img/s')
+
+
+def main(args):
+    model = init_detector(args.config, args.checkpoint, device=args.device)
+    images = load_images(args.img_dir, args.num_requests)
+
+    # warm up, also fills the zero level caches
+    model.set_threshold(torch.tensor(args.threshold))
+    for img in images[:5]:
+        inference_detector(model, img)
+
+    latencies, total_time = asyncio.run(
+        run_handler(model, images, args.rate, args.seed))
+    report('MMdetHandler', latencies, total_time)
+    model.unset_threshold()
+
+    latencies, total_time, exit_ratios = asyncio.run(
+        run_server(model, images, args))
+    report('ExitAwareBatchingServer', latencies, total_time)
+    print('Exit ratios: ' + ', '.join(f'{ratio:.2f}' for ratio in exit_ratios))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)